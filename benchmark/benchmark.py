@@ -0,0 +1,235 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "reader"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "segmentation"))
+from phantom import getPhantomPath, getPhantomSeries
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+DATA_DIR = os.path.join(tempfile.gettempdir(), "vtk-test-phantoms")
+SPACING = (0.703125, 0.703125, 1.25)
+
+"""
+    Stages: setup(dataDir, size) returns the arguments of run, only run is timed.
+    Every (stage, size) runs in a new process. The memory of a stage is the peak RSS of its runs minus the
+    RSS before them (stageRssMB): the peak is reset after the setup, so e.g. the splitSegments() of the
+    applyMask setup is not counted.
+"""
+
+def loadPhantom(dataDir: str, size: int):
+    from loader import wrapArrayAsImageData
+    return wrapArrayAsImageData(np.load(getPhantomPath(dataDir, size)), SPACING)
+
+def setupRead(dataDir: str, size: int) -> tuple:
+    import loader # vtk and its libraries are loaded by the setup, not counted in the stage memory
+    return (getPhantomSeries(dataDir, size, SPACING),)
+
+def runRead(dirpath: str) -> None:
+    from loader import loadVolume
+    loadVolume(dirpath)
+
+def runVtkDICOMImageReader(dirpath: str) -> None:
+    import vtk
+    reader = vtk.vtkDICOMImageReader()
+    reader.SetDirectoryName(dirpath)
+    reader.Update()
+
+def setupVolume(dataDir: str, size: int) -> tuple:
+    return (loadPhantom(dataDir, size),)
+
+def runVtk2sitk(imageData) -> None:
+    from remove_bed import vtk2sitk
+    vtk2sitk(imageData)
+
+def runSplitSegments(imageData) -> None:
+    from remove_bed import splitSegments
+    splitSegments(imageData)
+
+def runComputeMask(imageData) -> None:
+    from remove_bed import computeMask
+    computeMask(imageData)
+
+def runCoarseToFine(imageData) -> None:
+    from coarse import computeMaskCoarseToFine
+    computeMaskCoarseToFine(imageData)
+
+def setupApplyMask(dataDir: str, size: int) -> tuple:
+    from remove_bed import splitSegments
+    imageData = loadPhantom(dataDir, size)
+    return imageData, splitSegments(imageData)
+
+def runApplyMask(imageData, mask) -> None:
+    from remove_bed import applyMask
+    applyMask(imageData, mask)
+
+STAGES: Dict[str, Tuple[Callable, Callable]] = {
+    "read": (setupRead, runRead),
+    "vtkDICOMImageReader": (setupRead, runVtkDICOMImageReader),
+    "vtk2sitk": (setupVolume, runVtk2sitk),
+    "splitSegments": (setupVolume, runSplitSegments),
+    "computeMask": (setupVolume, runComputeMask),
+    "computeMaskCoarseToFine": (setupVolume, runCoarseToFine),
+    "applyMask": (setupApplyMask, runApplyMask),
+}
+
+def resetPeakRss() -> bool:
+    # Writing 5 to clear_refs resets VmHWM (Linux >= 4.0), ru_maxrss cannot be reset
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError as e:
+        print(f"Cannot reset the peak RSS, it includes the setup: {e}")
+        return False
+
+def getPeakRssMB() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+def getRssMB() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+"""
+    Description: worker of the pool, runs one stage on one phantom size.
+    Params:
+        stage: a key of STAGES
+        size: phantom cube size
+        dataDir: directory of the generated phantoms
+        repeat: number of timed runs, the fastest is kept
+    Return: the result record (dict)
+"""
+def runStage(stage: str, size: int, dataDir: str, repeat: int) -> dict:
+    setup, run = STAGES[stage]
+    arguments = setup(dataDir, size)
+    resetPeakRss()
+    rssBefore = getRssMB()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(*arguments)
+        timings.append(time.perf_counter() - start)
+    peakRss = getPeakRssMB()
+    return {
+        "stage": stage,
+        "size": size,
+        "seconds": min(timings),
+        "timings": timings,
+        "peakRssMB": peakRss,
+        "rssBeforeMB": rssBefore,
+        "stageRssMB": max(peakRss - rssBefore, 0.0),
+    }
+
+"""
+    Description: compare results with baselines.
+    Params:
+        results: records of runStage
+        baselines: {"<stage>/<size>": {"seconds": ..., "stageRssMB": ...}}
+        timeTolerance, memoryTolerance: allowed relative increase
+        timeSlack: allowed absolute increase (seconds), keeps millisecond stages from failing on noise
+        memorySlack: allowed absolute increase (MB) of the stage memory, same for the stages allocating a few MB
+        compareTimes: False when the baselines were measured on another host, only the memory is compared
+    Return: a list of regression messages
+"""
+def compareWithBaselines(results: List[dict], baselines: Dict[str, dict], timeTolerance: float, memoryTolerance: float, timeSlack: float, memorySlack: float, compareTimes=True) -> List[str]:
+    regressions = []
+    for result in results:
+        key = f"{result['stage']}/{result['size']}"
+        baseline = baselines.get(key)
+        if baseline is None:
+            continue
+        if compareTimes and result["seconds"] > baseline["seconds"] * (1 + timeTolerance) + timeSlack:
+            regressions.append(f"{key}: {result['seconds']:.3f}s > baseline {baseline['seconds']:.3f}s (+{timeTolerance:.0%})")
+        # Baselines without stageRssMB measured the whole process, they are not comparable
+        if "stageRssMB" in baseline and result["stageRssMB"] > baseline["stageRssMB"] * (1 + memoryTolerance) + memorySlack:
+            regressions.append(f"{key}: stage RSS {result['stageRssMB']:.0f}MB > baseline {baseline['stageRssMB']:.0f}MB (+{memoryTolerance:.0%})")
+    return regressions
+
+def getHost() -> dict:
+    # Identifies the machine the baseline timings were measured on
+    return {"machine": platform.platform(), "cpus": os.cpu_count()}
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Timing and peak memory of the reading/segmentation stages on synthetic CT phantoms")
+    parser.add_argument("-s", "--sizes", type=int, nargs="+", default=[128, 256], help="phantom cube sizes, up to 1024")
+    parser.add_argument("-t", "--stages", nargs="+", choices=sorted(STAGES), default=sorted(STAGES))
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("--data-dir", default=DATA_DIR, help="cache of the generated phantoms")
+    parser.add_argument("--baselines", default=BASELINE_PATH)
+    parser.add_argument("--update-baselines", action="store_true", help="store the results as the new baselines")
+    parser.add_argument("--time-tolerance", type=float, default=0.25)
+    parser.add_argument("--time-slack", type=float, default=0.02)
+    parser.add_argument("--memory-tolerance", type=float, default=0.10)
+    parser.add_argument("--memory-slack", type=float, default=4.0, help="MB")
+    parser.add_argument("-o", "--output", default=None, help="JSON file of the results")
+    args = parser.parse_args(argv)
+
+    # Generate the phantoms once, before the workers need them
+    for size in args.sizes:
+        getPhantomPath(args.data_dir, size)
+        if {"read", "vtkDICOMImageReader"} & set(args.stages):
+            getPhantomSeries(args.data_dir, size, SPACING)
+
+    results = []
+    # One new process per stage: max_tasks_per_child needs spawn
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context, max_tasks_per_child=1) as pool:
+        for size in args.sizes:
+            for stage in args.stages:
+                result = pool.submit(runStage, stage, size, args.data_dir, args.repeat).result()
+                results.append(result)
+                print(f"{stage:>24} {size:>5}^3 {result['seconds']:8.3f}s {result['stageRssMB']:8.0f}MB (peak {result['peakRssMB']:.0f}MB)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    host = getHost()
+    baselines = {}
+    sameHost = True
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            stored = json.load(f)
+        sameHost = {"machine": stored.get("machine"), "cpus": stored.get("cpus")} == host
+        baselines = stored["results"]
+    if args.update_baselines:
+        if not sameHost:
+            # Timings of another host are not kept next to the new ones
+            print(f"Baselines of {stored.get('machine')} ({stored.get('cpus')} CPUs) replaced")
+            baselines = {}
+        for result in results:
+            baselines[f"{result['stage']}/{result['size']}"] = {"seconds": result["seconds"], "stageRssMB": result["stageRssMB"], "peakRssMB": result["peakRssMB"]}
+        with open(args.baselines, "w") as f:
+            json.dump({**host, "results": dict(sorted(baselines.items()))}, f, indent=2)
+        print(f"Baselines updated: {args.baselines}")
+        return 0
+
+    if not sameHost:
+        print(f"WARNING baselines measured on {stored.get('machine')} ({stored.get('cpus')} CPUs), this host is {host['machine']} ({host['cpus']} CPUs): timings not compared, run with --update-baselines")
+    regressions = compareWithBaselines(results, baselines, args.time_tolerance, args.memory_tolerance, args.time_slack, args.memory_slack, compareTimes=sameHost)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"Regressions: {len(regressions)}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,102 @@
+import os
+from typing import Tuple
+
+import numpy as np
+import SimpleITK as sitk
+
+AIR = -1000
+SOFT_TISSUE = 40
+LUNG = -800
+BONE = 700
+TABLE = 300
+NOISE = 30 # uniform noise amplitude (HU), stays far from the -50 threshold of splitSegments
+
+"""
+    Description:
+        Synthetic CT phantom (z, y, x), int16 HU: air, a body ellipsoid (soft tissue, two lungs, a spine)
+        and a table slab under it, separated from the body by an air gap. splitSegments keeps the body and
+        removes the table. Generated slab by slab, so only output + one slab is in memory.
+    Params:
+        shape: (slices, rows, columns)
+        output: array (or np.memmap) of this shape to fill, default=None (allocated)
+        seed: seed of the noise
+        slabSize: number of slices generated at a time
+    Return: the phantom
+"""
+def generatePhantom(shape: Tuple[int, int, int], output: np.ndarray = None, seed=0, slabSize=32) -> np.ndarray:
+    depth, rows, columns = shape
+    if output is None:
+        output = np.empty(shape, dtype=np.int16)
+    rng = np.random.default_rng(seed)
+
+    # Normalized coordinates in [-1, 1], y grows downwards (the table is at the bottom of the image)
+    y = np.linspace(-1, 1, rows, dtype=np.float32)[:, None]
+    x = np.linspace(-1, 1, columns, dtype=np.float32)[None, :]
+    table = (y >= 0.62) & (y <= 0.7) & (np.abs(x) <= 0.85)
+    for z0 in range(0, depth, slabSize):
+        z1 = min(depth, z0 + slabSize)
+        z = np.linspace(-1, 1, depth, dtype=np.float32)[z0:z1, None, None]
+        slab = np.full((z1 - z0, rows, columns), AIR, dtype=np.int16)
+        body = (z / 0.95) ** 2 + ((y + 0.05) / 0.5) ** 2 + (x / 0.8) ** 2 <= 1
+        slab[body] = SOFT_TISSUE
+        for side in (-1, 1):
+            lung = (z / 0.6) ** 2 + ((y + 0.15) / 0.3) ** 2 + ((x - side * 0.35) / 0.25) ** 2 <= 1
+            slab[lung] = LUNG
+        spine = (((y - 0.3) / 0.1) ** 2 + (x / 0.1) ** 2 <= 1) & (np.abs(z) <= 0.9)
+        slab[spine] = BONE
+        slab[np.broadcast_to(table, slab.shape)] = TABLE
+        slab += rng.integers(-NOISE, NOISE + 1, size=slab.shape, dtype=np.int16)
+        output[z0:z1] = slab
+    return output
+
+"""
+    Description: phantom stored as .npy in dataDir, generated on the first call (memory-mapped, any size).
+    Params:
+        dataDir: directory of the generated phantoms
+        size: cube size (slices = rows = columns)
+    Return: path of the .npy file
+"""
+def getPhantomPath(dataDir: str, size: int) -> str:
+    path = os.path.join(dataDir, f"phantom_{size}.npy")
+    if not os.path.exists(path):
+        os.makedirs(dataDir, exist_ok=True)
+        output = np.lib.format.open_memmap(f"{path}.tmp", mode="w+", dtype=np.int16, shape=(size, size, size))
+        generatePhantom(output.shape, output)
+        output.flush()
+        del output
+        os.replace(f"{path}.tmp", path)
+    return path
+
+"""
+    Description:
+        Phantom written as a DICOM series (one CT file per slice) in dataDir, generated on the first call.
+        Slice z of the array is the one read at index z by loadVolume/vtkDICOMImageReader.
+    Params:
+        dataDir: directory of the generated phantoms
+        size: cube size
+        spacing: spacing (x, y, z)
+    Return: the series directory
+"""
+def getPhantomSeries(dataDir: str, size: int, spacing=(0.703125, 0.703125, 1.25)) -> str:
+    dirpath = os.path.join(dataDir, f"phantom_{size}_dicom")
+    if os.path.isdir(dirpath):
+        return dirpath
+    array = np.load(getPhantomPath(dataDir, size), mmap_mode="r")
+    temporary = f"{dirpath}.tmp"
+    os.makedirs(temporary, exist_ok=True)
+    seriesUID = f"1.2.826.0.1.3680043.8.498.{size}"
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    for index in range(size):
+        # vtkDICOMImageReader stacks the slices by decreasing position and flips the rows
+        image = sitk.GetImageFromArray(np.ascontiguousarray(array[size - 1 - index, ::-1]))
+        image.SetSpacing(spacing[:2])
+        position = f"0\\0\\{index * spacing[2]}"
+        for tag, value in (("0008|0060", "CT"), ("0020|000e", seriesUID), ("0020|0013", str(index + 1)),
+                           ("0020|0032", position), ("0020|0037", "1\\0\\0\\0\\1\\0"), ("0018|0050", str(spacing[2])),
+                           ("0008|0018", f"{seriesUID}.{index + 1}")):
+            image.SetMetaData(tag, value)
+        writer.SetFileName(os.path.join(temporary, f"{index + 1:05d}.dcm"))
+        writer.Execute(image)
+    os.replace(temporary, dirpath)
+    return dirpath
@@ -0,0 +1,83 @@
+import vtk
+from typing import List, Sequence
+
+"""
+    Description:
+        Multi-resolution pyramid of a volume (2x, 4x, 8x averaged by default) used while the user drags.
+        Every level has its own mapper, so switching levels only swaps the mapper of the vtkVolume,
+        no level is re-uploaded. The levels are computed when the pyramid is created, outside of any
+        interactive frame. The shrink filters are a vtk pipeline: after the input image is modified
+        (e.g. progressive loading) call update(), otherwise the first interactive frame recomputes them.
+        Automatic level selection: after every interactive frame the last render time is compared to
+        the desired update rate, the next frame uses a coarser level if too slow and a finer one if fast enough.
+    Params:
+        imageData: the full resolution volume
+        volume: the vtkVolume whose mapper is switched
+        factors: shrink factor of each level relative to the full resolution
+        desiredUpdateRate: frames per second wanted during interaction
+"""
+class VolumePyramid:
+    def __init__(self, imageData: vtk.vtkImageData, volume: vtk.vtkVolume, factors: Sequence[int] = (2, 4, 8), desiredUpdateRate=15.0) -> None:
+        self.volume = volume
+        self.fullResolutionMapper = volume.GetMapper()
+        self.desiredUpdateRate = desiredUpdateRate
+        self.shrinkFilters: List[vtk.vtkImageShrink3D] = []
+        self.mappers: List[vtk.vtkVolumeMapper] = []
+        self.level = 0 # index in self.mappers
+        self.isInteracting = False
+
+        previousFactor = 1
+        previousPort = None
+        for factor in factors:
+            relativeFactor = max(1, factor // previousFactor)
+            shrink = vtk.vtkImageShrink3D()
+            if previousPort is None:
+                shrink.SetInputData(imageData)
+            else:
+                shrink.SetInputConnection(previousPort)
+            shrink.SetShrinkFactors(relativeFactor, relativeFactor, relativeFactor)
+            shrink.AveragingOn()
+            self.shrinkFilters.append(shrink)
+            previousPort = shrink.GetOutputPort()
+            previousFactor = factor
+
+            mapper = self.fullResolutionMapper.NewInstance()
+            mapper.SetInputConnection(shrink.GetOutputPort())
+            mapper.SetBlendMode(self.fullResolutionMapper.GetBlendMode())
+            if hasattr(mapper, "SetAutoAdjustSampleDistances"):
+                mapper.SetAutoAdjustSampleDistances(self.fullResolutionMapper.GetAutoAdjustSampleDistances())
+            if hasattr(mapper, "SetLockSampleDistanceToInputSpacing"):
+                mapper.SetLockSampleDistanceToInputSpacing(self.fullResolutionMapper.GetLockSampleDistanceToInputSpacing())
+            self.mappers.append(mapper)
+        self.update()
+
+    def update(self) -> None:
+        # Shrink every level now (the last filter updates the whole chain), not in the first frame of a drag
+        if self.shrinkFilters:
+            self.shrinkFilters[-1].Update()
+
+    def attach(self, renderer: vtk.vtkRenderer) -> None:
+        renderer.AddObserver(vtk.vtkCommand.EndEvent, self.endRenderEventHandle)
+
+    def startInteraction(self) -> None:
+        if not self.mappers:
+            return
+        self.isInteracting = True
+        self.volume.SetMapper(self.mappers[self.level])
+
+    def endInteraction(self) -> None:
+        self.isInteracting = False
+        self.volume.SetMapper(self.fullResolutionMapper)
+
+    def endRenderEventHandle(self, obj: vtk.vtkRenderer, event: str) -> None:
+        if not self.isInteracting:
+            return
+        renderTime = obj.GetLastRenderTimeInSeconds()
+        budget = 1.0 / self.desiredUpdateRate
+        if renderTime > budget and self.level < len(self.mappers) - 1:
+            self.level += 1
+        elif renderTime < budget / 4 and self.level > 0: # a finer level costs ~4-8x more
+            self.level -= 1
+        else:
+            return
+        self.volume.SetMapper(self.mappers[self.level])
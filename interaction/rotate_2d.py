@@ -1,14 +1,23 @@
 import vtk
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "reader"))
+from store import volumeStore
+from presets import presetRegistry
+from pyramid import VolumePyramid
 
 class Rotate2DInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
     def __init__(self) -> None:
         super().__init__()
         self.isRotate = False
+        self.pyramid = None # VolumePyramid, coarse levels are rendered while the button is down
         self.AddObserver(vtk.vtkCommand.LeftButtonPressEvent, self.leftButtonPressEventHandle)
         self.AddObserver(vtk.vtkCommand.MouseMoveEvent, self.mouseMoveEventHandle)
         self.AddObserver(vtk.vtkCommand.LeftButtonReleaseEvent, self.leftButtonReleaseEventHandle)
 
     def leftButtonPressEventHandle(self, obj: vtk.vtkInteractorStyleTrackballCamera, event: str) -> None:
+        if self.pyramid is not None:
+            self.pyramid.startInteraction()
         self.StartSpin()
         if not self.isRotate:
             self.isRotate = True
@@ -23,6 +32,8 @@ class Rotate2DInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
     def leftButtonReleaseEventHandle(self, obj: vtk.vtkInteractorStyleTrackballCamera, event: str) -> None:
         if self.isRotate:
             self.isRotate = False
+        if self.pyramid is not None:
+            self.pyramid.endInteraction() # before EndSpin() so the final render is at full resolution
         self.EndSpin()
         self.OnLeftButtonUp()
 
@@ -36,56 +47,35 @@ def main(path: str) -> None:
     renderWindowInteractor.SetInteractorStyle(style)
     renderWindow.SetInteractor(renderWindowInteractor)
 
-    reader = vtk.vtkDICOMImageReader()
-    reader.SetDirectoryName(path)
-    reader.Update()
-    imageData = reader.GetOutput()
+    with volumeStore.open(path) as imageData: # shared with the other viewers of this process
+        mapper = vtk.vtkOpenGLGPUVolumeRayCastMapper()
+        mapper.SetInputConnection(volumeStore.getOutputPort(path))
+        mapper.AutoAdjustSampleDistancesOff()
+        mapper.LockSampleDistanceToInputSpacingOn()
 
-    mapper = vtk.vtkOpenGLGPUVolumeRayCastMapper()
-    mapper.SetInputData(imageData)
-    mapper.AutoAdjustSampleDistancesOff()
-    mapper.LockSampleDistanceToInputSpacingOn()
+        volumeProperty = vtk.vtkVolumeProperty()
+        volumeProperty.SetInterpolationTypeToLinear()
+        volumeProperty.ShadeOn()
 
-    volumeProperty = vtk.vtkVolumeProperty()
-    volumeProperty.SetInterpolationTypeToLinear()
-    volumeProperty.ShadeOn()
+        volumeProperty.SetAmbient(0.1)
+        volumeProperty.SetDiffuse(0.9)
+        volumeProperty.SetSpecular(0.2)
+        volumeProperty.SetSpecularPower(10)
 
-    volumeProperty.SetAmbient(0.1)
-    volumeProperty.SetDiffuse(0.9)
-    volumeProperty.SetSpecular(0.2)
-    volumeProperty.SetSpecularPower(10)
+        presetRegistry.applyPreset(volumeProperty, "CT-AAA")
 
-    scalarColorTransferFunction = vtk.vtkColorTransferFunction()
-    scalarColorTransferFunction.AddRGBPoint(-3024, 0, 0, 0)
-    scalarColorTransferFunction.AddRGBPoint(143.556, 0.615686, 0.356863, 0.184314)
-    scalarColorTransferFunction.AddRGBPoint(166.222, 0.882353, 0.603922, 0.290196)
-    scalarColorTransferFunction.AddRGBPoint(214.389, 1, 1, 1)
-    scalarColorTransferFunction.AddRGBPoint(419.736, 1, 0.937033, 0.954531)
-    scalarColorTransferFunction.AddRGBPoint(3071, 0.827451, 0.658824, 1)
-    volumeProperty.SetColor(scalarColorTransferFunction)
+        volume = vtk.vtkVolume()
+        volume.SetMapper(mapper)
+        volume.SetProperty(volumeProperty)
 
-    scalarOpacity = vtk.vtkPiecewiseFunction()
-    scalarOpacity.AddPoint(-3024, 0)
-    scalarOpacity.AddPoint(143.556, 0)
-    scalarOpacity.AddPoint(166.222, 0.686275)
-    scalarOpacity.AddPoint(214.389, 0.696078)
-    scalarOpacity.AddPoint(419.736, 0.833333)
-    scalarOpacity.AddPoint(3071, 0.803922)
-    volumeProperty.SetScalarOpacity(scalarOpacity)
+        renderer.AddVolume(volume)
+        renderer.ResetCamera()
 
-    gradientOpacity = vtk.vtkPiecewiseFunction()
-    gradientOpacity.AddPoint(0, 1)
-    gradientOpacity.AddPoint(255, 1)
-    volumeProperty.SetGradientOpacity(gradientOpacity)
+        pyramid = VolumePyramid(imageData, volume)
+        pyramid.attach(renderer)
+        style.pyramid = pyramid
 
-    volume = vtk.vtkVolume()
-    volume.SetMapper(mapper)
-    volume.SetProperty(volumeProperty)
-
-    renderer.AddVolume(volume)
-    renderer.ResetCamera()
-    
-    renderWindowInteractor.Start()
+        renderWindowInteractor.Start()
 
 if __name__ == "__main__":
     path = "./data/220277460 Nguyen Thanh Dat"
@@ -1,14 +1,25 @@
 import vtk
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "reader"))
+from streaming import ProgressiveVolumeLoader
+from store import volumeStore
+from presets import presetRegistry
+from skipping import EmptySpaceSkipping
+from pyramid import VolumePyramid
 
 class ZoomInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
     def __init__(self) -> None:
         super().__init__()
         self.isZoom = False
+        self.pyramid = None # VolumePyramid, coarse levels are rendered while the button is down
         self.AddObserver(vtk.vtkCommand.LeftButtonPressEvent, self.leftButtonPressEventHandle)
         self.AddObserver(vtk.vtkCommand.MouseMoveEvent, self.mouseMoveEventHandle)
         self.AddObserver(vtk.vtkCommand.LeftButtonReleaseEvent, self.leftButtonReleaseEventHandle)
 
     def leftButtonPressEventHandle(self, obj: vtk.vtkInteractorStyleTrackballCamera, event: str) -> None:
+        if self.pyramid is not None:
+            self.pyramid.startInteraction()
         self.StartDolly()
         if not self.isZoom:
             self.isZoom = True
@@ -23,6 +34,8 @@ class ZoomInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
     def leftButtonReleaseEventHandle(self, obj: vtk.vtkInteractorStyleTrackballCamera, event: str) -> None:
         if self.isZoom:
             self.isZoom = False
+        if self.pyramid is not None:
+            self.pyramid.endInteraction() # before EndDolly() so the final render is at full resolution
         self.EndDolly()
         self.OnLeftButtonUp()
 
@@ -36,57 +49,55 @@ def main(path: str) -> None:
     renderWindowInteractor.SetInteractorStyle(style)
     renderWindow.SetInteractor(renderWindowInteractor)
 
-    reader = vtk.vtkDICOMImageReader()
-    reader.SetDirectoryName(path)
-    reader.Update()
-    imageData = reader.GetOutput()
+    # Coarse preview first, the remaining slices are streamed in after the window is shown
+    # The store only loads it when no other viewer of this process has the series open
+    volumeLoader = ProgressiveVolumeLoader(path)
+    with volumeStore.open(path, lambda dirpath: volumeLoader.loadPreview()) as imageData:
+        # mapper = vtk.vtkOpenGLGPUVolumeRayCastMapper()
+        mapper = vtk.vtkFixedPointVolumeRayCastMapper()
+        mapper.SetInputConnection(volumeStore.getOutputPort(path))
+        mapper.AutoAdjustSampleDistancesOff()
+        mapper.LockSampleDistanceToInputSpacingOn()
 
-    # mapper = vtk.vtkOpenGLGPUVolumeRayCastMapper()
-    mapper = vtk.vtkFixedPointVolumeRayCastMapper()
-    mapper.SetInputData(imageData)
-    mapper.AutoAdjustSampleDistancesOff()
-    mapper.LockSampleDistanceToInputSpacingOn()
+        volumeProperty = vtk.vtkVolumeProperty()
+        volumeProperty.SetInterpolationTypeToLinear()
+        volumeProperty.ShadeOn()
 
-    volumeProperty = vtk.vtkVolumeProperty()
-    volumeProperty.SetInterpolationTypeToLinear()
-    volumeProperty.ShadeOn()
+        volumeProperty.SetAmbient(0.1)
+        volumeProperty.SetDiffuse(0.9)
+        volumeProperty.SetSpecular(0.2)
+        volumeProperty.SetSpecularPower(10)
 
-    volumeProperty.SetAmbient(0.1)
-    volumeProperty.SetDiffuse(0.9)
-    volumeProperty.SetSpecular(0.2)
-    volumeProperty.SetSpecularPower(10)
+        presetRegistry.applyPreset(volumeProperty, "CT-AAA")
 
-    scalarColorTransferFunction = vtk.vtkColorTransferFunction()
-    scalarColorTransferFunction.AddRGBPoint(-3024, 0, 0, 0)
-    scalarColorTransferFunction.AddRGBPoint(143.556, 0.615686, 0.356863, 0.184314)
-    scalarColorTransferFunction.AddRGBPoint(166.222, 0.882353, 0.603922, 0.290196)
-    scalarColorTransferFunction.AddRGBPoint(214.389, 1, 1, 1)
-    scalarColorTransferFunction.AddRGBPoint(419.736, 1, 0.937033, 0.954531)
-    scalarColorTransferFunction.AddRGBPoint(3071, 0.827451, 0.658824, 1)
-    volumeProperty.SetColor(scalarColorTransferFunction)
+        volume = vtk.vtkVolume()
+        volume.SetMapper(mapper)
+        volume.SetProperty(volumeProperty)
 
-    scalarOpacity = vtk.vtkPiecewiseFunction()
-    scalarOpacity.AddPoint(-3024, 0)
-    scalarOpacity.AddPoint(143.556, 0)
-    scalarOpacity.AddPoint(166.222, 0.686275)
-    scalarOpacity.AddPoint(214.389, 0.696078)
-    scalarOpacity.AddPoint(419.736, 0.833333)
-    scalarOpacity.AddPoint(3071, 0.803922)
-    volumeProperty.SetScalarOpacity(scalarOpacity)
+        renderer.AddVolume(volume)
+        renderer.ResetCamera()
 
-    gradientOpacity = vtk.vtkPiecewiseFunction()
-    gradientOpacity.AddPoint(0, 1)
-    gradientOpacity.AddPoint(255, 1)
-    volumeProperty.SetGradientOpacity(gradientOpacity)
+        pyramid = VolumePyramid(imageData, volume)
+        pyramid.attach(renderer)
+        style.pyramid = pyramid
 
-    volume = vtk.vtkVolume()
-    volume.SetMapper(mapper)
-    volume.SetProperty(volumeProperty)
+        # Only the blocks with a non-zero opacity are ray cast (re-classified when the transfer function changes)
+        # Attached once every slice is decoded: each publish of the loader modifies the image and would rebuild the grid
+        skipping = EmptySpaceSkipping(volume, imageData, [mapper] + pyramid.mappers)
+        def loadingDone() -> None:
+            # The pyramid levels of the complete volume are shrunk here, before the next drag
+            pyramid.update()
+            skipping.attach(renderer)
+            skipping.update()
 
-    renderer.AddVolume(volume)
-    renderer.ResetCamera()
-    
-    renderWindowInteractor.Start()
+        renderWindowInteractor.Initialize()
+        if volumeLoader.imageData is imageData:
+            volumeLoader.attach(renderWindowInteractor)
+            volumeLoader.start()
+            volumeLoader.addDoneCallback(loadingDone)
+        else:
+            loadingDone()
+        renderWindowInteractor.Start()
 
 if __name__ == "__main__":
     path = "./data/220277460 Nguyen Thanh Dat"
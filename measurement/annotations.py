@@ -0,0 +1,198 @@
+import vtk
+import numpy as np
+from typing import List
+from vtkmodules.util.numpy_support import numpy_to_vtk, numpy_to_vtkIdTypeArray
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "reader"))
+from instrumentation import timed
+from transform import getViewTransform
+
+ARC_RESOLUTION = 30 # segments of an angle arc
+ANGLE_PLACEMENT_RATIO = 0.5 # arc radius / shortest ray, as buildArcAngleMeasurement
+ANGLE_TEXT_PLACEMENT_RATIO = 0.7
+EPSILON = 0.001 # rays shorter than this (on every axis) have no angle
+
+"""
+    Description:
+        Length and angle annotations of a renderer, stored as arrays: (N, 2, 3) length endpoints and
+        (M, 3, 3) angle points (first, vertex, third). Everything is drawn by two actors whatever the number
+        of annotations: the lines/rays/arcs in one vtkPolyData (world coordinates) and the labels through one
+        vtkLabeledDataMapper in display coordinates.
+        One StartEvent observer of the renderer rebuilds the geometry and the label texts when annotations
+        changed, and re-projects all label anchors with one matrix product when the camera, the viewport or
+        the window size changed. Indices are positions in the arrays: removing an annotation shifts the next ones.
+    Params:
+        renderer: the renderer showing the annotations
+"""
+class AnnotationManager:
+    def __init__(self, renderer: vtk.vtkRenderer) -> None:
+        self.renderer = renderer
+        self.lengthPoints = np.empty((0, 2, 3))
+        self.anglePoints = np.empty((0, 3, 3))
+        self.lengths = np.empty(0)
+        self.angles = np.empty(0)
+        self.labelAnchors = np.empty((0, 3)) # world positions of the labels, lengths then angles
+        self.isModified = False
+        self.projectionKey = None
+
+        self.geometry = vtk.vtkPolyData()
+        geometryMapper = vtk.vtkPolyDataMapper()
+        geometryMapper.SetInputData(self.geometry)
+        self.geometryActor = vtk.vtkActor()
+        self.geometryActor.SetMapper(geometryMapper)
+        self.geometryActor.GetProperty().SetColor(0, 1, 0)
+        self.geometryActor.GetProperty().SetLineWidth(1.5)
+        self.geometryActor.PickableOff()
+
+        self.labels = vtk.vtkPolyData()
+        self.labelPoints = vtk.vtkPoints()
+        self.labels.SetPoints(self.labelPoints)
+        labelMapper = vtk.vtkLabeledDataMapper()
+        labelMapper.SetInputData(self.labels)
+        labelMapper.SetLabelModeToLabelFieldData()
+        labelMapper.SetFieldDataName("labels")
+        labelMapper.SetCoordinateSystem(vtk.vtkLabeledDataMapper.DISPLAY)
+        labelMapper.GetLabelTextProperty().SetColor(1, 1, 0)
+        labelMapper.GetLabelTextProperty().SetFontSize(14)
+        self.labelActor = vtk.vtkActor2D()
+        self.labelActor.SetMapper(labelMapper)
+        self.labelActor.PickableOff()
+
+        renderer.AddActor(self.geometryActor)
+        renderer.AddViewProp(self.labelActor)
+        renderer.AddObserver(vtk.vtkCommand.StartEvent, self.startRenderEventHandle)
+
+    def addLength(self, firstPoint: List[float], secondPoint: List[float]) -> int:
+        self.lengthPoints = np.concatenate((self.lengthPoints, [[firstPoint, secondPoint]]))
+        self.isModified = True
+        return len(self.lengthPoints) - 1
+
+    def addAngle(self, firstPoint: List[float], secondPoint: List[float], thirdPoint: List[float]) -> int:
+        # secondPoint is the vertex
+        self.anglePoints = np.concatenate((self.anglePoints, [[firstPoint, secondPoint, thirdPoint]]))
+        self.isModified = True
+        return len(self.anglePoints) - 1
+
+    def setLength(self, index: int, firstPoint: List[float], secondPoint: List[float]) -> None:
+        self.lengthPoints[index] = (firstPoint, secondPoint)
+        self.isModified = True
+
+    def setAngle(self, index: int, firstPoint: List[float], secondPoint: List[float], thirdPoint: List[float]) -> None:
+        self.anglePoints[index] = (firstPoint, secondPoint, thirdPoint)
+        self.isModified = True
+
+    def removeLength(self, index: int) -> None:
+        self.lengthPoints = np.delete(self.lengthPoints, index, axis=0)
+        self.isModified = True
+
+    def removeAngle(self, index: int) -> None:
+        self.anglePoints = np.delete(self.anglePoints, index, axis=0)
+        self.isModified = True
+
+    def getLengths(self) -> np.ndarray:
+        self.rebuild()
+        return self.lengths
+
+    def getAngles(self) -> np.ndarray:
+        # Degrees, 0 for the degenerate angles
+        self.rebuild()
+        return self.angles
+
+    def startRenderEventHandle(self, obj: vtk.vtkRenderer, event: str) -> None:
+        self.rebuild()
+        self.project()
+
+    @timed()
+    def rebuild(self) -> None:
+        # Measurements, label texts and geometry of every annotation, after annotations changed
+        if not self.isModified:
+            return
+        self.isModified = False
+        self.projectionKey = None
+
+        # Lengths: segment, label at the middle
+        first, second = self.lengthPoints[:, 0], self.lengthPoints[:, 1]
+        self.lengths = np.linalg.norm(second - first, axis=1)
+        lengthAnchors = (first + second) / 2
+
+        # Angles: the same construction as buildArcAngleMeasurement
+        vertex = self.anglePoints[:, 1]
+        vector1 = self.anglePoints[:, 0] - vertex
+        vector2 = self.anglePoints[:, 2] - vertex
+        valid = ~(np.all(np.abs(vector1) < EPSILON, axis=1) | np.all(np.abs(vector2) < EPSILON, axis=1))
+        norm1 = np.linalg.norm(vector1, axis=1)
+        norm2 = np.linalg.norm(vector2, axis=1)
+        unit1 = vector1 / np.where(norm1 > 0, norm1, 1)[:, None]
+        unit2 = vector2 / np.where(norm2 > 0, norm2, 1)[:, None]
+        cosine = np.clip(np.einsum("ij,ij->i", unit1, unit2), -1, 1)
+        self.angles = np.where(valid, np.degrees(np.arccos(cosine)), 0.0)
+        shortest = np.minimum(norm1, norm2)
+        bisector = unit1 + unit2
+        bisectorNorm = np.linalg.norm(bisector, axis=1)
+        bisector /= np.where(bisectorNorm > 0, bisectorNorm, 1)[:, None]
+        angleAnchors = vertex + (ANGLE_TEXT_PLACEMENT_RATIO * shortest)[:, None] * bisector
+
+        # Arc from unit1 to unit2 (slerp), radius ANGLE_PLACEMENT_RATIO * shortest ray
+        theta = np.radians(self.angles)
+        t = np.linspace(0, 1, ARC_RESOLUTION + 1)
+        sine = np.sin(theta)
+        safeSine = np.where(sine > 1e-9, sine, 1)[:, None]
+        weight1 = np.where(sine[:, None] > 1e-9, np.sin((1 - t)[None, :] * theta[:, None]) / safeSine, 1 - t)
+        weight2 = np.where(sine[:, None] > 1e-9, np.sin(t[None, :] * theta[:, None]) / safeSine, t)
+        radius = (ANGLE_PLACEMENT_RATIO * shortest * valid)[:, None, None]
+        arcs = vertex[:, None] + radius * (weight1[:, :, None] * unit1[:, None] + weight2[:, :, None] * unit2[:, None])
+
+        self.buildGeometry(arcs, valid)
+
+        # Label texts
+        texts = [f"{round(length, 1)}mm" for length in self.lengths]
+        texts += [f"{round(angle, 1)}deg" if isValid else "" for angle, isValid in zip(self.angles, valid)]
+        labelArray = vtk.vtkStringArray()
+        labelArray.SetName("labels")
+        labelArray.SetNumberOfValues(len(texts))
+        for i, text in enumerate(texts):
+            labelArray.SetValue(i, text)
+        self.labels.GetPointData().AddArray(labelArray)
+        self.labelAnchors = np.concatenate((lengthAnchors, angleAnchors))
+        self.labelPoints.SetNumberOfPoints(len(self.labelAnchors))
+
+    def buildGeometry(self, arcs: np.ndarray, valid: np.ndarray) -> None:
+        # One polydata: a line per length, then per angle the polyline first-vertex-third and the arc polyline
+        lengthCount = len(self.lengthPoints)
+        angleCount = len(self.anglePoints)
+        arcSize = ARC_RESOLUTION + 1
+        points = np.concatenate((self.lengthPoints.reshape(-1, 3), self.anglePoints.reshape(-1, 3), arcs.reshape(-1, 3)))
+
+        lengthCells = np.arange(2 * lengthCount).reshape(-1, 2)
+        rayCells = 2 * lengthCount + np.arange(3 * angleCount).reshape(-1, 3)
+        arcCells = 2 * lengthCount + 3 * angleCount + np.arange(arcSize * angleCount).reshape(-1, arcSize)
+        connectivity = np.concatenate((lengthCells.ravel(), rayCells.ravel(), arcCells[valid].ravel())).astype(np.int64)
+        sizes = np.concatenate((np.full(lengthCount, 2), np.full(angleCount, 3), np.full(int(valid.sum()), arcSize)))
+        offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+
+        vtkPoints = vtk.vtkPoints()
+        vtkPoints.SetData(numpy_to_vtk(points, deep=True))
+        lines = vtk.vtkCellArray()
+        lines.SetData(numpy_to_vtkIdTypeArray(offsets, deep=True), numpy_to_vtkIdTypeArray(connectivity, deep=True))
+        self.geometry.SetPoints(vtkPoints)
+        self.geometry.SetLines(lines)
+        self.geometry.Modified()
+
+    @timed()
+    def project(self) -> None:
+        # Display positions of every label in one pass, only when the view changed
+        renderWindow = self.renderer.GetRenderWindow()
+        key = (self.renderer.GetActiveCamera().GetMTime(), self.renderer.GetViewport(), renderWindow.GetSize() if renderWindow is not None else None)
+        if key == self.projectionKey or len(self.labelAnchors) == 0:
+            self.projectionKey = key
+            return
+        self.projectionKey = key
+        display = getViewTransform(self.renderer).worldToDisplay(self.labelAnchors)
+        # Anchors outside the near/far planes (e.g. behind the camera) are moved out of the window
+        hidden = (display[:, 2] < 0) | (display[:, 2] > 1)
+        display[hidden, :2] = -1e6
+        display[:, 2] = 0
+        self.labelPoints.SetData(numpy_to_vtk(np.round(display), deep=True))
+        self.labels.Modified()
@@ -0,0 +1,148 @@
+import vtk
+import numpy as np
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+from vtkmodules.util.numpy_support import vtk_to_numpy
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "reader"))
+from instrumentation import timed
+from transform import ViewTransform
+
+PICK_CACHE_SIZE = 64 # display points remembered by CachedPicker under one view
+
+"""
+    Description:
+        Per display point cache of a picker (vtkCellPicker, vtkVolumePicker, ...). The results of the last
+        PICK_CACHE_SIZE display points are kept as long as the view and the picked data are unchanged:
+        camera (MTime, not the one of the renderer which SetDisplayPoint() modifies), viewport, window size,
+        the picked props (MTime, includes their property and transfer functions) and their input images.
+        A widget callback picks every endpoint on each drag event: only the dragged one is cast again.
+    Params:
+        picker: the picker doing the picks
+        props: the picked props (e.g. the pick list of a vtkCellPicker)
+        size: number of display points kept, default=PICK_CACHE_SIZE
+"""
+class CachedPicker:
+    def __init__(self, picker, props: Sequence[vtk.vtkProp3D], size=PICK_CACHE_SIZE) -> None:
+        self.picker = picker
+        self.props = list(props)
+        self.size = size
+        self.pickPosition = (0.0, 0.0, 0.0)
+        self.cache: "OrderedDict[Tuple[float, float], Tuple[int, Tuple[float, float, float]]]" = OrderedDict()
+        self.cacheKey = None
+        self.hitCount = 0 # statistics: cached / cast picks
+        self.missCount = 0
+
+    def GetPickPosition(self) -> Tuple[float, float, float]:
+        return self.pickPosition
+
+    def getKey(self, renderer: vtk.vtkRenderer) -> Tuple:
+        inputs = [prop.GetMapper().GetInput() if hasattr(prop, "GetMapper") and prop.GetMapper() is not None else None for prop in self.props]
+        return (
+            renderer.GetActiveCamera().GetMTime(),
+            renderer.GetViewport(),
+            renderer.GetRenderWindow().GetSize(),
+            tuple(prop.GetMTime() for prop in self.props),
+            tuple(data.GetMTime() if data is not None else 0 for data in inputs),
+        )
+
+    def Pick(self, x: float, y: float, z: float, renderer: vtk.vtkRenderer) -> int:
+        key = self.getKey(renderer)
+        if key != self.cacheKey:
+            self.cache.clear()
+            self.cacheKey = key
+        # Display positions read back from a representation differ by rounding errors only
+        point = (round(x, 3), round(y, 3))
+        entry = self.cache.get(point)
+        if entry is not None:
+            self.cache.move_to_end(point)
+            self.hitCount += 1
+            result, self.pickPosition = entry
+            return result
+        self.missCount += 1
+        result = self.picker.Pick(x, y, z, renderer)
+        if result:
+            self.pickPosition = tuple(self.picker.GetPickPosition())
+        self.cache[point] = (result, self.pickPosition)
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        return result
+
+"""
+    Description:
+        Picking from the depth buffer of the last rendered frame. The z-buffer of the render window is read
+        once per frame (on the first pick after a render), a pick then reads one depth value and transforms it
+        with the cached inverse of the view/projection matrix of the camera: O(1) whatever the size of the data.
+        Drop-in for vtkCellPicker in getPickPosition(), which also takes its display -> world conversion
+        (convertFromDisplayCoords2WorldCoords) without the SetDisplayPoint/DisplayToWorld round-trips.
+        Volume mappers do not write the depth buffer: background depths are passed to fallbackPicker
+        (e.g. a CachedPicker of a vtkCellPicker picking the volume) when there is one.
+    Params:
+        renderer: the renderer whose frames are picked
+        fallbackPicker: picker used where the depth buffer is empty, default=None
+"""
+class DepthPicker:
+    def __init__(self, renderer: vtk.vtkRenderer, fallbackPicker=None) -> None:
+        self.renderer = renderer
+        self.fallbackPicker = fallbackPicker
+        self.pickPosition = (0.0, 0.0, 0.0)
+        self.depth: Optional[np.ndarray] = None # (height, width), row 0 is the bottom of the window
+        self.viewTransform = ViewTransform(renderer)
+        self.isFrameValid = False
+        renderer.AddObserver(vtk.vtkCommand.EndEvent, self.endRenderEventHandle)
+
+    def endRenderEventHandle(self, obj: vtk.vtkRenderer, event: str) -> None:
+        self.isFrameValid = False
+
+    def GetPickPosition(self) -> Tuple[float, float, float]:
+        return self.pickPosition
+
+    def update(self) -> None:
+        if self.isFrameValid:
+            return
+        renderWindow = self.renderer.GetRenderWindow()
+        width, height = renderWindow.GetSize()
+        depth = vtk.vtkFloatArray()
+        renderWindow.GetZbufferData(0, 0, width - 1, height - 1, depth)
+        self.depth = vtk_to_numpy(depth).reshape(height, width)
+        self.viewTransform.update()
+        self.isFrameValid = True
+
+    def getWorldPoint(self, x: float, y: float, depth: float) -> Tuple[float, float, float]:
+        point = self.viewTransform.apply(self.viewTransform.displayToWorldMatrix, np.array([x, y, depth]))[0]
+        return tuple(float(v) for v in point)
+
+    def getDepth(self, x: float, y: float) -> float:
+        height, width = self.depth.shape
+        return float(self.depth[min(max(int(y), 0), height - 1), min(max(int(x), 0), width - 1)])
+
+    """
+        Description: pick the rendered surface under a display point.
+        Params:
+            x, y: display coordinates
+            z: unused (vtkCellPicker signature)
+            renderer: must be the renderer of the picker
+        Return: 1 if there is something rendered at (x, y) in the viewport of the renderer (GetPickPosition()), 0 otherwise
+    """
+    @timed()
+    def Pick(self, x: float, y: float, z: float, renderer: vtk.vtkRenderer) -> int:
+        # The depth buffer is the one of the whole window: outside the viewport it belongs to other renderers
+        if not self.renderer.IsInViewport(int(x), int(y)):
+            return 0
+        self.update()
+        depth = self.getDepth(x, y)
+        if depth < 1.0:
+            self.pickPosition = self.getWorldPoint(x, y, depth)
+            return 1
+        if self.fallbackPicker is not None and self.fallbackPicker.Pick(x, y, z, renderer):
+            self.pickPosition = tuple(self.fallbackPicker.GetPickPosition())
+            return 1
+        return 0
+
+    def convertFromDisplayCoords2WorldCoords(self, point: List[float], focalPoint: List[float]) -> List[float]:
+        # Same result as utils.convertFromDisplayCoords2WorldCoords: the point at the depth of the focal point
+        self.update()
+        focal = self.viewTransform.apply(self.viewTransform.worldToDisplayMatrix, np.array(focalPoint[:3]))[0]
+        return list(self.getWorldPoint(point[0], point[1], focal[2]))
@@ -0,0 +1,132 @@
+import time
+import vtk
+from typing import Callable, Optional
+
+"""
+    Description:
+        Coalesce the InteractionEvent bursts of a widget (one per mouse move) into at most one call of
+        dragCallback per rendered frame and per interval, and call releaseCallback once on EndInteractionEvent.
+        Events arriving too early only mark the drag as pending: a single one-shot timer of the interactor
+        runs the last one when it is due, so picks never queue up behind a fast drag. Everything runs on the
+        thread of the interactor.
+        Typical use: the dragged point on the focal plane while dragging, the exact surface snap on release.
+    Params:
+        widget: a vtkAbstractWidget, enabled with an interactor before the first interaction
+        dragCallback: (widget, event) called during the interaction
+        releaseCallback: (widget, event) called on EndInteractionEvent, default=None (dragCallback)
+        interval: minimum time between two calls of dragCallback (seconds)
+        perFrame: also wait for a new frame of the renderer between two calls
+        picker: picker of the callbacks, default=None. It is warmed by one pick after the first frame of the
+            window, so what it builds lazily (block grids, opacity tables, view caches) is not built by the
+            first InteractionEvent. The widget needs its interactor (with a render window) when the scheduler is created.
+"""
+class InteractionScheduler:
+    def __init__(self, widget: vtk.vtkAbstractWidget, dragCallback: Callable, releaseCallback: Optional[Callable] = None, interval=1.0 / 30, perFrame=True, picker=None) -> None:
+        self.widget = widget
+        self.dragCallback = dragCallback
+        self.releaseCallback = releaseCallback or dragCallback
+        self.interval = interval
+        self.perFrame = perFrame
+        self.pendingEvent: Optional[str] = None
+        self.lastCall = 0.0
+        self.frameCount = 0 # frames rendered since the interaction started
+        self.frameCountAtLastCall = -1
+        self.timerId = None
+        self.interactor: Optional[vtk.vtkRenderWindowInteractor] = None
+        self.renderer: Optional[vtk.vtkRenderer] = None
+        self.callCount = 0 # statistics: dragCallback calls / coalesced events
+        self.coalescedCount = 0
+        widget.AddObserver(vtk.vtkCommand.StartInteractionEvent, self.startInteractionEventHandle)
+        widget.AddObserver(vtk.vtkCommand.InteractionEvent, self.interactionEventHandle)
+        widget.AddObserver(vtk.vtkCommand.EndInteractionEvent, self.endInteractionEventHandle)
+        self.picker = picker
+        self.warmUpObserver = None
+        if picker is not None:
+            self.warmUpObserver = widget.GetInteractor().GetRenderWindow().AddObserver(vtk.vtkCommand.EndEvent, self.warmUpEventHandle)
+
+    def attach(self) -> None:
+        # Observers of the interactor and renderer, done on the first interaction (the widget has them by then)
+        if self.interactor is not None:
+            return
+        self.interactor = self.widget.GetInteractor()
+        self.interactor.AddObserver(vtk.vtkCommand.TimerEvent, self.timerEventHandle)
+        self.renderer = self.widget.GetCurrentRenderer() or self.interactor.GetRenderWindow().GetRenderers().GetFirstRenderer()
+        self.renderer.AddObserver(vtk.vtkCommand.EndEvent, self.endRenderEventHandle)
+
+    def warmUpEventHandle(self, obj: vtk.vtkRenderWindow, event: str) -> None:
+        # Once, after the first frame: a pick at the center of the first renderer
+        obj.RemoveObserver(self.warmUpObserver)
+        self.warmUpObserver = None
+        renderer = self.widget.GetCurrentRenderer() or obj.GetRenderers().GetFirstRenderer()
+        if renderer is None:
+            return
+        width, height = renderer.GetSize()
+        x, y = renderer.GetOrigin()
+        self.picker.Pick(x + width / 2, y + height / 2, 0, renderer)
+
+    def isDue(self, now: float) -> bool:
+        if now - self.lastCall < self.interval:
+            return False
+        return not self.perFrame or self.frameCount != self.frameCountAtLastCall
+
+    def call(self, event: str, now: float) -> None:
+        self.pendingEvent = None
+        self.lastCall = now
+        self.frameCountAtLastCall = self.frameCount
+        self.callCount += 1
+        self.dragCallback(self.widget, event)
+
+    def schedule(self, now: float) -> None:
+        # One timer at most, for the remaining part of the interval (a missing frame is checked again on EndEvent)
+        if self.timerId is not None:
+            return
+        delay = max(1, int((self.interval - (now - self.lastCall)) * 1000))
+        self.timerId = self.interactor.CreateOneShotTimer(delay)
+
+    def cancelTimer(self) -> None:
+        if self.timerId is not None:
+            self.interactor.DestroyTimer(self.timerId)
+            self.timerId = None
+
+    def startInteractionEventHandle(self, obj: vtk.vtkAbstractWidget, event: str) -> None:
+        self.attach()
+        self.cancelTimer()
+        self.pendingEvent = None
+        self.lastCall = 0.0
+        self.frameCount = 0
+        self.frameCountAtLastCall = -1
+
+    def interactionEventHandle(self, obj: vtk.vtkAbstractWidget, event: str) -> None:
+        self.attach()
+        now = time.perf_counter()
+        if self.isDue(now):
+            # The widget renders right after this event, no extra render needed
+            self.call(event, now)
+            return
+        if self.pendingEvent is not None:
+            self.coalescedCount += 1
+        self.pendingEvent = event
+        self.schedule(now)
+
+    def timerEventHandle(self, obj: vtk.vtkRenderWindowInteractor, event: str) -> None:
+        if self.timerId is None or obj.GetTimerEventId() != self.timerId:
+            return
+        self.timerId = None
+        if self.pendingEvent is None:
+            return
+        now = time.perf_counter()
+        if self.isDue(now):
+            self.call(self.pendingEvent, now)
+            obj.Render()
+        elif not self.perFrame or self.frameCount != self.frameCountAtLastCall:
+            self.schedule(now)
+
+    def endRenderEventHandle(self, obj: vtk.vtkRenderer, event: str) -> None:
+        self.frameCount += 1
+        if self.pendingEvent is not None:
+            self.schedule(time.perf_counter())
+
+    def endInteractionEventHandle(self, obj: vtk.vtkAbstractWidget, event: str) -> None:
+        self.cancelTimer()
+        self.pendingEvent = None
+        self.releaseCallback(self.widget, event)
@@ -0,0 +1,73 @@
+import weakref
+import vtk
+import numpy as np
+
+def getMatrix(matrix: vtk.vtkMatrix4x4) -> np.ndarray:
+    return np.array([[matrix.GetElement(i, j) for j in range(4)] for i in range(4)])
+
+"""
+    Description:
+        World <-> display transform of a renderer as two 4x4 matrices, the same conversion as
+        vtkRenderer::WorldToDisplay/DisplayToWorld (camera composite matrix with the near/far planes at 0/1,
+        so the display z is the depth buffer value, then the viewport). The matrices are recomputed only
+        when the camera, the viewport or the window size changed, N points are converted with one product
+        and one perspective divide.
+    Params:
+        renderer: the renderer of the conversions
+"""
+class ViewTransform:
+    def __init__(self, renderer: vtk.vtkRenderer) -> None:
+        self.rendererReference = weakref.ref(renderer) # the cache of getViewTransform() must not keep the renderer alive
+        self.key = None
+        self.worldToDisplayMatrix = np.eye(4)
+        self.displayToWorldMatrix = np.eye(4)
+
+    def update(self) -> None:
+        renderer = self.rendererReference()
+        renderWindow = renderer.GetRenderWindow()
+        camera = renderer.GetActiveCamera()
+        viewport = renderer.GetViewport()
+        size = renderWindow.GetSize() if renderWindow is not None else renderer.GetSize()
+        key = (camera.GetMTime(), viewport, size)
+        if key == self.key:
+            return
+        width, height = size
+        # View [-1, 1] -> display (pixels): the affine map of vtkViewport
+        viewToDisplay = np.array([
+            [(viewport[2] - viewport[0]) * width / 2, 0, 0, (viewport[0] + (viewport[2] - viewport[0]) / 2) * width],
+            [0, (viewport[3] - viewport[1]) * height / 2, 0, (viewport[1] + (viewport[3] - viewport[1]) / 2) * height],
+            [0, 0, 1, 0],
+            [0, 0, 0, 1],
+        ])
+        worldToView = getMatrix(camera.GetCompositeProjectionTransformMatrix(renderer.GetTiledAspectRatio(), 0, 1))
+        # The perspective divide commutes with the affine viewport map, so both fit in one matrix
+        self.worldToDisplayMatrix = viewToDisplay @ worldToView
+        self.displayToWorldMatrix = np.linalg.inv(self.worldToDisplayMatrix)
+        self.key = key
+
+    def apply(self, matrix: np.ndarray, points: np.ndarray) -> np.ndarray:
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        homogeneous = points @ matrix[:3, :3].T + matrix[:3, 3]
+        w = points @ matrix[3, :3] + matrix[3, 3]
+        w[w == 0] = 1 # as vtkRenderer: no divide by a null w
+        return homogeneous / w[:, None]
+
+    def worldToDisplay(self, points: np.ndarray) -> np.ndarray:
+        # (N, 3) world points -> (N, 3) display points (x, y in pixels, z depth in [0, 1])
+        self.update()
+        return self.apply(self.worldToDisplayMatrix, points)
+
+    def displayToWorld(self, points: np.ndarray) -> np.ndarray:
+        # (N, 3) display points (x, y, depth) -> (N, 3) world points
+        self.update()
+        return self.apply(self.displayToWorldMatrix, points)
+
+viewTransforms: "weakref.WeakKeyDictionary[vtk.vtkRenderer, ViewTransform]" = weakref.WeakKeyDictionary()
+
+def getViewTransform(renderer: vtk.vtkRenderer) -> ViewTransform:
+    # One cached transform per renderer
+    viewTransform = viewTransforms.get(renderer)
+    if viewTransform is None:
+        viewTransform = ViewTransform(renderer)
+        viewTransforms[renderer] = viewTransform
+    return viewTransform
@@ -1,7 +1,14 @@
 import vtk
 from vtkmodules.vtkCommonCore import vtkMath
-from typing import List
+from typing import List, Union
 import math
+import numpy as np
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "reader"))
+from instrumentation import timed
+from picker import DepthPicker, CachedPicker
+from transform import getViewTransform
 
 """
     Description:
@@ -14,6 +21,7 @@ import math
         renderer: used to convert coordinates
     Return: a point (in world coordinates)
 """
+@timed()
 def convertFromDisplayCoords2WorldCoords(point: List[int], focalPoint: List[float], renderer: vtk.vtkRenderer) -> List[float]:
     # Select z-axis when convert the focal point from homogeneous coordinates to display coordinates
     renderer.SetWorldPoint(focalPoint[0], focalPoint[1], focalPoint[2], 1) 
@@ -39,12 +47,43 @@ def convertFromDisplayCoords2WorldCoords(point: List[int], focalPoint: List[floa
         renderer: used to convert coordinates
     Return: a point (in display coordinates)
 """
+@timed()
 def convertFromWorldCoords2DisplayCoords(point: List[float], renderer: vtk.vtkRenderer) -> List[float]:
     # Specify a point location in world coordinates. This method takes homogeneous coordinates
     renderer.SetWorldPoint(point[0], point[1], point[2], 1)
     renderer.WorldToDisplay()
     return list(renderer.GetDisplayPoint()) # Return specified point location in display coordinates 
 
+"""
+    Description:
+        Batched convertFromWorldCoords2DisplayCoords: one matrix product for N points, the matrix of the
+        renderer is only rebuilt when its camera, viewport or window size changed.
+    Params:
+        points: (N, 3) array of points (in world coordinates)
+        renderer: used to convert coordinates
+    Return: (N, 3) array of points (in display coordinates, z is the depth)
+"""
+@timed()
+def convertFromWorldCoords2DisplayCoordsBatch(points: np.ndarray, renderer: vtk.vtkRenderer) -> np.ndarray:
+    return getViewTransform(renderer).worldToDisplay(points)
+
+"""
+    Description:
+        Batched convertFromDisplayCoords2WorldCoords: the points are put at the depth of the focal point,
+        which is computed once for all of them.
+    Params:
+        points: (N, 2) array of points (in display coordinates)
+        focalPoint: the focal point of camera object (in world coordinates) used to select z-axis
+        renderer: used to convert coordinates
+    Return: (N, 3) array of points (in world coordinates)
+"""
+@timed()
+def convertFromDisplayCoords2WorldCoordsBatch(points: np.ndarray, focalPoint: List[float], renderer: vtk.vtkRenderer) -> np.ndarray:
+    viewTransform = getViewTransform(renderer)
+    selectionz = viewTransform.worldToDisplay(focalPoint)[0, 2]
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return viewTransform.displayToWorld(np.column_stack((points, np.full(len(points), selectionz))))
+
 """
     Description:
         Calculate the euclide distance between two points.
@@ -52,6 +91,7 @@ def convertFromWorldCoords2DisplayCoords(point: List[float], renderer: vtk.vtkRe
     Params: two points
     Return: the euclidean distance
 """
+@timed()
 def getEuclideanDistanceBetween2Points(firstPoint: List[float], secondPoint: List[float]) -> float:
     distSquared = vtkMath.Distance2BetweenPoints(firstPoint, secondPoint)
     dist = math.sqrt(distSquared)
@@ -66,6 +106,7 @@ def getEuclideanDistanceBetween2Points(firstPoint: List[float], secondPoint: Lis
         directionOfProjection: a vector (in world coordinates)
     Return: the projection point of the second point
 """
+@timed()
 def findProjectionPoint(firstPoint: List[float], secondPoint: List[float], directionOfProjection: List[float]) -> List[float]:
     x1 = firstPoint[0]; y1 = firstPoint[1]; z1 = firstPoint[2]
     a = directionOfProjection[0]; b = directionOfProjection[1]; c = directionOfProjection[2]
@@ -93,7 +134,8 @@ def findProjectionPoint(firstPoint: List[float], secondPoint: List[float], direc
         Method can return a projection point (in case out).
     Params:
         point: a point (in display coordinates)
-        cellPicker: used to get a point on surface
+        cellPicker: used to get a point on surface, a CachedPicker reuses the picks of unchanged display points,
+            a DepthPicker picks from the depth buffer of the last frame (and also converts the point if out)
         renderer: used to convert coordinates
         camera: used to get focal point and direction of projection
 
@@ -102,18 +144,24 @@ def findProjectionPoint(firstPoint: List[float], secondPoint: List[float], direc
         if checkToGetProjectionPoint=True, finding a plane thought the first point. After finding a projection point of the second point on plane
     Return: a point (in world coordinates)
 """
-def getPickPosition(point: List[int], cellPicker: vtk.vtkCellPicker, renderer: vtk.vtkRenderer, camera: vtk.vtkCamera, checkToGetProjectionPoint=False, firstPoint=None) -> List[float]:
+@timed()
+def getPickPosition(point: List[int], cellPicker: Union[vtk.vtkCellPicker, DepthPicker, CachedPicker], renderer: vtk.vtkRenderer, camera: vtk.vtkCamera, checkToGetProjectionPoint=False, firstPoint=None) -> List[float]:
     pickPosition = None
     check = cellPicker.Pick(point[0], point[1], 0, renderer)
     if check:
         pickPosition = list(cellPicker.GetPickPosition())
     else:
-        pickPosition = convertFromDisplayCoords2WorldCoords(list(point), list(camera.GetFocalPoint()), renderer)
+        if isinstance(cellPicker, DepthPicker):
+            pickPosition = cellPicker.convertFromDisplayCoords2WorldCoords(list(point), list(camera.GetFocalPoint()))
+        else:
+            pickPosition = convertFromDisplayCoords2WorldCoords(list(point), list(camera.GetFocalPoint()), renderer)
         if checkToGetProjectionPoint:
             projectionPoint = findProjectionPoint(firstPoint, pickPosition, list(camera.GetDirectionOfProjection()))
             pickPosition = projectionPoint
     return pickPosition
 
+ANGLE_MODES = ("Unsigned", "OrientedSigned", "OrientedPositive")
+
 """
     Description:
         Method returns the angle between two vectors.
@@ -121,9 +169,12 @@ def getPickPosition(point: List[int], cellPicker: vtk.vtkCellPicker, renderer: v
         The second vector created by the third point and the second point.
     Params:
         firstPoint, secondPoint, thirdPoint: three points in world coordinates
+        mode: "Unsigned" (0 -> 180), "OrientedSigned" (-180 -> 180) or "OrientedPositive" (0 -> 360), default="Unsigned"
+        rotationAxis: the oriented angles are positive counterclockwise around this axis, default=(0, 0, 1)
     Return: the angle between two vectors
 """
-def getAngleDegrees(firstPoint: List[float], secondPoint: List[float], thirdPoint: List[float]) -> float:
+@timed()
+def getAngleDegrees(firstPoint: List[float], secondPoint: List[float], thirdPoint: List[float], mode="Unsigned", rotationAxis=(0, 0, 1)) -> float:
     EPSILON = 1e-3 # threshold
 
     if vtkMath.Distance2BetweenPoints(firstPoint, secondPoint) <= EPSILON and vtkMath.Distance2BetweenPoints(thirdPoint, secondPoint) <= EPSILON:
@@ -134,11 +185,18 @@ def getAngleDegrees(firstPoint: List[float], secondPoint: List[float], thirdPoin
     vtkMath.Normalize(vector1)
     vtkMath.Normalize(vector2)
 
-    angleRad = math.acos(vtkMath.Dot(vector1, vector2)) # Dot: tich vo huong
+    angleRad = math.acos(max(-1.0, min(1.0, vtkMath.Dot(vector1, vector2)))) # Dot: tich vo huong
     angleDeg = vtkMath.DegreesFromRadians(angleRad)
 
+    if mode != "Unsigned":
+        # The sign is given by the direction of vector1 x vector2 along the rotation axis
+        cross = [0.0, 0.0, 0.0]
+        vtkMath.Cross(vector1, vector2, cross)
+        if vtkMath.Dot(cross, list(rotationAxis)) < 0:
+            angleDeg = -angleDeg
+        if mode == "OrientedPositive" and angleDeg < 0:
+            angleDeg += 360.0
     return angleDeg
-    # TODO: need to develop other options such as: OrientedSigned (-180 -> 180) and OrientedPositive (0 -> 360)
 
 """
     Description:
@@ -149,6 +207,7 @@ def getAngleDegrees(firstPoint: List[float], secondPoint: List[float], thirdPoin
         points: object contains points in world coordinates
     Return: None
 """
+@timed()
 def buildTextActorLengthMeasurement(textActor: vtk.vtkTextActor, renderer: vtk.vtkRenderer, points: vtk.vtkPoints) -> None:
     if points.GetNumberOfPoints() == 2:
         firstPoint = list(points.GetPoint(0))
@@ -176,6 +235,7 @@ def buildTextActorLengthMeasurement(textActor: vtk.vtkTextActor, renderer: vtk.v
         points: object contains points in world coordinates
     Return: None
 """
+@timed()
 def buildArcAngleMeasurement(arc: vtk.vtkArcSource, textActor: vtk.vtkTextActor, renderer: vtk.vtkRenderer, points: vtk.vtkPoints) -> None:
     if points.GetNumberOfPoints() == 3:
         # Get three points
@@ -226,42 +286,60 @@ def buildArcAngleMeasurement(arc: vtk.vtkArcSource, textActor: vtk.vtkTextActor,
         textActor.SetInput(f"{round(angle, 1)}deg")
         textActor.SetPosition(round(textActorPositionDisplay[0]), round(textActorPositionDisplay[1]))
 
-def to_rgb_points(colormap: List[dict]) -> List[list]:
-    rgb_points = []
-    for item in colormap:
-        crange = item["range"]
-        color = item["color"]
-        for idx, r in enumerate(crange):
-            if len(color) == len(crange):
-                rgb_points.append([r] + color[idx])
-            else:
-                rgb_points.append([r] + color[0])
-    return rgb_points
-
-STANDARD = [
-    {
-        "name": 'air',
-        "range": [-1000],
-        "color": [[0, 0, 0]] # black
-    },
-    {
-        "name": 'lung',
-        "range": [-600, -400],
-        "color": [[194 / 255, 105 / 255, 82 / 255]]
-    },
-    {
-        "name": 'fat',
-        "range": [-100, -60],
-        "color": [[194 / 255, 166 / 255, 115 / 255]]
-    },
-    {
-        "name": 'soft tissue',
-        "range": [40, 80],
-        "color": [[102 / 255, 0, 0], [153 / 255, 0, 0]] # red
-    },
-    {
-        "name": 'bone',
-        "range": [400, 1000],
-        "color": [[255 / 255, 217 / 255, 163 / 255]] # ~ white
-    }
-]
\ No newline at end of file
+"""
+    Description: array version of getEuclideanDistanceBetween2Points.
+    Params: firstPoints, secondPoints: (N, 3) arrays (or one (3,) point, broadcast)
+    Return: (N,) array of euclidean distances
+"""
+@timed()
+def getEuclideanDistances(firstPoints: np.ndarray, secondPoints: np.ndarray) -> np.ndarray:
+    difference = np.asarray(secondPoints, dtype=np.float64) - np.asarray(firstPoints, dtype=np.float64)
+    return np.sqrt(np.einsum("...i,...i->...", difference, difference))
+
+"""
+    Description:
+        Array version of getAngleDegrees, same results (including the degenerate cases: 0 when both vectors
+        are null, a null vector is not normalized).
+    Params:
+        firstPoints, secondPoints, thirdPoints: (N, 3) arrays, secondPoints are the vertices
+        mode: "Unsigned", "OrientedSigned" or "OrientedPositive", default="Unsigned"
+        rotationAxis: (3,) or (N, 3), default=(0, 0, 1)
+    Return: (N,) array of angles (degrees)
+"""
+@timed()
+def getAnglesDegrees(firstPoints: np.ndarray, secondPoints: np.ndarray, thirdPoints: np.ndarray, mode="Unsigned", rotationAxis=(0, 0, 1)) -> np.ndarray:
+    EPSILON = 1e-3 # threshold, as getAngleDegrees
+
+    secondPoints = np.asarray(secondPoints, dtype=np.float64)
+    vector1 = np.asarray(firstPoints, dtype=np.float64) - secondPoints
+    vector2 = np.asarray(thirdPoints, dtype=np.float64) - secondPoints
+    squaredNorm1 = np.einsum("...i,...i->...", vector1, vector1)
+    squaredNorm2 = np.einsum("...i,...i->...", vector2, vector2)
+    # vtkMath.Normalize leaves a null vector unchanged
+    norm1 = np.sqrt(squaredNorm1)
+    norm2 = np.sqrt(squaredNorm2)
+    vector1 = vector1 / np.where(norm1 > 0, norm1, 1)[..., None]
+    vector2 = vector2 / np.where(norm2 > 0, norm2, 1)[..., None]
+
+    angles = np.degrees(np.arccos(np.clip(np.einsum("...i,...i->...", vector1, vector2), -1.0, 1.0)))
+    if mode != "Unsigned":
+        cross = np.cross(vector1, vector2)
+        angles = np.where(np.einsum("...i,...i->...", cross, np.broadcast_to(np.asarray(rotationAxis, dtype=np.float64), cross.shape)) < 0, -angles, angles)
+        if mode == "OrientedPositive":
+            angles = np.where(angles < 0, angles + 360.0, angles)
+    return np.where((squaredNorm1 <= EPSILON) & (squaredNorm2 <= EPSILON), 0.0, angles)
+
+"""
+    Description: array version of findProjectionPoint, projection of secondPoints on the planes through firstPoints.
+    Params:
+        firstPoints, secondPoints: (N, 3) arrays
+        directionsOfProjection: normals of the planes, (N, 3) or one (3,) direction for all
+    Return: (N, 3) array of projection points
+"""
+@timed()
+def findProjectionPoints(firstPoints: np.ndarray, secondPoints: np.ndarray, directionsOfProjection: np.ndarray) -> np.ndarray:
+    firstPoints = np.asarray(firstPoints, dtype=np.float64)
+    secondPoints = np.asarray(secondPoints, dtype=np.float64)
+    directions = np.broadcast_to(np.asarray(directionsOfProjection, dtype=np.float64), np.broadcast_shapes(firstPoints.shape, secondPoints.shape))
+    t = np.einsum("...i,...i->...", firstPoints - secondPoints, directions) / np.einsum("...i,...i->...", directions, directions)
+    return secondPoints + t[..., None] * directions
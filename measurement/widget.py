@@ -1,8 +1,16 @@
 import vtk
-from typing import Tuple, List
+from typing import Tuple, List, Optional
 from vtkmodules.vtkCommonCore import vtkCommand
 
-from utils import to_rgb_points, STANDARD
+from picker import CachedPicker
+from scheduler import InteractionScheduler
+from utils import convertFromDisplayCoords2WorldCoordsBatch
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "reader"))
+from store import volumeStore
+from presets import presetRegistry
+from instrumentation import instrumentAlgorithm, instrumentRenderWindow
 
 def main() -> None:
     cone = vtk.vtkConeSource()
@@ -48,7 +56,6 @@ def main() -> None:
     renderWindowInteractor.Start()
 
 def distance_widget(path) -> None:
-    reader = vtk.vtkDICOMImageReader()
     volumeMapper = vtk.vtkSmartVolumeMapper()
     volume = vtk.vtkVolume()
     volumeProperty = vtk.vtkVolumeProperty()
@@ -71,67 +78,75 @@ def distance_widget(path) -> None:
     distanceRepresentation = vtk.vtkDistanceRepresentation2D()
     distanceWidget = vtk.vtkDistanceWidget()
     
-    reader.SetDirectoryName(path)
-    reader.Update()
-    
-    volumeMapper.SetInputData(reader.GetOutput())
-    volume.SetMapper(volumeMapper)
-
-    set_volume_properties(volumeProperty)
-    volume.SetProperty(volumeProperty)
-
-    renderer.AddVolume(volume)
-    renderer.ResetCamera()
-
-    renderWindow.AddRenderer(renderer)
-
-    # Distance widget
-    if isinstance(distanceRepresentation, vtk.vtkDistanceRepresentation3D):
-        # Line property
-        distanceRepresentation.GetLineProperty().SetColor(0, 1, 0)
-        distanceRepresentation.GetLineProperty().SetLineWidth(1.5)
-        # distanceRepresentation.GetLineProperty().SetAmbient(0.1)
-        # distanceRepresentation.GetLineProperty().SetDiffuse(0.9)
-        # distanceRepresentation.GetLineProperty().SetSpecular(0.2)
-        # distanceRepresentation.GetLineProperty().SetSpecularPower(10)
-        # distanceRepresentation.GetLineProperty().ShadingOn()
-        # Label property
-        distanceRepresentation.GetLabelProperty().SetColor(1, 1, 0)
-        # distanceRepresentation.SetLabelPosition(1)
-
-        # Scale text (font size along each dimension)
-        # distanceRepresentation.SetLabelScale(6, 6, 6)
-    else:
-        # Line property
-        distanceRepresentation.GetAxisProperty().SetColor(0, 1, 0)
-        distanceRepresentation.GetAxisProperty().SetLineWidth(1.5)
-        # Label property
-        distanceRepresentation.GetAxis().GetTitleTextProperty().SetColor(1, 1, 0)
-        # distanceRepresentation.GetAxis().SetTitlePosition(1)
-
-        # distanceRepresentation.GetAxis().TickVisibilityOff()
-
-    labelFormat = distanceRepresentation.GetLabelFormat()
-    distanceRepresentation.SetLabelFormat(f"{labelFormat} mm")
-
-    distanceWidget.SetRepresentation(distanceRepresentation)
-    distanceWidget.SetInteractor(renderWindowInteractor)
-
-    # distanceWidget.GetRepresentation().SetPoint1WorldPosition([0, 0, 0])
-
-    # distanceWidget.AddObserver(vtkCommand.PlacePointEvent, distancePlacePointEventCallback)
-    distanceWidget.AddObserver(vtkCommand.InteractionEvent, distanceInteractionEventCallback)
-    # distanceWidget.AddObserver(vtkCommand.InteractionEvent, test)
-    # distanceWidget.AddObserver(vtkCommand.EndInteractionEvent, test2)
-    # distanceWidget.AddObserver(vtkCommand.EndInteractionEvent, distanceEndInteractionEventCallback)
-
-    # Turn on widget
-    distanceWidget.On()
-
-    renderWindowInteractor.Start()
+    with volumeStore.open(path): # shared with the other viewers of this process
+        volumeMapper.SetInputConnection(volumeStore.getOutputPort(path))
+        volume.SetMapper(volumeMapper)
+
+        set_volume_properties(volumeProperty)
+        volume.SetProperty(volumeProperty)
+
+        renderer.AddVolume(volume)
+        renderer.ResetCamera()
+
+        renderWindow.AddRenderer(renderer)
+
+        # Distance widget
+        if isinstance(distanceRepresentation, vtk.vtkDistanceRepresentation3D):
+            # Line property
+            distanceRepresentation.GetLineProperty().SetColor(0, 1, 0)
+            distanceRepresentation.GetLineProperty().SetLineWidth(1.5)
+            # distanceRepresentation.GetLineProperty().SetAmbient(0.1)
+            # distanceRepresentation.GetLineProperty().SetDiffuse(0.9)
+            # distanceRepresentation.GetLineProperty().SetSpecular(0.2)
+            # distanceRepresentation.GetLineProperty().SetSpecularPower(10)
+            # distanceRepresentation.GetLineProperty().ShadingOn()
+            # Label property
+            distanceRepresentation.GetLabelProperty().SetColor(1, 1, 0)
+            # distanceRepresentation.SetLabelPosition(1)
+
+            # Scale text (font size along each dimension)
+            # distanceRepresentation.SetLabelScale(6, 6, 6)
+        else:
+            # Line property
+            distanceRepresentation.GetAxisProperty().SetColor(0, 1, 0)
+            distanceRepresentation.GetAxisProperty().SetLineWidth(1.5)
+            # Label property
+            distanceRepresentation.GetAxis().GetTitleTextProperty().SetColor(1, 1, 0)
+            # distanceRepresentation.GetAxis().SetTitlePosition(1)
+
+            # distanceRepresentation.GetAxis().TickVisibilityOff()
+
+        labelFormat = distanceRepresentation.GetLabelFormat()
+        distanceRepresentation.SetLabelFormat(f"{labelFormat} mm")
+
+        distanceWidget.SetRepresentation(distanceRepresentation)
+        distanceWidget.SetInteractor(renderWindowInteractor)
+
+        # distanceWidget.GetRepresentation().SetPoint1WorldPosition([0, 0, 0])
+
+        # distanceWidget.AddObserver(vtkCommand.PlacePointEvent, distancePlacePointEventCallback)
+        # While dragging, the dragged endpoint only follows the mouse on the focal plane (no ray cast, at most once per frame),
+        # on release the endpoints are snapped to the first opaque point of the volume by the cell picker
+        # (cached per display point), the endpoint which was not dragged is not picked again
+        cachedPicker = CachedPicker(cellPicker, [volume])
+        scheduler = InteractionScheduler(
+            distanceWidget,
+            lambda obj, event: dragEndpointCallback(obj, event, DISTANCE_ENDPOINTS),
+            lambda obj, event: distanceInteractionEventCallback(obj, event, cachedPicker),
+            picker=cachedPicker,
+        )
+        # distanceWidget.AddObserver(vtkCommand.InteractionEvent, test)
+        # distanceWidget.AddObserver(vtkCommand.EndInteractionEvent, test2)
+        # distanceWidget.AddObserver(vtkCommand.EndInteractionEvent, distanceEndInteractionEventCallback)
+
+        # Turn on widget
+        distanceWidget.On()
+
+        instrumentAlgorithm(volumeMapper)
+        instrumentRenderWindow(renderWindow)
+        renderWindowInteractor.Start()
 
 def angle_widget(path) -> None:
-    reader = vtk.vtkDICOMImageReader()
     volumeMapper = vtk.vtkSmartVolumeMapper()
     volume = vtk.vtkVolume()
     volumeProperty = vtk.vtkVolumeProperty()
@@ -154,48 +169,83 @@ def angle_widget(path) -> None:
     angleRepresentation = vtk.vtkAngleRepresentation2D()
     angleWidget = vtk.vtkAngleWidget()
     
-    reader.SetDirectoryName(path)
-    reader.Update()
-    
-    volumeMapper.SetInputData(reader.GetOutput())
-    volume.SetMapper(volumeMapper)
-
-    set_volume_properties(volumeProperty)
-    volume.SetProperty(volumeProperty)
-
-    renderer.AddVolume(volume)
-    renderer.ResetCamera()
-
-    renderWindow.AddRenderer(renderer)
-
-    # Distance widget
-    if isinstance(angleRepresentation, vtk.vtkAngleRepresentation3D):
-        pass
-    else:
-        angleRepresentation.GetRay1().SetArrowPlacementToNone()
-        angleRepresentation.GetRay1().GetProperty().SetLineWidth(1.5)
-        angleRepresentation.GetRay1().GetProperty().SetColor(0, 1, 0)
-
-        angleRepresentation.GetArc().GetProperty().SetLineWidth(1.5)
-        angleRepresentation.GetArc().GetProperty().SetColor(0, 1, 0)
-        angleRepresentation.GetArc().GetLabelTextProperty().SetColor(1, 1, 0)
-
-        angleRepresentation.GetRay2().SetArrowPlacementToNone()
-        angleRepresentation.GetRay2().GetProperty().SetLineWidth(1.5)
-        angleRepresentation.GetRay2().GetProperty().SetColor(0, 1, 0)
-
-    angleWidget.SetRepresentation(angleRepresentation)
-    angleWidget.SetInteractor(renderWindowInteractor)
-
-    angleWidget.AddObserver(vtkCommand.EndInteractionEvent, angleEndInteractionEventCallback)
-
-    # Turn on widget
-    angleWidget.On()
-
-    renderWindowInteractor.Start()
-
-def angleEndInteractionEventCallback(obj: vtk.vtkAngleWidget, event: str) -> None:
-    cellPicker = obj.GetInteractor().GetPicker()
+    with volumeStore.open(path): # shared with the other viewers of this process
+        volumeMapper.SetInputConnection(volumeStore.getOutputPort(path))
+        volume.SetMapper(volumeMapper)
+
+        set_volume_properties(volumeProperty)
+        volume.SetProperty(volumeProperty)
+
+        renderer.AddVolume(volume)
+        renderer.ResetCamera()
+
+        renderWindow.AddRenderer(renderer)
+
+        # Distance widget
+        if isinstance(angleRepresentation, vtk.vtkAngleRepresentation3D):
+            pass
+        else:
+            angleRepresentation.GetRay1().SetArrowPlacementToNone()
+            angleRepresentation.GetRay1().GetProperty().SetLineWidth(1.5)
+            angleRepresentation.GetRay1().GetProperty().SetColor(0, 1, 0)
+
+            angleRepresentation.GetArc().GetProperty().SetLineWidth(1.5)
+            angleRepresentation.GetArc().GetProperty().SetColor(0, 1, 0)
+            angleRepresentation.GetArc().GetLabelTextProperty().SetColor(1, 1, 0)
+
+            angleRepresentation.GetRay2().SetArrowPlacementToNone()
+            angleRepresentation.GetRay2().GetProperty().SetLineWidth(1.5)
+            angleRepresentation.GetRay2().GetProperty().SetColor(0, 1, 0)
+
+        angleWidget.SetRepresentation(angleRepresentation)
+        angleWidget.SetInteractor(renderWindowInteractor)
+
+        # Dragged point on the focal plane while dragging, snapped on release
+        # The vertex and the endpoint which are not dragged are not picked again
+        cachedPicker = CachedPicker(cellPicker, [volume])
+        scheduler = InteractionScheduler(
+            angleWidget,
+            lambda obj, event: dragEndpointCallback(obj, event, ANGLE_ENDPOINTS),
+            lambda obj, event: angleEndInteractionEventCallback(obj, event, cachedPicker),
+            picker=cachedPicker,
+        )
+
+        # Turn on widget
+        angleWidget.On()
+
+        instrumentAlgorithm(volumeMapper)
+        instrumentRenderWindow(renderWindow)
+        renderWindowInteractor.Start()
+
+# Endpoint of the representation handled in each interaction state (the handle being dragged)
+DISTANCE_ENDPOINTS = {vtk.vtkDistanceRepresentation.NearP1: "Point1", vtk.vtkDistanceRepresentation.NearP2: "Point2"}
+ANGLE_ENDPOINTS = {vtk.vtkAngleRepresentation.NearP1: "Point1", vtk.vtkAngleRepresentation.NearCenter: "Center", vtk.vtkAngleRepresentation.NearP2: "Point2"}
+
+"""
+    Description:
+        Drag callback of the measurement widgets: the dragged endpoint is put at the depth of the focal point
+        under the mouse (one matrix product, no pick). The other endpoints keep their snapped positions and the
+        surface snap is left to the release callback.
+    Params:
+        obj: a vtkDistanceWidget or vtkAngleWidget
+        event: the event
+        endpoints: DISTANCE_ENDPOINTS or ANGLE_ENDPOINTS
+    Return: None
+"""
+def dragEndpointCallback(obj: vtk.vtkAbstractWidget, event: str, endpoints: dict) -> None:
+    representation = obj.GetRepresentation()
+    name = endpoints.get(representation.GetInteractionState())
+    if name is None:
+        return
+    renderer = obj.GetInteractor().GetRenderWindow().GetRenderers().GetFirstRenderer()
+    displayPoint = [0, 0, 0]
+    getattr(representation, f"Get{name}DisplayPosition")(displayPoint)
+    focalPoint = renderer.GetActiveCamera().GetFocalPoint()
+    worldPoint = convertFromDisplayCoords2WorldCoordsBatch(displayPoint[:2], focalPoint, renderer)[0]
+    getattr(representation, f"Set{name}WorldPosition")(worldPoint.tolist())
+
+def angleEndInteractionEventCallback(obj: vtk.vtkAngleWidget, event: str, picker: Optional[CachedPicker] = None) -> None:
+    cellPicker = picker if picker is not None else obj.GetInteractor().GetPicker()
     renderer = obj.GetInteractor().GetRenderWindow().GetRenderers().GetFirstRenderer()
 
     point1DisplayPoint = [0, 0, 0]
@@ -245,8 +295,8 @@ def distancePlacePointEventCallback(obj: vtk.vtkDistanceWidget, event: str) -> N
         pickPosition = cellPicker.GetPickPosition()
         obj.GetRepresentation().SetPoint1WorldPosition(list(pickPosition))
 
-def distanceInteractionEventCallback(obj: vtk.vtkDistanceWidget, event: str) -> None:
-    cellPicker = obj.GetInteractor().GetPicker()
+def distanceInteractionEventCallback(obj: vtk.vtkDistanceWidget, event: str, picker: Optional[CachedPicker] = None) -> None:
+    cellPicker = picker if picker is not None else obj.GetInteractor().GetPicker()
     renderer = obj.GetInteractor().GetRenderWindow().GetRenderers().GetFirstRenderer()
 
     point1DisplayPoint = [0, 0, 0]
@@ -282,10 +332,6 @@ def distanceEndInteractionEventCallback(obj: vtk.vtkDistanceWidget, event: str)
         obj.GetRepresentation().SetPoint2WorldPosition(list(pickPosition))
 
 def set_volume_properties(volumeProperty: vtk.vtkVolumeProperty) -> None:
-    gradientOpacity = vtk.vtkPiecewiseFunction()
-    scalarOpacity = vtk.vtkPiecewiseFunction()
-    color = vtk.vtkColorTransferFunction()
-
     volumeProperty.ShadeOn()
     volumeProperty.SetScalarOpacityUnitDistance(0.1)
     volumeProperty.SetInterpolationTypeToLinear()
@@ -295,39 +341,8 @@ def set_volume_properties(volumeProperty: vtk.vtkVolumeProperty) -> None:
     volumeProperty.SetSpecular(0.2)
     volumeProperty.SetSpecularPower(10)
 
-    gradientOpacity.AddPoint(0.0, 0.0)
-    gradientOpacity.AddPoint(2000.0, 1.0)
-    volumeProperty.SetGradientOpacity(gradientOpacity)
-
-    # scalarOpacity.AddPoint(-800.0, 0.0)
-    # scalarOpacity.AddPoint(-750.0, 1.0)
-    # scalarOpacity.AddPoint(-350.0, 1.0)
-    # scalarOpacity.AddPoint(-300.0, 0.0)
-    # scalarOpacity.AddPoint(-200.0, 0.0)
-    # scalarOpacity.AddPoint(-100.0, 1.0)
-    # scalarOpacity.AddPoint(1000.0, 0.0)
-    # scalarOpacity.AddPoint(2750.0, 0.0)
-    # scalarOpacity.AddPoint(2976.0, 1.0)
-    # scalarOpacity.AddPoint(3000.0, 0.0)
-    # volumeProperty.SetScalarOpacity(scalarOpacity)
-
-    # color.AddRGBPoint(-750.0, 0.08, 0.05, 0.03)
-    # color.AddRGBPoint(-350.0, 0.39, 0.25, 0.16)
-    # color.AddRGBPoint(-200.0, 0.80, 0.80, 0.80)
-    # color.AddRGBPoint(2750.0, 0.70, 0.70, 0.70)
-    # color.AddRGBPoint(3000.0, 0.35, 0.35, 0.35)
-    # volumeProperty.SetColor(color)
-
-    rgb_points = to_rgb_points(STANDARD)
-    for rgb_point in rgb_points:
-        color.AddRGBPoint(rgb_point[0], rgb_point[1], rgb_point[2], rgb_point[3])
-    volumeProperty.SetColor(color)
-
-    # Bone preset
-    scalarOpacity.AddPoint(80, 0)
-    scalarOpacity.AddPoint(400, 0.2)
-    scalarOpacity.AddPoint(1000, 1)
-    volumeProperty.SetScalarOpacity(scalarOpacity)
+    # STANDARD colors, bone opacity and gradient opacity (presets.json)
+    presetRegistry.applyPreset(volumeProperty, "Bone-Measurement")
 
 def convertFromDisplayCoords2WorldCoords(point: Tuple, focalPoint: Tuple, renderer: vtk.vtkRenderer) -> List:
     # Select z-axis when convert the focal point from homogeneous coordinates to display coordinates
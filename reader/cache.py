@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+from typing import Optional
+
+import numpy as np
+import SimpleITK as sitk
+import vtk
+from vtkmodules.util.numpy_support import vtk_to_numpy
+
+from loader import getSeriesHeaders, loadVolume, wrapArrayAsImageData
+from instrumentation import timed
+
+CACHE_DIR = os.environ.get("VTK_TEST_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "vtk-test", "volumes"))
+CACHE_MAX_BYTES = int(os.environ.get("VTK_TEST_CACHE_MAX_BYTES", 8 * 1024 ** 3)) # 8 GB
+
+"""
+    Description:
+        Compute the cache key of a series directory from the (path, size, mtime) of its files.
+        Only stat() is called, no file is opened.
+    Params:
+        dirpath: a directory contains DICOM files
+    Return: a hex digest
+"""
+def getSeriesKey(dirpath: str) -> str:
+    entries = []
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((os.path.abspath(entry.path), stat.st_size, stat.st_mtime_ns))
+    entries.sort()
+    digest = hashlib.sha1()
+    for path, size, mtime in entries:
+        digest.update(f"{path}\0{size}\0{mtime}\n".encode())
+    return digest.hexdigest()
+
+"""
+    Description: read spacing independent metadata (direction, rescale) from the header of the first slice.
+    Params:
+        fileName: path of a DICOM file
+    Return: a dict with direction, rescaleSlope and rescaleIntercept
+"""
+def readSeriesMetadata(fileName: str) -> dict:
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO("GDCMImageIO")
+    reader.SetFileName(fileName)
+    reader.ReadImageInformation()
+
+    def getValue(tag: str, default: str) -> str:
+        return reader.GetMetaData(tag).strip() if reader.HasMetaDataKey(tag) else default
+
+    return {
+        "direction": list(reader.GetDirection()),
+        "rescaleSlope": float(getValue("0028|1053", "1")),
+        "rescaleIntercept": float(getValue("0028|1052", "0"))
+    }
+
+"""
+    Description:
+        Remove the least recently used entries until the cache fits in maxBytes.
+        The modification time of the sidecar file records the last access.
+    Params:
+        cacheDir: the cache directory
+        maxBytes: the byte budget
+    Return: None
+"""
+def evictCache(cacheDir: str, maxBytes: int) -> None:
+    entries = []
+    totalBytes = 0
+    for name in os.listdir(cacheDir):
+        if not name.endswith(".json"):
+            continue
+        key = name[:-len(".json")]
+        sidecarPath = os.path.join(cacheDir, name)
+        volumePath = os.path.join(cacheDir, f"{key}.npy")
+        size = os.path.getsize(volumePath) if os.path.exists(volumePath) else 0
+        entries.append((os.path.getmtime(sidecarPath), size, sidecarPath, volumePath))
+        totalBytes += size
+
+    entries.sort()
+    for _, size, sidecarPath, volumePath in entries:
+        if totalBytes <= maxBytes:
+            break
+        for path in (sidecarPath, volumePath):
+            if os.path.exists(path):
+                os.remove(path)
+        totalBytes -= size
+
+"""
+    Description: store a volume as <key>.npy and its metadata as <key>.json (written last, marks the entry as complete).
+    Params:
+        imageData: the volume
+        key: the cache key
+        metadata: the sidecar content
+        cacheDir: the cache directory
+    Return: None
+"""
+def storeVolume(imageData: vtk.vtkImageData, key: str, metadata: dict, cacheDir: str) -> None:
+    os.makedirs(cacheDir, exist_ok=True)
+    dimensions = imageData.GetDimensions()
+    array = vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(dimensions[::-1])
+
+    volumePath = os.path.join(cacheDir, f"{key}.npy")
+    sidecarPath = os.path.join(cacheDir, f"{key}.json")
+    np.save(f"{volumePath}.tmp.npy", array)
+    os.replace(f"{volumePath}.tmp.npy", volumePath)
+
+    sidecar = dict(metadata)
+    sidecar["spacing"] = list(imageData.GetSpacing())
+    sidecar["origin"] = list(imageData.GetOrigin())
+    with open(f"{sidecarPath}.tmp", "w") as f:
+        json.dump(sidecar, f)
+    os.replace(f"{sidecarPath}.tmp", sidecarPath)
+
+"""
+    Description:
+        Open a cached volume as a copy-on-write memory map. Pages are read lazily on first access,
+        in-place edits (e.g. applyMask) stay private to the process.
+    Params:
+        key: the cache key
+        cacheDir: the cache directory
+    Return: vtkImageData object or None if the key is not cached
+"""
+def openCachedVolume(key: str, cacheDir: str) -> Optional[vtk.vtkImageData]:
+    volumePath = os.path.join(cacheDir, f"{key}.npy")
+    sidecarPath = os.path.join(cacheDir, f"{key}.json")
+    if not os.path.exists(sidecarPath) or not os.path.exists(volumePath):
+        return
+    with open(sidecarPath) as f:
+        sidecar = json.load(f)
+    os.utime(sidecarPath) # LRU bookkeeping
+
+    array = np.load(volumePath, mmap_mode="c")
+    return wrapArrayAsImageData(array, sidecar["spacing"], sidecar["origin"])
+
+"""
+    Description:
+        Load a DICOM series through the on-disk cache.
+        Warm runs only stat() the series files and map the cached volume, nothing is decoded.
+    Params:
+        dirpath: a directory contains one DICOM series
+        cacheDir: the cache directory, default=CACHE_DIR
+        maxBytes: the byte budget of the cache, default=CACHE_MAX_BYTES
+    Return: vtkImageData object
+"""
+@timed()
+def loadCachedVolume(dirpath: str, cacheDir: str = CACHE_DIR, maxBytes: int = CACHE_MAX_BYTES) -> vtk.vtkImageData:
+    key = getSeriesKey(dirpath)
+    imageData = openCachedVolume(key, cacheDir)
+    if imageData is not None:
+        return imageData
+
+    headers = getSeriesHeaders(dirpath)
+    imageData = loadVolume(dirpath, headers=headers)
+    try:
+        storeVolume(imageData, key, readSeriesMetadata(headers[0]["path"]), cacheDir)
+        evictCache(cacheDir, maxBytes)
+    except OSError as e:
+        print(f"Volume cache is not writable: {e}")
+    return imageData
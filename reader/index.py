@@ -0,0 +1,367 @@
+import os
+import sqlite3
+import struct
+import sys
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+import numpy as np
+
+IMPLICIT_VR_LITTLE_ENDIAN = "1.2.840.10008.1.2"
+EXPLICIT_VR_LITTLE_ENDIAN = "1.2.840.10008.1.2.1"
+EXPLICIT_VR_BIG_ENDIAN = "1.2.840.10008.1.2.2"
+DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN = "1.2.840.10008.1.2.1.99"
+UNDEFINED_LENGTH = 0xFFFFFFFF
+STOP_GROUP = 0x0029 # every indexed tag lives below this group, pixel data (7FE0) is only reached by readHeader(path, pixelData=True)
+PIXEL_DATA = (0x7FE0, 0x0010)
+
+# Explicit VR with a 2 bytes reserved field and a 4 bytes length
+LONG_VRS = {b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC", b"UN", b"UR", b"UT", b"UV"}
+
+TAGS = {
+    (0x0008, 0x0060): "modality",
+    (0x0008, 0x103E): "seriesDescription",
+    (0x0010, 0x0020): "patientID",
+    (0x0020, 0x000D): "studyInstanceUID",
+    (0x0020, 0x000E): "seriesInstanceUID",
+    (0x0020, 0x0013): "instanceNumber",
+    (0x0020, 0x0032): "imagePositionPatient",
+    (0x0020, 0x0037): "imageOrientationPatient",
+    (0x0028, 0x0002): "samplesPerPixel",
+    (0x0028, 0x0010): "rows",
+    (0x0028, 0x0011): "columns",
+    (0x0028, 0x0030): "pixelSpacing",
+    (0x0028, 0x0100): "bitsAllocated",
+    (0x0028, 0x0103): "pixelRepresentation",
+    (0x0028, 0x1052): "rescaleIntercept",
+    (0x0028, 0x1053): "rescaleSlope"
+}
+US_TAGS = {(0x0028, 0x0002), (0x0028, 0x0010), (0x0028, 0x0011), (0x0028, 0x0100), (0x0028, 0x0103)}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime INTEGER,
+    series_uid TEXT,
+    study_uid TEXT,
+    patient_id TEXT,
+    modality TEXT,
+    description TEXT,
+    instance_number INTEGER,
+    position TEXT,
+    orientation TEXT,
+    rows INTEGER,
+    columns INTEGER,
+    pixel_spacing TEXT
+);
+CREATE INDEX IF NOT EXISTS files_series ON files (series_uid);
+CREATE TABLE IF NOT EXISTS series (
+    series_uid TEXT PRIMARY KEY,
+    study_uid TEXT,
+    patient_id TEXT,
+    modality TEXT,
+    description TEXT,
+    directory TEXT,
+    slice_count INTEGER,
+    slice_spacing REAL,
+    uniform INTEGER,
+    has_gaps INTEGER
+);
+"""
+
+def _readElementHeader(f: BinaryIO, explicit: bool) -> Optional[Tuple[int, int, Optional[bytes], int]]:
+    raw = f.read(4)
+    if len(raw) < 4:
+        return
+    group, element = struct.unpack("<HH", raw)
+    if group == 0xFFFE: # item and delimitation tags never have a VR
+        return group, element, None, struct.unpack("<I", f.read(4))[0]
+    if explicit:
+        vr = f.read(2)
+        if vr in LONG_VRS:
+            f.read(2)
+            length = struct.unpack("<I", f.read(4))[0]
+        else:
+            length = struct.unpack("<H", f.read(2))[0]
+        return group, element, vr, length
+    return group, element, None, struct.unpack("<I", f.read(4))[0]
+
+def _skipUndefinedLength(f: BinaryIO, explicit: bool) -> None:
+    # Skip a sequence of undefined length up to its sequence delimitation item
+    while True:
+        header = _readElementHeader(f, explicit)
+        if header is None:
+            return
+        group, element, vr, length = header
+        if group == 0xFFFE:
+            if element == 0xE0DD:
+                return
+            if element == 0xE000 and length != UNDEFINED_LENGTH:
+                f.seek(length, os.SEEK_CUR)
+            continue
+        _skipValue(f, length, explicit)
+
+def _skipValue(f: BinaryIO, length: int, explicit: bool) -> None:
+    if length == UNDEFINED_LENGTH:
+        _skipUndefinedLength(f, explicit)
+    else:
+        f.seek(length, os.SEEK_CUR)
+
+"""
+    Description:
+        Read the tags used for indexing from a DICOM file without touching its pixel data.
+        Parsing stops at the first tag after group 0028.
+        Supports implicit and explicit VR little endian (the transfer syntaxes of PACS exports).
+    Params:
+        path: path of a file
+        pixelData: also locate the pixel data: parsing goes on up to it and the header gets transferSyntax,
+            pixelDataOffset and pixelDataLength (UNDEFINED_LENGTH when encapsulated), default=False
+    Return: a dict (keys are values of TAGS) or None if the file is not a readable DICOM file
+"""
+def readHeader(path: str, pixelData=False) -> Optional[Dict[str, object]]:
+    header: Dict[str, object] = {}
+    with open(path, "rb") as f:
+        f.seek(128)
+        if f.read(4) != b"DICM":
+            f.seek(0) # Files without preamble start directly with the data set
+            transferSyntax = IMPLICIT_VR_LITTLE_ENDIAN
+        else:
+            transferSyntax = None
+            # File meta information, always explicit VR little endian
+            while True:
+                position = f.tell()
+                elementHeader = _readElementHeader(f, True)
+                if elementHeader is None:
+                    return
+                group, element, vr, length = elementHeader
+                if group != 0x0002:
+                    f.seek(position)
+                    break
+                if element == 0x0010:
+                    transferSyntax = f.read(length).decode("ascii", "ignore").strip("\0 ")
+                else:
+                    _skipValue(f, length, True)
+            if transferSyntax in (EXPLICIT_VR_BIG_ENDIAN, DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN):
+                return
+
+        explicit = transferSyntax != IMPLICIT_VR_LITTLE_ENDIAN
+        while True:
+            elementHeader = _readElementHeader(f, explicit)
+            if elementHeader is None:
+                break
+            group, element, vr, length = elementHeader
+            if pixelData and (group, element) == PIXEL_DATA:
+                header["transferSyntax"] = transferSyntax
+                header["pixelDataOffset"] = f.tell()
+                header["pixelDataLength"] = length
+                break
+            if group >= STOP_GROUP and not pixelData:
+                break
+            key = TAGS.get((group, element))
+            if key is None or length == UNDEFINED_LENGTH:
+                _skipValue(f, length, explicit)
+                continue
+            value = f.read(length)
+            if (group, element) in US_TAGS:
+                header[key] = struct.unpack("<H", value[:2])[0]
+            else:
+                header[key] = value.decode("ascii", "ignore").strip("\0 ")
+
+    if "seriesInstanceUID" not in header:
+        return
+    return header
+
+def _parseInt(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return
+
+def _parseNumbers(value: Optional[str]) -> List[float]:
+    if not value:
+        return []
+    return [float(v) for v in value.split("\\") if v.strip()]
+
+"""
+    Description:
+        Sort slices along the slice normal (cross product of the ImageOrientationPatient rows)
+        and check the distance between neighbouring slices.
+    Params:
+        rows: file rows of one series (dicts with path, position, orientation, instance_number)
+        tolerance: relative tolerance of the slice spacing, default=0.01
+    Return: sorted rows, slice spacing (median), uniform flag, gaps flag
+"""
+def sortSlices(rows: List[dict], tolerance=0.01) -> Tuple[List[dict], float, bool, bool]:
+    orientation = _parseNumbers(rows[0]["orientation"])
+    positions = [_parseNumbers(row["position"]) for row in rows]
+    if len(orientation) != 6 or any(len(p) != 3 for p in positions):
+        # No geometry, fall back to the instance number
+        ordered = sorted(rows, key=lambda row: (row["instance_number"] or 0, row["path"]))
+        return ordered, 0.0, False, False
+
+    normal = np.cross(orientation[:3], orientation[3:])
+    distances = np.array(positions) @ normal
+    order = np.argsort(distances, kind="stable")
+    ordered = [rows[i] for i in order]
+    if len(ordered) < 2:
+        return ordered, 0.0, True, False
+
+    steps = np.diff(distances[order])
+    sliceSpacing = float(np.median(steps))
+    if sliceSpacing <= 0:
+        return ordered, sliceSpacing, False, False
+    uniform = bool(np.all(np.abs(steps - sliceSpacing) <= tolerance * sliceSpacing))
+    hasGaps = bool(np.any(steps > 1.5 * sliceSpacing))
+    return ordered, sliceSpacing, uniform, hasGaps
+
+"""
+    Description:
+        Walk an archive directory tree and index the DICOM headers into an SQLite database.
+        Files whose (path, size, mtime) did not change since the last run are not read again.
+    Params:
+        rootDir: the archive directory
+        dbPath: path of the SQLite database
+    Return: number of (re)read files
+"""
+def buildIndex(rootDir: str, dbPath: str) -> int:
+    connection = sqlite3.connect(dbPath)
+    connection.executescript(SCHEMA)
+    known = {path: (size, mtime) for path, size, mtime in connection.execute("SELECT path, size, mtime FROM files")}
+
+    seen = set()
+    readCount = 0
+    for dirpath, _, fileNames in os.walk(rootDir):
+        for fileName in fileNames:
+            path = os.path.abspath(os.path.join(dirpath, fileName))
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Removed during the walk or a broken link: skipped, its old row is deleted below
+                continue
+            seen.add(path)
+            if known.get(path) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            readCount += 1
+            try:
+                header = readHeader(path)
+            except (OSError, struct.error):
+                header = None
+            if header is None:
+                connection.execute("DELETE FROM files WHERE path = ?", (path,))
+                continue
+            connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    path, stat.st_size, stat.st_mtime_ns,
+                    header["seriesInstanceUID"], header.get("studyInstanceUID"), header.get("patientID"),
+                    header.get("modality"), header.get("seriesDescription"),
+                    _parseInt(header.get("instanceNumber")),
+                    header.get("imagePositionPatient"), header.get("imageOrientationPatient"),
+                    header.get("rows"), header.get("columns"), header.get("pixelSpacing")
+                )
+            )
+
+    for path in set(known) - seen:
+        if path.startswith(os.path.abspath(rootDir) + os.sep):
+            connection.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    _updateSeries(connection)
+    connection.commit()
+    connection.close()
+    return readCount
+
+def _updateSeries(connection: sqlite3.Connection) -> None:
+    connection.execute("DELETE FROM series")
+    connection.row_factory = sqlite3.Row
+    seriesUIDs = [row[0] for row in connection.execute("SELECT DISTINCT series_uid FROM files")]
+    for seriesUID in seriesUIDs:
+        rows = [dict(row) for row in connection.execute("SELECT * FROM files WHERE series_uid = ?", (seriesUID,))]
+        ordered, sliceSpacing, uniform, hasGaps = sortSlices(rows)
+        first = ordered[0]
+        connection.execute(
+            "INSERT INTO series VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                seriesUID, first["study_uid"], first["patient_id"], first["modality"], first["description"],
+                os.path.dirname(first["path"]), len(ordered), sliceSpacing, int(uniform), int(hasGaps)
+            )
+        )
+    connection.row_factory = None
+
+"""
+    Description: list the indexed series.
+    Params:
+        dbPath: path of the SQLite database
+    Return: a list of dicts (one per series)
+"""
+def listSeries(dbPath: str) -> List[dict]:
+    connection = sqlite3.connect(dbPath)
+    connection.row_factory = sqlite3.Row
+    series = [dict(row) for row in connection.execute("SELECT * FROM series ORDER BY patient_id, study_uid, series_uid")]
+    connection.close()
+    return series
+
+"""
+    Description:
+        Return the file names of an indexed series sorted along the slice normal (ascending),
+        ready for loader.loadVolume(..., fileNames=fileNames[::-1]).
+    Params:
+        dbPath: path of the SQLite database
+        seriesUID: SeriesInstanceUID
+    Return: a list of file names
+"""
+def getSeriesFileNames(dbPath: str, seriesUID: str) -> List[str]:
+    connection = sqlite3.connect(dbPath)
+    connection.row_factory = sqlite3.Row
+    rows = [dict(row) for row in connection.execute("SELECT * FROM files WHERE series_uid = ?", (seriesUID,))]
+    connection.close()
+    if not rows:
+        return []
+    ordered, _, _, _ = sortSlices(rows)
+    return [row["path"] for row in ordered]
+
+"""
+    Description:
+        Sort the DICOM files of a single directory without a database, using the header-only reader.
+        Files of the first SeriesInstanceUID (in file name order) are kept.
+    Params:
+        dirpath: a directory contains DICOM files
+        pixelData: locate the pixel data of every file too (see readHeader), default=False
+    Return: a list of headers (readHeader dicts with the file name in "path") sorted along the slice normal (ascending)
+"""
+def scanSeriesHeaders(dirpath: str, pixelData=False) -> List[dict]:
+    rows = []
+    for fileName in sorted(os.listdir(dirpath)):
+        path = os.path.join(dirpath, fileName)
+        if not os.path.isfile(path):
+            continue
+        try:
+            header = readHeader(path, pixelData)
+        except (OSError, struct.error):
+            header = None
+        if header is None:
+            continue
+        rows.append({
+            "path": path,
+            "series_uid": header["seriesInstanceUID"],
+            "instance_number": _parseInt(header.get("instanceNumber")),
+            "position": header.get("imagePositionPatient"),
+            "orientation": header.get("imageOrientationPatient"),
+            "header": header
+        })
+    if not rows:
+        return []
+    rows = [row for row in rows if row["series_uid"] == rows[0]["series_uid"]]
+    ordered, _, _, _ = sortSlices(rows)
+    return [dict(row["header"], path=row["path"]) for row in ordered]
+
+def scanSeriesFileNames(dirpath: str) -> List[str]:
+    return [header["path"] for header in scanSeriesHeaders(dirpath)]
+
+if __name__ == "__main__":
+    rootDir = sys.argv[1] if len(sys.argv) > 1 else "./data"
+    dbPath = sys.argv[2] if len(sys.argv) > 2 else "./dicom_index.sqlite"
+    readCount = buildIndex(rootDir, dbPath)
+    print(f"Read headers: {readCount}")
+    for series in listSeries(dbPath):
+        flags = ("uniform" if series["uniform"] else "non-uniform") + (", gaps" if series["has_gaps"] else "")
+        print(f"{series['patient_id']} {series['modality']} {series['description']} {series['slice_count']} slices {series['slice_spacing']:.3f}mm ({flags}) {series['series_uid']}")
@@ -0,0 +1,201 @@
+import atexit
+import functools
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+import vtk
+
+"""
+    Instrumentation of the hot paths.
+    Disabled by default, the decorated functions then only pay one attribute check. Enabled when the
+    environment variable VTK_TEST_TRACE is set to the path of the trace to write at exit, or by tracer.enable().
+    - @timed / span(): timers around Python functions or blocks
+    - instrumentAlgorithm(): VTK algorithm executions from their StartEvent/EndEvent/ProgressEvent
+    - instrumentRenderWindow(): every Render(), the first one is also reported as "time to first frame"
+    Every span becomes a Chrome trace event (chrome://tracing, https://ui.perfetto.dev) and goes into a
+    per-stage histogram (power of 2 buckets of microseconds) printed by printSummary().
+"""
+
+TRACE_PATH = os.environ.get("VTK_TEST_TRACE")
+MAX_EVENTS = 1_000_000 # events beyond it are only counted in the histograms
+
+class StageStatistics:
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = 0.0
+        self.buckets: Dict[int, int] = {} # floor(log2(microseconds)) -> count
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.minimum = min(self.minimum, seconds)
+        self.maximum = max(self.maximum, seconds)
+        bucket = int(math.log2(max(seconds * 1e6, 1)))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction: float) -> float:
+        # Upper bound of the bucket holding the percentile (seconds)
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2 ** (bucket + 1) / 1e6, self.maximum)
+        return self.maximum
+
+class Tracer:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.path: Optional[str] = None
+        self.origin = time.perf_counter()
+        self.events: List[dict] = []
+        self.statistics: Dict[str, StageStatistics] = {}
+        self.firstFrame: Optional[float] = None
+        self.lock = threading.Lock()
+
+    def enable(self, path: Optional[str] = None) -> None:
+        # path: Chrome trace written at exit, default=None (only the summary is printed)
+        if not self.enabled and path is not None:
+            atexit.register(self.close)
+        self.enabled = True
+        self.path = path
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def now(self) -> float:
+        return time.perf_counter()
+
+    def record(self, name: str, category: str, start: float, end: float, args: Optional[dict] = None) -> None:
+        with self.lock:
+            statistics = self.statistics.get(name)
+            if statistics is None:
+                statistics = self.statistics[name] = StageStatistics()
+            statistics.add(end - start)
+            if len(self.events) < MAX_EVENTS:
+                event = {"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": threading.get_native_id(),
+                         "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6}
+                if args:
+                    event["args"] = args
+                self.events.append(event)
+
+    def counter(self, name: str, values: Dict[str, float]) -> None:
+        with self.lock:
+            if len(self.events) < MAX_EVENTS:
+                self.events.append({"name": name, "ph": "C", "pid": os.getpid(), "tid": threading.get_native_id(),
+                                    "ts": (self.now() - self.origin) * 1e6, "args": values})
+
+    def instant(self, name: str, args: Optional[dict] = None) -> None:
+        with self.lock:
+            if len(self.events) < MAX_EVENTS:
+                self.events.append({"name": name, "ph": "i", "s": "p", "pid": os.getpid(), "tid": threading.get_native_id(),
+                                    "ts": (self.now() - self.origin) * 1e6, "args": args or {}})
+
+    def exportChromeTrace(self, path: str) -> None:
+        with self.lock:
+            events = list(self.events)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def printSummary(self) -> None:
+        if self.firstFrame is not None:
+            print(f"Time to first frame: {self.firstFrame * 1e3:.1f}ms")
+        print(f"{'stage':<48} {'count':>7} {'total ms':>10} {'mean ms':>9} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+        for name, statistics in sorted(self.statistics.items(), key=lambda item: -item[1].total):
+            print(f"{name:<48} {statistics.count:>7} {statistics.total * 1e3:>10.1f} {statistics.total / statistics.count * 1e3:>9.2f} "
+                  f"{statistics.percentile(0.5) * 1e3:>8.2f} {statistics.percentile(0.95) * 1e3:>8.2f} {statistics.maximum * 1e3:>8.2f}")
+
+    def close(self) -> None:
+        if self.path is not None:
+            self.exportChromeTrace(self.path)
+            print(f"Trace written: {self.path}")
+        self.printSummary()
+
+tracer = Tracer()
+if TRACE_PATH:
+    tracer.enable(TRACE_PATH)
+
+"""
+    Description: decorator timing every call of a function when the tracer is enabled.
+    Params:
+        name: stage name, default=None (module.function)
+        category: trace category
+    Return: the decorator
+"""
+def timed(name: Optional[str] = None, category="python") -> Callable:
+    def decorator(function: Callable) -> Callable:
+        stage = name or f"{function.__module__}.{function.__qualname__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            start = tracer.now()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                tracer.record(stage, category, start, tracer.now())
+        return wrapper
+    return decorator
+
+@contextmanager
+def span(name: str, category="python", **args):
+    # with span("stage"): ... times a block
+    if not tracer.enabled:
+        yield
+        return
+    start = tracer.now()
+    try:
+        yield
+    finally:
+        tracer.record(name, category, start, tracer.now(), args)
+
+"""
+    Description:
+        Time every execution of a VTK algorithm (mapper, reader, filter) from its StartEvent and EndEvent,
+        its ProgressEvent becomes a counter track of the trace. Observers are only added when the tracer is enabled.
+    Params:
+        algorithm: a vtkAlgorithm (or any vtkObject invoking StartEvent/EndEvent)
+        name: stage name, default=None (class name)
+    Return: None
+"""
+def instrumentAlgorithm(algorithm: vtk.vtkObject, name: Optional[str] = None) -> None:
+    if not tracer.enabled:
+        return
+    stage = name or algorithm.GetClassName()
+    starts: List[float] = []
+
+    def startEventHandle(obj, event) -> None:
+        starts.append(tracer.now())
+
+    def endEventHandle(obj, event) -> None:
+        if starts:
+            tracer.record(stage, "vtk", starts.pop(), tracer.now())
+
+    def progressEventHandle(obj, event) -> None:
+        tracer.counter(f"{stage} progress", {"progress": obj.GetProgress()})
+
+    algorithm.AddObserver(vtk.vtkCommand.StartEvent, startEventHandle)
+    algorithm.AddObserver(vtk.vtkCommand.EndEvent, endEventHandle)
+    if isinstance(algorithm, vtk.vtkAlgorithm):
+        algorithm.AddObserver(vtk.vtkCommand.ProgressEvent, progressEventHandle)
+
+def instrumentRenderWindow(renderWindow: vtk.vtkRenderWindow, name="Render") -> None:
+    # Every Render(), the end of the first one gives the time to first frame (since the tracer was created)
+    if not tracer.enabled:
+        return
+    instrumentAlgorithm(renderWindow, name)
+
+    def firstFrameHandle(obj, event) -> None:
+        if tracer.firstFrame is None:
+            tracer.firstFrame = tracer.now() - tracer.origin
+            tracer.instant("first frame")
+
+    renderWindow.AddObserver(vtk.vtkCommand.EndEvent, firstFrameHandle)
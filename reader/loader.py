@@ -0,0 +1,181 @@
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+import SimpleITK as sitk
+import vtk
+from vtkmodules.util.numpy_support import numpy_to_vtk
+
+from instrumentation import timed
+from index import EXPLICIT_VR_LITTLE_ENDIAN, IMPLICIT_VR_LITTLE_ENDIAN, readHeader, scanSeriesHeaders
+
+INT16_RANGE = (-32768, 32767)
+
+"""
+    Description:
+        Return the file names of the first DICOM series in a directory, sorted along the slice normal by the
+        header-only reader of index.py (faster than the GDCM scan, same order).
+        GDCM sorts the directories the header-only reader cannot parse (big endian, deflated).
+        The list is reversed to follow the slice order of vtkDICOMImageReader.
+    Params:
+        dirpath: a directory contains DICOM files
+    Return: a list of file names
+"""
+def getSeriesFileNames(dirpath: str) -> List[str]:
+    return [header["path"] for header in getSeriesHeaders(dirpath)]
+
+"""
+    Description: getSeriesFileNames() keeping the headers, with the pixel data located (readRawSlice() reuses them).
+    Params:
+        dirpath: a directory contains DICOM files
+    Return: a list of headers (file name in "path"), in the slice order of vtkDICOMImageReader
+"""
+def getSeriesHeaders(dirpath: str) -> List[dict]:
+    headers = scanSeriesHeaders(dirpath, pixelData=True)
+    if not headers:
+        headers = [{"path": fileName} for fileName in sitk.ImageSeriesReader.GetGDCMSeriesFileNames(dirpath)]
+    return headers[::-1]
+
+"""
+    Description:
+        Read the pixels of an uncompressed slice straight from the file (one header parse and one read,
+        no GDCM reader), as vtkDICOMImageReader does.
+        Only the slices GDCM would give the same int16 values for are handled: little endian, one 16 bits
+        sample, integer rescale staying in the int16 range.
+    Params:
+        fileName: path of a DICOM file
+        header: readHeader(fileName, pixelData=True) if already read, default=None
+    Return: a 2D array (rows, columns) or None when the slice needs GDCM
+"""
+def readRawSlice(fileName: str, header: Optional[dict] = None) -> Optional[np.ndarray]:
+    if header is None or "pixelDataOffset" not in header:
+        header = readHeader(fileName, pixelData=True)
+    if header is None or header.get("transferSyntax") not in (None, IMPLICIT_VR_LITTLE_ENDIAN, EXPLICIT_VR_LITTLE_ENDIAN):
+        return
+    rows, columns = header.get("rows"), header.get("columns")
+    if not rows or not columns or header.get("bitsAllocated") != 16 or header.get("samplesPerPixel", 1) != 1:
+        return
+    if header.get("pixelDataLength") != rows * columns * 2:
+        return # encapsulated or odd sized pixel data
+    try:
+        slope = float(header.get("rescaleSlope") or 1)
+        intercept = float(header.get("rescaleIntercept") or 0)
+    except ValueError:
+        return
+    if slope != 1 or not intercept.is_integer():
+        return
+    dtype = "<i2" if header.get("pixelRepresentation") == 1 else "<u2"
+    array = np.fromfile(fileName, dtype=dtype, count=rows * columns, offset=header["pixelDataOffset"]).reshape(rows, columns)
+    intercept = int(intercept)
+    if array.size and (int(array.min()) + intercept < INT16_RANGE[0] or int(array.max()) + intercept > INT16_RANGE[1]):
+        return
+    # In place and modulo 2^16: the result is exact since it fits in int16
+    array = array.view(np.int16)
+    array += np.array(intercept).astype(np.int16)
+    return array
+
+"""
+    Description: decode one DICOM slice (rescale slope/intercept applied) to a 2D array.
+    Params:
+        fileName: path of a DICOM file
+        header: header of the file from getSeriesHeaders(), default=None
+    Return: a 2D array (rows, columns), the first row is the top of the image
+"""
+def readSlice(fileName: str, header: Optional[dict] = None) -> np.ndarray:
+    try:
+        array = readRawSlice(fileName, header)
+    except (OSError, ValueError, struct.error):
+        array = None
+    if array is not None:
+        return array
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO("GDCMImageIO") # Skip the image IO detection
+    reader.SetFileName(fileName)
+    reader.SetOutputPixelType(sitk.sitkInt16)
+    image = reader.Execute()
+    return sitk.GetArrayFromImage(image)[0]
+
+"""
+    Description: read the geometry of a series from the headers of its first and last slice.
+    Params:
+        fileNames: sorted file names of a series
+    Return: dimensions (columns, rows, slices) and spacing
+"""
+def readSeriesGeometry(fileNames: List[str]) -> Tuple[Tuple[int, int, int], Tuple[float, float, float]]:
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO("GDCMImageIO")
+    reader.SetFileName(fileNames[0])
+    reader.ReadImageInformation()
+    size = reader.GetSize()
+    spacing = list(reader.GetSpacing())
+    firstPosition = np.array(reader.GetOrigin())
+
+    sliceSpacing = 1.0
+    if len(fileNames) > 1:
+        reader.SetFileName(fileNames[-1])
+        reader.ReadImageInformation()
+        lastPosition = np.array(reader.GetOrigin())
+        sliceSpacing = float(np.linalg.norm(lastPosition - firstPosition)) / (len(fileNames) - 1)
+    if sliceSpacing == 0:
+        sliceSpacing = 1.0
+
+    dimensions = (size[0], size[1], len(fileNames))
+    return dimensions, (spacing[0], spacing[1], sliceSpacing)
+
+"""
+    Description:
+        Wrap a (slices, rows, columns) array as vtkImageData without copying it.
+        The vtk array keeps a reference to the numpy buffer, so the buffer lives as long as the image.
+    Params:
+        array: a C-contiguous 3D array
+        spacing: spacing of the volume
+        origin: origin of the volume
+    Return: vtkImageData object
+"""
+def wrapArrayAsImageData(array: np.ndarray, spacing: Tuple[float, float, float], origin=(0.0, 0.0, 0.0)) -> vtk.vtkImageData:
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(array.shape[2], array.shape[1], array.shape[0])
+    imageData.SetSpacing(spacing)
+    imageData.SetOrigin(origin)
+    scalars = numpy_to_vtk(array.reshape(-1), deep=False)
+    imageData.GetPointData().SetScalars(scalars)
+    return imageData
+
+"""
+    Description:
+        Load a DICOM series by decoding its slices concurrently into one preallocated buffer.
+        The output matches vtkDICOMImageReader (slice order, rows flipped to lower left, short scalars).
+        The headers are read once (getSeriesHeaders) and the uncompressed slices are read without GDCM
+        (readRawSlice), as fast as vtkDICOMImageReader on one CPU; GDCM only decodes the other slices.
+    Params:
+        dirpath: a directory contains one DICOM series
+        numberOfWorkers: size of the pool, default=None (number of CPUs)
+        useProcesses: use a process pool instead of a thread pool, default=False
+        fileNames: sorted file names of the series if already known, default=None
+        headers: headers of the series from getSeriesHeaders() if already known (fileNames is ignored), default=None
+    Return: vtkImageData object
+"""
+@timed()
+def loadVolume(dirpath: str, numberOfWorkers: Optional[int] = None, useProcesses=False, fileNames: Optional[List[str]] = None, headers: Optional[List[dict]] = None) -> vtk.vtkImageData:
+    if headers is None and fileNames is None:
+        headers = getSeriesHeaders(dirpath)
+    if headers is not None:
+        fileNames = [header["path"] for header in headers]
+    else:
+        headers = [None] * len(fileNames)
+    if not fileNames:
+        raise ValueError(f"No DICOM series found in {dirpath}")
+    dimensions, spacing = readSeriesGeometry(fileNames)
+
+    buffer = np.empty((dimensions[2], dimensions[1], dimensions[0]), dtype=np.int16)
+
+    if numberOfWorkers is None:
+        numberOfWorkers = os.cpu_count() or 1
+    executor = ProcessPoolExecutor if useProcesses else ThreadPoolExecutor
+    with executor(max_workers=numberOfWorkers) as pool:
+        for index, array in enumerate(pool.map(readSlice, fileNames, headers)):
+            buffer[index] = array[::-1] # DICOM rows start at the top, vtk rows start at the bottom
+
+    return wrapArrayAsImageData(buffer, spacing)
@@ -0,0 +1,172 @@
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import vtk
+
+PRESETS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "presets.json")
+LOOKUP_TABLE_SIZE = 4096 # default entries of the RGBA tables, one per HU on the usual CT range
+
+def to_rgb_points(colormap: List[dict]) -> List[list]:
+    rgb_points = []
+    for item in colormap:
+        crange = item["range"]
+        color = item["color"]
+        for idx, r in enumerate(crange):
+            if len(color) == len(crange):
+                rgb_points.append([r] + color[idx])
+            else:
+                rgb_points.append([r] + color[0])
+    return rgb_points
+
+"""
+    Description:
+        One transfer-function preset: its vtkColorTransferFunction / vtkPiecewiseFunction objects are built
+        once and shared by every volume property using the preset (read-only, as the volumes of the store).
+        A function the preset does not define is None (applyPreset() leaves it as it is).
+    Params:
+        name: name of the preset
+        color, scalarOpacity, gradientOpacity: the transfer functions
+"""
+class TransferFunctionPreset:
+    def __init__(self, name: str, color: Optional[vtk.vtkColorTransferFunction], scalarOpacity: Optional[vtk.vtkPiecewiseFunction], gradientOpacity: Optional[vtk.vtkPiecewiseFunction]) -> None:
+        self.name = name
+        self.color = color
+        self.scalarOpacity = scalarOpacity
+        self.gradientOpacity = gradientOpacity
+        self.lookupTables: Dict[Tuple, np.ndarray] = {}
+
+    def getKey(self) -> Tuple:
+        # The shared functions are not supposed to change, a modified one still invalidates the tables
+        return tuple(function.GetMTime() if function is not None else 0 for function in (self.color, self.scalarOpacity))
+
+    """
+        Description:
+            The preset sampled on a fixed number of scalars, computed once per range and size and shared by every
+            caller (the opacity tables of EmptySpaceSkipping, see skipping.getOpacityTable()).
+        Params:
+            scalarRange: (minimum, maximum) scalar of the table, e.g. imageData.GetScalarRange()
+            size: number of entries, default=LOOKUP_TABLE_SIZE
+        Return: read-only (size, 4) float64 array of RGBA in [0, 1], entry i is the scalar minimum + i * (maximum - minimum) / (size - 1)
+    """
+    def getLookupTable(self, scalarRange: Tuple[float, float], size=LOOKUP_TABLE_SIZE) -> np.ndarray:
+        key = (float(scalarRange[0]), float(scalarRange[1]), size, self.getKey())
+        table = self.lookupTables.get(key)
+        if table is not None:
+            return table
+        table = np.ones((size, 4), dtype=np.float64)
+        minimum, maximum = key[0], max(key[1], key[0] + 1e-6) # GetTable() needs a non-empty range
+        if self.color is not None:
+            rgb = np.empty(3 * size, dtype=np.float64)
+            self.color.GetTable(minimum, maximum, size, rgb)
+            table[:, :3] = rgb.reshape(-1, 3)
+        if self.scalarOpacity is not None:
+            alpha = np.empty(size, dtype=np.float64)
+            self.scalarOpacity.GetTable(minimum, maximum, size, alpha)
+            table[:, 3] = alpha
+        table.flags.writeable = False # shared by every caller
+        self.lookupTables = {k: v for k, v in self.lookupTables.items() if k[3] == key[3]} # drop the outdated tables
+        self.lookupTables[key] = table
+        return table
+
+def buildColor(points: List[list]) -> vtk.vtkColorTransferFunction:
+    color = vtk.vtkColorTransferFunction()
+    for point in points:
+        color.AddRGBPoint(point[0], point[1], point[2], point[3])
+    return color
+
+def buildPiecewise(points: List[list]) -> vtk.vtkPiecewiseFunction:
+    function = vtk.vtkPiecewiseFunction()
+    for point in points:
+        function.AddPoint(point[0], point[1])
+    return function
+
+"""
+    Description:
+        Registry of the transfer-function presets (CT-AAA, Bone, Angio, Muscle, MIP, STANDARD, ...) read from
+        presets.json on the first use. A preset gives its colors as RGB points ("color": [[x, r, g, b], ...]),
+        as a tissue colormap ("colormap", see to_rgb_points) or as the name of another preset whose color
+        function it shares ("color": "STANDARD"), and optionally "scalarOpacity" / "gradientOpacity" points.
+        Switching the preset of a volume only swaps the function objects of its property: nothing is rebuilt.
+    Params:
+        path: the JSON file of the presets, default=PRESETS_PATH
+"""
+class PresetRegistry:
+    def __init__(self, path=PRESETS_PATH) -> None:
+        self.path = path
+        self.presets: Optional[Dict[str, TransferFunctionPreset]] = None
+        self.lock = threading.RLock()
+
+    def load(self) -> Dict[str, TransferFunctionPreset]:
+        with self.lock:
+            if self.presets is not None:
+                return self.presets
+            with open(self.path) as f:
+                definitions = json.load(f)
+            presets = {}
+            # Presets defining their colors first, the references are resolved afterwards
+            for name, definition in definitions.items():
+                if "colormap" in definition:
+                    color = buildColor(to_rgb_points(definition["colormap"]))
+                elif isinstance(definition.get("color"), list):
+                    color = buildColor(definition["color"])
+                else:
+                    color = None
+                scalarOpacity = buildPiecewise(definition["scalarOpacity"]) if "scalarOpacity" in definition else None
+                gradientOpacity = buildPiecewise(definition["gradientOpacity"]) if "gradientOpacity" in definition else None
+                presets[name] = TransferFunctionPreset(name, color, scalarOpacity, gradientOpacity)
+            for name, definition in definitions.items():
+                if isinstance(definition.get("color"), str):
+                    reference = presets.get(definition["color"])
+                    if reference is None:
+                        print(f"Unknown color preset {definition['color']} in {name}")
+                        continue
+                    presets[name].color = reference.color
+            self.presets = presets
+            return presets
+
+    def getNames(self) -> List[str]:
+        return list(self.load().keys())
+
+    def get(self, name: str) -> Optional[TransferFunctionPreset]:
+        preset = self.load().get(name)
+        if preset is None:
+            print(f"Unknown transfer function preset: {name}")
+        return preset
+
+    def getLookupTable(self, name: str, scalarRange: Tuple[float, float], size=LOOKUP_TABLE_SIZE) -> Optional[np.ndarray]:
+        preset = self.get(name)
+        return preset.getLookupTable(scalarRange, size) if preset is not None else None
+
+    def findScalarOpacity(self, scalarOpacity: vtk.vtkPiecewiseFunction) -> Optional[TransferFunctionPreset]:
+        # The preset sharing this function object with a volume property (applyPreset), None for a custom function
+        for preset in self.load().values():
+            if preset.scalarOpacity is scalarOpacity:
+                return preset
+
+    """
+        Description: use the shared functions of a preset in a volume property (colors, scalar opacity, gradient opacity).
+        Params:
+            volumeProperty: the property of the volume
+            name: name of the preset
+        Return: True if the preset exists
+    """
+    def applyPreset(self, volumeProperty: vtk.vtkVolumeProperty, name: str) -> bool:
+        preset = self.get(name)
+        if preset is None:
+            return False
+        if preset.color is not None:
+            volumeProperty.SetColor(preset.color)
+        if preset.scalarOpacity is not None:
+            volumeProperty.SetScalarOpacity(preset.scalarOpacity)
+            # Without its own gradient opacity the preset turns off the one of the previous preset
+            if preset.gradientOpacity is not None:
+                volumeProperty.SetGradientOpacity(preset.gradientOpacity)
+                volumeProperty.DisableGradientOpacityOff()
+            else:
+                volumeProperty.DisableGradientOpacityOn()
+        return True
+
+presetRegistry = PresetRegistry()
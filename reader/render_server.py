@@ -0,0 +1,560 @@
+import argparse
+import itertools
+import json
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import vtk
+from vtkmodules.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+
+from cache import loadCachedVolume
+from read_dicom import setVolumeProperties
+from instrumentation import span, instrumentAlgorithm
+
+"""
+    Headless volume rendering for thin clients.
+    Every session has its own offscreen render window (no X display, no interactor loop) and
+    vtkFixedPointVolumeRayCastMapper (CPU) over one shared vtkImageData and vtkVolumeProperty.
+    VTK objects are only touched by the render thread; the HTTP handler threads queue camera commands
+    and encode the frames it publishes.
+    - Commands are coalesced: a render applies every command received since the previous one.
+    - Frame budget: at most maxFps renders per session, interactive renders get frameTime seconds
+      (the mapper adjusts its sample distance), a full quality still frame follows STILL_DELAY seconds
+      after the last command.
+    - Frame skipping: a session keeps only its last HISTORY frames, a client always receives the newest
+      one, the frames it never fetched are counted as skipped instead of being queued.
+
+    HTTP API (JSON bodies):
+        POST   /sessions                     {"width", "height", "maxFps", "frameTime"} -> {"id", ...}
+        POST   /sessions/<id>/commands       {"commands": [{"type": "rotate", "azimuth", "elevation"},
+                                              {"type": "pan", "dx", "dy"}, {"type": "zoom", "factor"},
+                                              {"type": "set", "position", "focalPoint", "viewUp", "viewAngle"},
+                                              {"type": "reset"}]}
+        GET    /sessions/<id>/frame?format=jpeg|png|delta&quality=&since=&timeout=
+               Waits (long poll) for a frame newer than since. Delta: zlib of the RGB rows (top first)
+               XOR the frame X-Base-Frame-Id, or of the plain rows when the base frame is no longer kept
+               (X-Base-Frame-Id: 0).
+        DELETE /sessions/<id>
+        GET    /stats
+"""
+
+HOST = "127.0.0.1"
+PORT = 8765
+HISTORY = 4 # frames kept per session for delta encoding
+STILL_DELAY = 0.3 # seconds without command before the full quality render
+SESSION_TIMEOUT = 120 # seconds without request before a session is closed
+MAX_SIZE = 4096
+
+class Frame:
+    def __init__(self, frameId: int, pixels: np.ndarray, still: bool, seconds: float) -> None:
+        self.frameId = frameId
+        self.pixels = pixels # (height, width, 3) uint8, bottom row first as in VTK
+        self.still = still
+        self.seconds = seconds
+
+class RenderSession:
+    def __init__(self, sessionId: str, imageData: vtk.vtkImageData, volumeProperty: vtk.vtkVolumeProperty, width=512, height=512, maxFps=15.0, frameTime=0.05) -> None:
+        self.sessionId = sessionId
+        self.width = width
+        self.height = height
+        self.minInterval = 1.0 / maxFps
+        self.frameTime = frameTime
+        # Written by the handler threads, guarded by RenderServer.condition
+        self.commands: List[dict] = []
+        self.lastCommand = 0.0
+        self.lastAccess = time.monotonic()
+        self.lastFetched = 0
+        self.skippedFrames = 0
+        self.frames: "OrderedDict[int, Frame]" = OrderedDict()
+        # Render thread only
+        self.lastRender = 0.0
+        self.stillDone = False
+        self.frameIds = itertools.count(1)
+
+        self.mapper = vtk.vtkFixedPointVolumeRayCastMapper()
+        self.mapper.SetInputData(imageData)
+        self.mapper.AutoAdjustSampleDistancesOn()
+        instrumentAlgorithm(self.mapper, "render_server.mapper")
+
+        self.volume = vtk.vtkVolume()
+        self.volume.SetMapper(self.mapper)
+        self.volume.SetProperty(volumeProperty)
+
+        self.renderer = vtk.vtkRenderer()
+        self.renderer.SetBackground(1, 1, 1)
+        self.renderer.AddVolume(self.volume)
+        self.renderer.ResetCamera()
+        self.camera = self.renderer.GetActiveCamera()
+
+        self.renderWindow = vtk.vtkRenderWindow()
+        self.renderWindow.SetOffScreenRendering(1)
+        self.renderWindow.SetSize(width, height)
+        self.renderWindow.AddRenderer(self.renderer)
+
+        self.windowToImage = vtk.vtkWindowToImageFilter()
+        self.windowToImage.SetInput(self.renderWindow)
+        self.windowToImage.SetInputBufferTypeToRGB()
+        self.windowToImage.ReadFrontBufferOff()
+
+    def getLatestFrame(self) -> Optional[Frame]:
+        return next(reversed(self.frames.values()), None)
+
+    def isDue(self, now: float) -> bool:
+        # A render is due when there are commands (and the frame budget allows it) or a still frame is missing
+        if now - self.lastRender < self.minInterval:
+            return False
+        if self.commands:
+            return True
+        return not self.stillDone and now - self.lastCommand >= STILL_DELAY
+
+    def getWakeUpTime(self) -> Optional[float]:
+        if self.commands:
+            return self.lastRender + self.minInterval
+        if not self.stillDone:
+            return max(self.lastRender + self.minInterval, self.lastCommand + STILL_DELAY)
+        return None
+
+    def applyCommand(self, command: dict) -> None:
+        camera = self.camera
+        commandType = command.get("type")
+        if commandType == "rotate":
+            camera.Azimuth(float(command.get("azimuth", 0)))
+            camera.Elevation(float(command.get("elevation", 0)))
+            camera.OrthogonalizeViewUp()
+        elif commandType == "pan":
+            # Same motion as vtkInteractorStyleTrackballCamera::Pan, dx/dy in pixels, y up
+            focalPoint = camera.GetFocalPoint()
+            self.renderer.SetWorldPoint(*focalPoint, 1)
+            self.renderer.WorldToDisplay()
+            displayFocal = self.renderer.GetDisplayPoint()
+            self.renderer.SetDisplayPoint(displayFocal[0] - float(command.get("dx", 0)), displayFocal[1] - float(command.get("dy", 0)), displayFocal[2])
+            self.renderer.DisplayToWorld()
+            worldPoint = self.renderer.GetWorldPoint()
+            motion = [worldPoint[i] / worldPoint[3] - focalPoint[i] for i in range(3)] if worldPoint[3] else [0, 0, 0]
+            position = camera.GetPosition()
+            camera.SetFocalPoint(*[focalPoint[i] + motion[i] for i in range(3)])
+            camera.SetPosition(*[position[i] + motion[i] for i in range(3)])
+        elif commandType == "zoom":
+            factor = float(command.get("factor", 1))
+            if factor > 0:
+                camera.Dolly(factor)
+        elif commandType == "set":
+            if "position" in command:
+                camera.SetPosition(*command["position"])
+            if "focalPoint" in command:
+                camera.SetFocalPoint(*command["focalPoint"])
+            if "viewUp" in command:
+                camera.SetViewUp(*command["viewUp"])
+            if "viewAngle" in command:
+                camera.SetViewAngle(float(command["viewAngle"]))
+            camera.OrthogonalizeViewUp()
+        elif commandType == "reset":
+            self.renderer.ResetCamera()
+        else:
+            print(f"Unknown command: {commandType}")
+
+    def render(self, commands: List[dict], still: bool) -> Frame:
+        for command in commands:
+            self.applyCommand(command)
+        self.renderer.ResetCameraClippingRange()
+        # DesiredUpdateRate is the inverse of the time given to a render, the mapper picks its sample distance from it
+        self.renderWindow.SetDesiredUpdateRate(0.0001 if still else 1.0 / self.frameTime)
+        start = time.perf_counter()
+        with span("render_server.render", "vtk", session=self.sessionId, still=still):
+            self.renderWindow.Render()
+            self.windowToImage.Modified()
+            self.windowToImage.Update()
+        output = self.windowToImage.GetOutput()
+        width, height, _ = output.GetDimensions()
+        pixels = vtk_to_numpy(output.GetPointData().GetScalars()).reshape(height, width, -1)[:, :, :3].copy()
+        return Frame(next(self.frameIds), pixels, still, time.perf_counter() - start)
+
+    def close(self) -> None:
+        self.renderWindow.Finalize()
+
+"""
+    Description: encode a frame as JPEG or PNG with the VTK writers (in memory).
+    Params:
+        frame: the frame to encode
+        imageFormat: "jpeg" or "png"
+        quality: JPEG quality (0-100)
+    Return: the encoded bytes
+"""
+def encodeImage(frame: Frame, imageFormat: str, quality=85) -> bytes:
+    height, width, components = frame.pixels.shape
+    image = vtk.vtkImageData()
+    image.SetDimensions(width, height, 1)
+    scalars = numpy_to_vtk(frame.pixels.reshape(-1, components), deep=True, array_type=vtk.VTK_UNSIGNED_CHAR)
+    image.GetPointData().SetScalars(scalars)
+
+    if imageFormat == "png":
+        writer = vtk.vtkPNGWriter()
+    else:
+        writer = vtk.vtkJPEGWriter()
+        writer.SetQuality(max(0, min(100, quality)))
+        writer.ProgressiveOff()
+    writer.SetInputData(image)
+    writer.WriteToMemoryOn()
+    writer.Write()
+    return bytes(vtk_to_numpy(writer.GetResult()))
+
+"""
+    Description: delta encoding of a frame against a frame the client already has.
+    Params:
+        frame: the frame to encode
+        base: the client frame, None for a key frame
+    Return: zlib compressed RGB rows (top first), XOR base when base is given
+"""
+def encodeDelta(frame: Frame, base: Optional[Frame]) -> bytes:
+    pixels = frame.pixels
+    if base is not None and base.pixels.shape == pixels.shape:
+        pixels = np.bitwise_xor(pixels, base.pixels)
+    return zlib.compress(np.ascontiguousarray(pixels[::-1]).tobytes(), 1)
+
+COMMAND_NUMBERS = {"rotate": ("azimuth", "elevation"), "pan": ("dx", "dy"), "zoom": ("factor",), "set": ("viewAngle",), "reset": ()}
+COMMAND_VECTORS = {"set": ("position", "focalPoint", "viewUp")}
+
+def isNumber(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and np.isfinite(value)
+
+"""
+    Description: check the fields of a camera command before it is queued (the render thread only gets valid ones).
+    Params:
+        command: a command object of the HTTP API
+    Return: the error message, None if the command is valid
+"""
+def validateCommand(command: dict) -> Optional[str]:
+    commandType = command.get("type")
+    if commandType not in COMMAND_NUMBERS:
+        return f"unknown command type: {commandType}"
+    for name in COMMAND_NUMBERS[commandType]:
+        if name in command and not isNumber(command[name]):
+            return f"{commandType}.{name} must be a number"
+    for name in COMMAND_VECTORS.get(commandType, ()):
+        if name in command and not (isinstance(command[name], list) and len(command[name]) == 3 and all(isNumber(value) for value in command[name])):
+            return f"{commandType}.{name} must be a list of 3 numbers"
+    return None
+
+class RenderServer:
+    def __init__(self, imageData: vtk.vtkImageData) -> None:
+        self.imageData = imageData
+        self.volumeProperty = vtk.vtkVolumeProperty()
+        setVolumeProperties(self.volumeProperty)
+        self.sessions: Dict[str, RenderSession] = {}
+        self.sessionIds = itertools.count(1)
+        self.pendingSessions: List[Tuple[str, dict]] = []
+        self.failedSessions: Set[str] = set()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self.running = True
+        self.thread = threading.Thread(target=self.renderLoop, name="render", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+    def createSession(self, options: dict) -> dict:
+        width = max(16, min(MAX_SIZE, int(options.get("width", 512))))
+        height = max(16, min(MAX_SIZE, int(options.get("height", 512))))
+        parameters = {
+            "width": width,
+            "height": height,
+            "maxFps": max(0.1, float(options.get("maxFps", 15))),
+            "frameTime": max(0.001, float(options.get("frameTime", 0.05))),
+        }
+        with self.condition:
+            sessionId = str(next(self.sessionIds))
+            # The render window is created by the render thread
+            self.pendingSessions.append((sessionId, parameters))
+            self.condition.notify_all()
+            while sessionId not in self.sessions and sessionId not in self.failedSessions and self.running:
+                self.condition.wait()
+            if sessionId not in self.sessions:
+                self.failedSessions.discard(sessionId)
+                raise RuntimeError("the session could not be created")
+        return {"id": sessionId, **parameters}
+
+    def getSession(self, sessionId: str) -> Optional[RenderSession]:
+        # Caller holds self.condition
+        session = self.sessions.get(sessionId)
+        if session is not None:
+            session.lastAccess = time.monotonic()
+        return session
+
+    def deleteSession(self, sessionId: str) -> bool:
+        with self.condition:
+            session = self.sessions.get(sessionId)
+            if session is None:
+                return False
+            session.lastAccess = -SESSION_TIMEOUT # closed by the render thread
+            self.condition.notify_all()
+        return True
+
+    def addCommands(self, sessionId: str, commands: List[dict]) -> bool:
+        with self.condition:
+            session = self.getSession(sessionId)
+            if session is None:
+                return False
+            session.commands.extend(commands)
+            session.lastCommand = time.monotonic()
+            self.condition.notify_all()
+        return True
+
+    """
+        Description: wait for a frame newer than since.
+        Params:
+            sessionId: the session
+            since: id of the last frame of the client (0: none)
+            timeout: maximum wait (seconds)
+        Return: (frame or None, number of frames skipped since the previous fetch, base frame or None) or None for an unknown session
+    """
+    def waitFrame(self, sessionId: str, since: int, timeout: float) -> Optional[Tuple[Optional[Frame], int, Optional[Frame]]]:
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                session = self.getSession(sessionId)
+                if session is None:
+                    return None
+                frame = session.getLatestFrame()
+                if frame is not None and frame.frameId > since:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.running:
+                    return None, 0, None
+                self.condition.wait(remaining)
+            # Frames rendered between the previous fetch and this one were never sent
+            skipped = max(0, frame.frameId - max(session.lastFetched, since) - 1)
+            session.skippedFrames += skipped
+            session.lastFetched = frame.frameId
+            return frame, skipped, session.frames.get(since)
+
+    def getStatistics(self) -> dict:
+        with self.condition:
+            sessions = {}
+            for sessionId, session in self.sessions.items():
+                frame = session.getLatestFrame()
+                sessions[sessionId] = {
+                    "width": session.width,
+                    "height": session.height,
+                    "lastFrameId": frame.frameId if frame else 0,
+                    "lastRenderSeconds": frame.seconds if frame else None,
+                    "lastFetched": session.lastFetched,
+                    "skippedFrames": session.skippedFrames,
+                    "pendingCommands": len(session.commands),
+                }
+            return {"sessions": sessions}
+
+    def renderLoop(self) -> None:
+        try:
+            self.renderSessions()
+        finally:
+            # Even if the loop dies, the waiting requests return instead of blocking forever
+            with self.condition:
+                self.running = False
+                for session in self.sessions.values():
+                    session.close()
+                self.sessions.clear()
+                self.condition.notify_all()
+
+    def renderSessions(self) -> None:
+        while True:
+            with self.condition:
+                if not self.running:
+                    break
+                now = time.monotonic()
+                for sessionId, parameters in self.pendingSessions:
+                    try:
+                        self.sessions[sessionId] = RenderSession(sessionId, self.imageData, self.volumeProperty, **parameters)
+                    except Exception as error:
+                        print(f"Cannot create the session {sessionId}: {error}")
+                        self.failedSessions.add(sessionId)
+                if self.pendingSessions:
+                    self.pendingSessions = []
+                    self.condition.notify_all()
+
+                expired = [sessionId for sessionId, session in self.sessions.items() if now - session.lastAccess > SESSION_TIMEOUT]
+                for sessionId in expired:
+                    self.sessions.pop(sessionId).close()
+
+                # Oldest render first, so one busy session does not starve the others
+                due = [session for session in self.sessions.values() if session.isDue(now)]
+                if not due:
+                    wakeUps = [t for t in (session.getWakeUpTime() for session in self.sessions.values()) if t is not None]
+                    wakeUps.append(now + 1.0) # idle sessions still expire
+                    self.condition.wait(max(0.0, min(wakeUps) - now))
+                    continue
+                session = min(due, key=lambda s: s.lastRender)
+                commands, session.commands = session.commands, []
+
+            still = not commands
+            try:
+                frame = session.render(commands, still)
+            except Exception as error:
+                # One bad session must not stop the others, its failed frame is not retried until the next command
+                print(f"Render of session {session.sessionId} failed: {error}")
+                frame = None
+
+            with self.condition:
+                session.lastRender = time.monotonic()
+                session.stillDone = still or frame is None
+                if frame is None:
+                    continue
+                session.frames[frame.frameId] = frame
+                while len(session.frames) > HISTORY:
+                    session.frames.popitem(last=False)
+                self.condition.notify_all()
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def sendJson(self, status: int, body: dict) -> None:
+        self.sendBytes(status, json.dumps(body).encode(), "application/json")
+
+    def sendBytes(self, status: int, body: bytes, contentType: str, headers: Optional[dict] = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def readJson(self) -> Optional[dict]:
+        # None on a malformed Content-Length or body, the caller answers 400
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                return None
+            return json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return None
+
+    def getPathParts(self) -> Tuple[List[str], dict]:
+        url = urlparse(self.path)
+        return [part for part in url.path.split("/") if part], parse_qs(url.query)
+
+    def do_POST(self) -> None:
+        renderServer: RenderServer = self.server.renderServer
+        parts, _ = self.getPathParts()
+        body = self.readJson()
+        if body is None:
+            self.sendJson(400, {"error": "invalid JSON"})
+        elif parts == ["sessions"]:
+            try:
+                self.sendJson(201, renderServer.createSession(body))
+            except (AttributeError, TypeError, ValueError) as error:
+                self.sendJson(400, {"error": str(error)})
+            except RuntimeError as error:
+                self.sendJson(503, {"error": str(error)})
+        elif len(parts) == 3 and parts[0] == "sessions" and parts[2] == "commands":
+            commands = body.get("commands", [body]) if isinstance(body, dict) else body
+            errors = [validateCommand(command) for command in commands] if isinstance(commands, list) and all(isinstance(command, dict) for command in commands) else ["commands must be a list of objects"]
+            error = next((error for error in errors if error is not None), None)
+            if error is not None:
+                self.sendJson(400, {"error": error})
+            elif renderServer.addCommands(parts[1], commands):
+                self.sendJson(202, {"queued": len(commands)})
+            else:
+                self.sendJson(404, {"error": "unknown session"})
+        else:
+            self.sendJson(404, {"error": "not found"})
+
+    def do_GET(self) -> None:
+        renderServer: RenderServer = self.server.renderServer
+        parts, query = self.getPathParts()
+        if parts == ["stats"]:
+            self.sendJson(200, renderServer.getStatistics())
+            return
+        if not (len(parts) == 3 and parts[0] == "sessions" and parts[2] == "frame"):
+            self.sendJson(404, {"error": "not found"})
+            return
+
+        parameter = lambda name, default: query.get(name, [default])[0]
+        try:
+            imageFormat = parameter("format", "jpeg")
+            quality = int(parameter("quality", 85))
+            since = int(parameter("since", 0))
+            timeout = float(parameter("timeout", 10))
+            if not timeout >= 0: # also rejects nan
+                raise ValueError(f"invalid timeout: {parameter('timeout', 10)}")
+            timeout = min(30.0, timeout)
+        except ValueError as error:
+            self.sendJson(400, {"error": str(error)})
+            return
+        if imageFormat not in ("jpeg", "png", "delta"):
+            self.sendJson(400, {"error": f"unknown format: {imageFormat}"})
+            return
+
+        result = renderServer.waitFrame(parts[1], since, timeout)
+        if result is None:
+            self.sendJson(404, {"error": "unknown session"})
+            return
+        frame, skipped, base = result
+        if frame is None:
+            # Nothing newer than since, the client keeps its frame
+            self.sendBytes(204, b"", "application/octet-stream")
+            return
+
+        height, width, _ = frame.pixels.shape
+        headers = {"X-Frame-Id": frame.frameId, "X-Skipped-Frames": skipped, "X-Still": int(frame.still), "X-Width": width, "X-Height": height}
+        with span("render_server.encode", format=imageFormat):
+            if imageFormat == "delta":
+                headers["X-Base-Frame-Id"] = base.frameId if base is not None else 0
+                self.sendBytes(200, encodeDelta(frame, base), "application/octet-stream", headers)
+            else:
+                self.sendBytes(200, encodeImage(frame, imageFormat, quality), f"image/{imageFormat}", headers)
+
+    def do_DELETE(self) -> None:
+        renderServer: RenderServer = self.server.renderServer
+        parts, _ = self.getPathParts()
+        if len(parts) == 2 and parts[0] == "sessions" and renderServer.deleteSession(parts[1]):
+            self.sendJson(200, {"deleted": parts[1]})
+        else:
+            self.sendJson(404, {"error": "unknown session"})
+
+"""
+    Description: load the series once and serve it until interrupted.
+    Params:
+        dirpath: a directory contains DICOM files
+        host, port: address of the HTTP server, local only by default
+    Return: None
+"""
+def serve(dirpath: str, host=HOST, port=PORT) -> None:
+    renderServer = RenderServer(loadCachedVolume(dirpath))
+    renderServer.start()
+    httpServer = ThreadingHTTPServer((host, port), RenderRequestHandler)
+    httpServer.daemon_threads = True
+    httpServer.renderServer = renderServer
+    print(f"Serving {dirpath} on http://{host}:{httpServer.server_address[1]}")
+    try:
+        httpServer.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpServer.server_close()
+        renderServer.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless volume rendering server")
+    parser.add_argument("dirpath", nargs="?", default="./data/220277460 Nguyen Thanh Dat")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args()
+    serve(args.dirpath, args.host, args.port)
@@ -0,0 +1,171 @@
+import vtk
+import numpy as np
+from typing import List, Optional, Sequence, Tuple
+from vtkmodules.util.numpy_support import vtk_to_numpy
+
+from instrumentation import timed
+from presets import presetRegistry
+
+BLOCK_SIZE = 8 # voxels per block edge of the min/max grid (macro-cells)
+OPACITY_THRESHOLD = 1.0 / 32767 # smaller opacities are 0 in the 15 bits tables of vtkFixedPointVolumeRayCastMapper
+
+"""
+    Description:
+        Per block min/max of a (z, y, x) volume. Block b covers the voxels [b * blockSize, (b + 1) * blockSize],
+        the last voxel plane being shared with block b + 1, so the range of a block bounds every trilinear
+        interpolation inside it.
+    Params:
+        array: the volume
+        blockSize: block edge (voxels)
+    Return: (minimum, maximum) arrays of the block grid
+"""
+def getBlockMinMax(array: np.ndarray, blockSize=BLOCK_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+    shape = [-(-n // blockSize) for n in array.shape]
+    minimum = np.empty(shape, dtype=array.dtype)
+    maximum = np.empty(shape, dtype=array.dtype)
+    # One slab of blockSize slices at a time: reduced along z first (contiguous planes), only the 2D result is padded,
+    # the volume is never copied
+    padding = ((0, shape[1] * blockSize - array.shape[1]), (0, shape[2] * blockSize - array.shape[2]))
+    for k in range(shape[0]):
+        slab = array[k * blockSize:(k + 1) * blockSize]
+        for planes, reduce, out in ((slab.min(axis=0), np.min, minimum), (slab.max(axis=0), np.max, maximum)):
+            if padding[0][1] or padding[1][1]:
+                planes = np.pad(planes, padding, mode="edge")
+            out[k] = reduce(planes.reshape(shape[1], blockSize, shape[2], blockSize), axis=(1, 3))
+    # Add the first voxel plane of the next block (separable: the corner neighbours are covered too)
+    for axis in range(3):
+        low = [slice(None)] * 3
+        high = [slice(None)] * 3
+        low[axis] = slice(0, -1)
+        high[axis] = slice(1, None)
+        np.minimum(minimum[tuple(low)], minimum[tuple(high)], out=minimum[tuple(low)])
+        np.maximum(maximum[tuple(low)], maximum[tuple(high)], out=maximum[tuple(low)])
+    return minimum, maximum
+
+"""
+    Description:
+        Opacity of every integer scalar of [scalarMinimum, scalarMaximum].
+        The function of a preset (presetRegistry.applyPreset) is sampled once in the cached lookup table of
+        the preset, shared by every volume using it; a custom function is sampled on each call.
+    Params:
+        scalarOpacity: the scalar opacity transfer function
+        scalarMinimum, scalarMaximum: integer range of the table
+    Return: the table (read-only), entry i is the opacity of scalarMinimum + i
+"""
+def getOpacityTable(scalarOpacity: vtk.vtkPiecewiseFunction, scalarMinimum: int, scalarMaximum: int) -> np.ndarray:
+    size = scalarMaximum - scalarMinimum + 1
+    preset = presetRegistry.findScalarOpacity(scalarOpacity) if size > 1 else None
+    if preset is not None:
+        return preset.getLookupTable((scalarMinimum, scalarMaximum), size)[:, 3]
+    table = np.empty(size, dtype=np.float64)
+    if size > 1:
+        scalarOpacity.GetTable(scalarMinimum, scalarMaximum, size, table)
+    else:
+        table[0] = scalarOpacity.GetValue(scalarMinimum)
+    return table
+
+"""
+    Description:
+        Classification of the blocks: does the range [min, max] of a block contain an opacity >= isovalue.
+        Prefix sums of the opacity table answer it in O(1) per block.
+    Params:
+        blockMinimum, blockMaximum: the block grid of getBlockMinMax()
+        table: opacity table of getOpacityTable(), starting at scalarMinimum
+        scalarMinimum: first scalar of the table
+        isovalue: opacity threshold
+    Return: boolean array of the occupied blocks
+"""
+def classifyBlocks(blockMinimum: np.ndarray, blockMaximum: np.ndarray, table: np.ndarray, scalarMinimum: int, isovalue: float) -> np.ndarray:
+    size = len(table)
+    opaqueCounts = np.concatenate(([0], np.cumsum(table >= isovalue)))
+    # Interpolated values are between the integer samples of the table: a block is also kept when its range
+    # only overlaps the opaque values by a fraction of a scalar unit
+    lower = np.floor(blockMinimum).astype(np.int64) - scalarMinimum
+    upper = np.ceil(blockMaximum).astype(np.int64) - scalarMinimum
+    return opaqueCounts[np.minimum(upper + 1, size)] - opaqueCounts[np.maximum(lower - 1, 0)] > 0
+
+"""
+    Description:
+        Empty-space skipping of a volume rendered by a CPU ray caster (vtkFixedPointVolumeRayCastMapper).
+        A min/max grid of macro-cells (BLOCK_SIZE voxels) is computed once per image (MTime) and classified
+        with the scalar opacity function of the volume property whenever it changes (MTime, preset swap).
+        The mappers are cropped to the bounding box of the occupied blocks (sub-volume cropping): rays missing
+        it are not cast and the others start and stop on its faces, so the air around the body and the
+        fillValue region of a removed bed are never sampled. Inside the box the mapper still leaps over its
+        own 4x4x4 transparent blocks. The blocks outside the box are fully transparent for every trilinear
+        sample: nothing visible is cut, only the first sample of the rays moves to the box faces (a few gray
+        levels of difference on edges, as any change of the ray start).
+        The cropping of the mappers is owned by this object (a cropping set by the user is replaced).
+    Params:
+        volume: the rendered vtkVolume
+        imageData: the volume data, default=None (input of the mapper of volume)
+        mappers: every mapper rendering the volume (e.g. the levels of a VolumePyramid), default=None (mapper of volume)
+        blockSize: macro-cell edge (voxels)
+        opacityThreshold: smallest opacity of a contributing sample
+"""
+class EmptySpaceSkipping:
+    def __init__(self, volume: vtk.vtkVolume, imageData: Optional[vtk.vtkImageData] = None, mappers: Optional[Sequence[vtk.vtkVolumeMapper]] = None, blockSize=BLOCK_SIZE, opacityThreshold=OPACITY_THRESHOLD) -> None:
+        self.volume = volume
+        self.imageData = imageData if imageData is not None else volume.GetMapper().GetInput()
+        self.mappers: List[vtk.vtkVolumeMapper] = list(mappers) if mappers else [volume.GetMapper()]
+        self.blockSize = blockSize
+        self.opacityThreshold = opacityThreshold
+        self.blockMinimum: Optional[np.ndarray] = None
+        self.blockMaximum: Optional[np.ndarray] = None
+        self.imageMTime = -1
+        self.occupied: Optional[np.ndarray] = None
+        self.opacityKey = None
+        self.bounds: Optional[Tuple[float, ...]] = None # cropping box (data coordinates)
+        self.occupiedFraction = 1.0 # statistics: occupied blocks / blocks, box volume / volume
+        self.boxFraction = 1.0
+
+    def attach(self, renderer: vtk.vtkRenderer) -> None:
+        renderer.AddObserver(vtk.vtkCommand.StartEvent, self.startRenderEventHandle)
+
+    def startRenderEventHandle(self, obj: vtk.vtkRenderer, event: str) -> None:
+        self.update()
+
+    @timed()
+    def update(self) -> None:
+        # Rebuild what is outdated: the min/max grid when the image changed, the classification when the opacity changed
+        imageMTime = self.imageData.GetMTime()
+        if imageMTime != self.imageMTime:
+            scalars = self.imageData.GetPointData().GetScalars()
+            if scalars is None:
+                return
+            dimensions = self.imageData.GetDimensions()
+            array = vtk_to_numpy(scalars).reshape(dimensions[::-1])
+            self.blockMinimum, self.blockMaximum = getBlockMinMax(array, self.blockSize)
+            self.imageMTime = imageMTime
+            self.opacityKey = None
+
+        scalarOpacity = self.volume.GetProperty().GetScalarOpacity()
+        opacityKey = (scalarOpacity, scalarOpacity.GetMTime(), self.opacityThreshold, self.imageMTime)
+        if opacityKey == self.opacityKey:
+            return
+        scalarMinimum = int(np.floor(self.blockMinimum.min()))
+        table = getOpacityTable(scalarOpacity, scalarMinimum, int(np.ceil(self.blockMaximum.max())))
+        self.occupied = classifyBlocks(self.blockMinimum, self.blockMaximum, table, scalarMinimum, self.opacityThreshold)
+        self.opacityKey = opacityKey
+        self.crop()
+
+    def crop(self) -> None:
+        origin = self.imageData.GetOrigin()
+        spacing = self.imageData.GetSpacing()
+        upperIndex = np.array(self.imageData.GetDimensions()) - 1
+        self.occupiedFraction = float(self.occupied.mean())
+        if not self.occupied.any():
+            # Nothing visible: an empty box at the origin
+            self.bounds = (origin[0], origin[0], origin[1], origin[1], origin[2], origin[2])
+            self.boxFraction = 0.0
+        else:
+            # Occupied blocks (z, y, x) -> voxel index box (x, y, z), a block covers the first plane of the next one
+            blocks = np.nonzero(self.occupied)
+            lower = np.array([blocks[axis].min() for axis in (2, 1, 0)]) * self.blockSize
+            upper = np.minimum((np.array([blocks[axis].max() for axis in (2, 1, 0)]) + 1) * self.blockSize, upperIndex)
+            self.bounds = tuple(value for axis in range(3) for value in (origin[axis] + lower[axis] * spacing[axis], origin[axis] + upper[axis] * spacing[axis]))
+            self.boxFraction = float(np.prod((upper - lower) / np.maximum(upperIndex, 1)))
+        for mapper in self.mappers:
+            mapper.SetCroppingRegionPlanes(self.bounds)
+            mapper.SetCroppingRegionFlagsToSubVolume()
+            mapper.CroppingOn()
@@ -0,0 +1,83 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+import vtk
+
+from cache import loadCachedVolume
+
+"""
+    Description:
+        Process-wide store of the loaded studies, so several viewers/widgets opened side by side share one
+        vtkImageData (and one pipeline producer for their mappers) instead of each loading the series.
+        acquire() loads a series on its first use and counts the references, release() drops the volume
+        when its last user is closed. The shared volume is read-only: a tool which modifies the voxels
+        (e.g. applyMask) has to load its own copy.
+        The GPU textures stay per render window (one OpenGL context each), only the CPU side is shared.
+"""
+class VolumeEntry:
+    def __init__(self, imageData: vtk.vtkImageData) -> None:
+        self.imageData = imageData
+        # Mappers connect to this producer: one pipeline input whatever the number of viewers
+        self.producer = vtk.vtkTrivialProducer()
+        self.producer.SetOutput(imageData)
+        self.references = 0
+
+class VolumeStore:
+    def __init__(self) -> None:
+        self.entries: Dict[str, VolumeEntry] = {}
+        self.lock = threading.RLock()
+
+    def getKey(self, dirpath: str) -> str:
+        return os.path.realpath(dirpath)
+
+    """
+        Description: get the volume of a series, loaded on the first call.
+        Params:
+            dirpath: a directory contains one DICOM series
+            load: loading function called with dirpath when the series is not in the store, default=None (loadCachedVolume)
+        Return: the shared vtkImageData object
+    """
+    def acquire(self, dirpath: str, load: Optional[Callable[[str], vtk.vtkImageData]] = None) -> vtk.vtkImageData:
+        key = self.getKey(dirpath)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = VolumeEntry((load or loadCachedVolume)(dirpath))
+                self.entries[key] = entry
+            entry.references += 1
+            return entry.imageData
+
+    def release(self, dirpath: str) -> None:
+        key = self.getKey(dirpath)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                print(f"Volume is not in the store: {dirpath}")
+                return
+            entry.references -= 1
+            if entry.references <= 0:
+                del self.entries[key]
+
+    def getOutputPort(self, dirpath: str) -> Optional[vtk.vtkAlgorithmOutput]:
+        # Input of a mapper (SetInputConnection), the series has to be acquired first
+        with self.lock:
+            entry = self.entries.get(self.getKey(dirpath))
+            return entry.producer.GetOutputPort() if entry is not None else None
+
+    def getReferenceCount(self, dirpath: str) -> int:
+        with self.lock:
+            entry = self.entries.get(self.getKey(dirpath))
+            return entry.references if entry is not None else 0
+
+    @contextmanager
+    def open(self, dirpath: str, load: Optional[Callable[[str], vtk.vtkImageData]] = None):
+        # with volumeStore.open(path) as imageData: ... released at the end of the block
+        imageData = self.acquire(dirpath, load)
+        try:
+            yield imageData
+        finally:
+            self.release(dirpath)
+
+volumeStore = VolumeStore()
@@ -0,0 +1,142 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+import numpy as np
+import vtk
+
+from cache import getSeriesKey, openCachedVolume, storeVolume, evictCache, readSeriesMetadata, CACHE_DIR, CACHE_MAX_BYTES
+from index import scanSeriesFileNames
+from loader import readSeriesGeometry, readSlice, wrapArrayAsImageData
+
+"""
+    Description:
+        Load a DICOM series coarse-to-fine.
+        loadPreview() decodes every stride-th slice and replicates it over its neighbours, so a full size
+        volume can be rendered right away. start() decodes the remaining slices in a background thread
+        straight into the same buffer. The background thread never calls VTK: attach() installs a repeating
+        timer on the interactor which marks the image as modified and re-renders from the main thread.
+        A slice which cannot be decoded keeps its preview neighbour, the other slices are still decoded; the
+        error is reported by the timer when the thread ends and the incomplete volume is not cached.
+        A series already in the volume cache is returned complete by loadPreview().
+"""
+class ProgressiveVolumeLoader:
+    def __init__(self, dirpath: str, stride=8, numberOfWorkers: Optional[int] = None, useCache=True) -> None:
+        self.dirpath = dirpath
+        self.stride = max(1, stride)
+        self.numberOfWorkers = numberOfWorkers or os.cpu_count() or 1
+        self.useCache = useCache
+        self.imageData: Optional[vtk.vtkImageData] = None
+        self.buffer: Optional[np.ndarray] = None
+        self.fileNames: List[str] = []
+        self.cacheKey: Optional[str] = None
+        self.remaining: List[int] = []
+        self.decodedCount = 0 # written by the background thread only
+        self.failedIndices: List[int] = [] # slices which could not be decoded (background thread)
+        self.error: Optional[Exception] = None # first error of the background thread
+        self.isDecoding = False
+        self.doneCallbacks: List[Callable[[], None]] = []
+        self.publishedCount = 0
+        self.done = False
+        self.timerId = None
+        self.thread: Optional[threading.Thread] = None
+
+    def loadPreview(self) -> vtk.vtkImageData:
+        if self.useCache:
+            self.cacheKey = getSeriesKey(self.dirpath)
+            imageData = openCachedVolume(self.cacheKey, CACHE_DIR)
+            if imageData is not None:
+                self.imageData = imageData
+                self.done = True
+                return imageData
+
+        # Header-only scan, reversed to the slice order of vtkDICOMImageReader
+        self.fileNames = scanSeriesFileNames(self.dirpath)[::-1]
+        if not self.fileNames:
+            raise ValueError(f"No DICOM series found in {self.dirpath}")
+        dimensions, spacing = readSeriesGeometry(self.fileNames)
+        self.buffer = np.empty((dimensions[2], dimensions[1], dimensions[0]), dtype=np.int16)
+
+        previewIndices = list(range(0, len(self.fileNames), self.stride))
+        with ThreadPoolExecutor(max_workers=self.numberOfWorkers) as pool:
+            slices = pool.map(readSlice, [self.fileNames[i] for i in previewIndices])
+            for index, array in zip(previewIndices, slices):
+                # Nearest neighbour fill of the slices which are not decoded yet
+                self.buffer[index:index + self.stride] = array[::-1]
+
+        previewSet = set(previewIndices)
+        self.remaining = [i for i in range(len(self.fileNames)) if i not in previewSet]
+        self.done = not self.remaining
+        self.imageData = wrapArrayAsImageData(self.buffer, spacing)
+        return self.imageData
+
+    def start(self) -> None:
+        if self.done or self.thread is not None:
+            return
+        self.isDecoding = True
+        self.thread = threading.Thread(target=self._decodeRemaining, daemon=True)
+        self.thread.start()
+
+    def _decodeRemaining(self) -> None:
+        # Nothing may escape the thread: the timer waits for isDecoding to be False
+        try:
+            with ThreadPoolExecutor(max_workers=self.numberOfWorkers) as pool:
+                futures = [(index, pool.submit(readSlice, self.fileNames[index])) for index in self.remaining]
+                for index, future in futures:
+                    try:
+                        self.buffer[index] = future.result()[::-1]
+                    except Exception as e:
+                        self.failedIndices.append(index)
+                        if self.error is None:
+                            self.error = e
+                    self.decodedCount += 1
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+        finally:
+            self.isDecoding = False
+
+    def addDoneCallback(self, callback: Callable[[], None]) -> None:
+        # Called from the timer (main thread) when the last slice is published, right away if the volume is complete
+        if self.done:
+            callback()
+        else:
+            self.doneCallbacks.append(callback)
+
+    def attach(self, interactor: vtk.vtkRenderWindowInteractor, interval=100) -> None:
+        if self.done:
+            return
+        interactor.AddObserver(vtk.vtkCommand.TimerEvent, self.timerEventHandle)
+        self.timerId = interactor.CreateRepeatingTimer(interval)
+
+    def timerEventHandle(self, obj: vtk.vtkRenderWindowInteractor, event: str) -> None:
+        if self.timerId is None or obj.GetTimerEventId() != self.timerId:
+            return
+        decodedCount = self.decodedCount
+        if decodedCount != self.publishedCount:
+            self.publishedCount = decodedCount
+            self.imageData.GetPointData().GetScalars().Modified()
+            self.imageData.Modified()
+            obj.Render()
+
+        if not self.isDecoding and self.publishedCount == self.decodedCount:
+            obj.DestroyTimer(self.timerId)
+            self.timerId = None
+            self.done = True
+            for callback in self.doneCallbacks:
+                callback()
+            self.doneCallbacks = []
+            if self.error is not None:
+                print(f"Loading of {self.dirpath} is incomplete, {len(self.failedIndices) or 'the remaining'} slices not decoded: {type(self.error).__name__}: {self.error}")
+                return
+            self._storeInCache()
+
+    def _storeInCache(self) -> None:
+        if not self.useCache or not self.fileNames:
+            return
+        try:
+            storeVolume(self.imageData, self.cacheKey, readSeriesMetadata(self.fileNames[0]), CACHE_DIR)
+            evictCache(CACHE_DIR, CACHE_MAX_BYTES)
+        except OSError as e:
+            print(f"Volume cache is not writable: {e}")
@@ -0,0 +1,279 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Tuple
+
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "reader"))
+from remove_bed import computeMask, applyMask
+from coarse import computeMaskCoarseToFine
+from bridge import vtkToSitk
+from slabs import splitSegmentsOutOfCore, applyMaskOutOfCore
+from loader import loadVolume, getSeriesFileNames, readSeriesGeometry, readSlice
+
+FORMATS = {"nrrd": ".nrrd", "mha": ".mha", "nifti": ".nii.gz"}
+# Peak bytes per input voxel of the in-memory path: int16 volume + uint8 binary + uint8 copy in SimpleITK
+# + uint32 connected components + uint32 relabel + uint8 mask
+IN_MEMORY_BYTES_PER_VOXEL = 2 + 1 + 1 + 4 + 4 + 1
+WORKER_OVERHEAD_BYTES = 1024 ** 3 # interpreter, VTK, ITK and their buffers, on top of the memory cap
+
+"""
+    Description: write a (z, y, x) array (e.g. np.memmap) to .mha or .nrrd slab by slab, raw little endian data.
+    Params:
+        array: the volume
+        spacing: spacing (x, y, z)
+        outputPath: path ending with .mha or .nrrd
+        slabSize: number of slices written at a time
+    Return: None
+"""
+def writeVolumeStreaming(array: np.ndarray, spacing, outputPath: str, slabSize=64) -> None:
+    dimensions = (array.shape[2], array.shape[1], array.shape[0])
+    if outputPath.endswith(".mha"):
+        elementType = {np.dtype(np.int16): "MET_SHORT", np.dtype(np.uint8): "MET_UCHAR"}[array.dtype]
+        header = (
+            "ObjectType = Image\nNDims = 3\nBinaryData = True\nBinaryDataByteOrderMSB = False\n"
+            f"Offset = 0 0 0\nElementSpacing = {spacing[0]} {spacing[1]} {spacing[2]}\n"
+            f"DimSize = {dimensions[0]} {dimensions[1]} {dimensions[2]}\n"
+            f"ElementType = {elementType}\nElementDataFile = LOCAL\n"
+        )
+    elif outputPath.endswith(".nrrd"):
+        nrrdType = {np.dtype(np.int16): "short", np.dtype(np.uint8): "uchar"}[array.dtype]
+        header = (
+            f"NRRD0004\ntype: {nrrdType}\ndimension: 3\nspace: left-posterior-superior\n"
+            f"sizes: {dimensions[0]} {dimensions[1]} {dimensions[2]}\n"
+            f"space directions: ({spacing[0]},0,0) (0,{spacing[1]},0) (0,0,{spacing[2]})\n"
+            "space origin: (0,0,0)\nkinds: domain domain domain\nendian: little\nencoding: raw\n\n"
+        )
+    else:
+        raise ValueError(f"Streaming output must be .mha or .nrrd: {outputPath}")
+
+    with open(outputPath, "wb") as f:
+        f.write(header.encode("ascii"))
+        for z0 in range(0, array.shape[0], slabSize):
+            f.write(np.ascontiguousarray(array[z0:z0 + slabSize], dtype=array.dtype.newbyteorder("<")).tobytes())
+
+"""
+    Description: bed removal of one series fully in memory (loadVolume -> splitSegments -> applyMask -> write).
+    Params:
+        dirpath: the series directory
+        fileNames: sorted file names of the series
+        outputPath: the output file, format from its extension
+        timings: filled with the duration of every stage
+        coarseToFine: use computeMaskCoarseToFine instead of computeMask, default=False
+    Return: None
+"""
+def removeBedInMemory(dirpath: str, fileNames: List[str], outputPath: str, timings: Dict[str, float], coarseToFine=False) -> None:
+    start = time.perf_counter()
+    imageData = loadVolume(dirpath, numberOfWorkers=1, fileNames=fileNames) # the pool parallelizes over studies
+    timings["load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mask = computeMaskCoarseToFine(imageData) if coarseToFine else computeMask(imageData)
+    timings["splitSegments"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if mask is not None:
+        applyMask(imageData, mask)
+    del mask
+    timings["applyMask"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sitk.WriteImage(vtkToSitk(imageData), outputPath, True)
+    timings["write"] = time.perf_counter() - start
+
+"""
+    Description:
+        Bed removal of one series with bounded memory: the slices are decoded into a memory-mapped
+        file and segmentation/slabs.py processes the volume slab by slab.
+    Params:
+        fileNames: sorted file names of the series
+        outputPath: the output file (.mha or .nrrd)
+        timings: filled with the duration of every stage
+        tempDir: directory of the temporary files
+    Return: None
+"""
+def removeBedOutOfCore(fileNames: List[str], outputPath: str, timings: Dict[str, float], tempDir: str) -> None:
+    start = time.perf_counter()
+    dimensions, spacing = readSeriesGeometry(fileNames)
+    volumePath = os.path.join(tempDir, "volume.npy")
+    volume = np.lib.format.open_memmap(volumePath, mode="w+", dtype=np.int16, shape=dimensions[::-1])
+    for index, fileName in enumerate(fileNames):
+        volume[index] = readSlice(fileName)[::-1]
+    volume.flush()
+    timings["load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mask = splitSegmentsOutOfCore(volume, os.path.join(tempDir, "mask.npy"), tempDir=tempDir)
+    timings["splitSegments"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if mask is not None:
+        volume = applyMaskOutOfCore(volume, mask, os.path.join(tempDir, "masked.npy"))
+    timings["applyMask"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    writeVolumeStreaming(volume, spacing, outputPath)
+    timings["write"] = time.perf_counter() - start
+
+"""
+    Description:
+        Worker of the pool: process one series and return its log record, exceptions are reported, not raised.
+    Params:
+        dirpath: the series directory
+        outputPath: the output file
+        memoryCap: bytes a worker may use, above it the out-of-core path is taken (0 = no cap)
+        coarseToFine: see removeBedInMemory
+    Return: the log record (dict)
+"""
+def processSeries(dirpath: str, outputPath: str, memoryCap: int, coarseToFine=False) -> dict:
+    record = {"series": dirpath, "output": outputPath, "pid": os.getpid()}
+    timings: Dict[str, float] = {}
+    start = time.perf_counter()
+    # Written next to the output then renamed: an interrupted write never leaves a file that later runs would skip
+    temporaryPath = getTemporaryPath(outputPath)
+    try:
+        fileNames = getSeriesFileNames(dirpath)
+        if not fileNames:
+            raise ValueError("No DICOM series found")
+        dimensions, _ = readSeriesGeometry(fileNames) # headers of the first and last slice only
+        estimate = int(np.prod(dimensions, dtype=np.int64)) * IN_MEMORY_BYTES_PER_VOXEL
+        record["estimatedBytes"] = estimate
+        if memoryCap and estimate > memoryCap:
+            record["mode"] = "slabs"
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(outputPath)) as tempDir:
+                removeBedOutOfCore(fileNames, temporaryPath, timings, tempDir)
+        else:
+            record["mode"] = "memory"
+            removeBedInMemory(dirpath, fileNames, temporaryPath, timings, coarseToFine)
+        os.replace(temporaryPath, outputPath)
+        record["status"] = "ok"
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = f"{type(e).__name__}: {e}"
+        record["traceback"] = traceback.format_exc()
+        if os.path.exists(temporaryPath):
+            os.remove(temporaryPath)
+    record["timings"] = timings
+    record["total"] = time.perf_counter() - start
+    return record
+
+"""
+    Description: expand directories and glob patterns to a sorted list of series directories.
+    Params:
+        patterns: directories or glob patterns
+    Return: a list of directories
+"""
+def expandSeries(patterns: List[str]) -> List[str]:
+    dirpaths = set()
+    for pattern in patterns:
+        for path in glob.glob(pattern, recursive=True) or [pattern]:
+            if os.path.isdir(path):
+                dirpaths.add(os.path.abspath(path))
+    return sorted(dirpaths)
+
+def getOutputPath(dirpath: str, outputDir: str, extension: str) -> str:
+    # Directory name + short hash of the full path, so equal names in different parents do not collide
+    digest = hashlib.sha1(dirpath.encode()).hexdigest()[:8]
+    return os.path.join(outputDir, f"{os.path.basename(dirpath)}_{digest}{extension}")
+
+def getTemporaryPath(outputPath: str) -> str:
+    # Same directory (os.replace stays on one file system) and same extension (the writers pick the format from it)
+    return os.path.join(os.path.dirname(outputPath), f".tmp{os.getpid()}_{os.path.basename(outputPath)}")
+
+def limitMemory(memoryCap: int) -> None:
+    # Pool initializer: above the cap (+ overhead) allocations fail with MemoryError, reported in the record of the study,
+    # instead of the OOM killer terminating the worker. RLIMIT_DATA (Linux >= 4.7) counts the anonymous mappings but
+    # not the shared file mappings of the out-of-core path.
+    if not memoryCap:
+        return
+    try:
+        import resource
+        limit = memoryCap + WORKER_OVERHEAD_BYTES
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, resource.getrlimit(resource.RLIMIT_DATA)[1]))
+    except (ImportError, ValueError, OSError) as e:
+        print(f"Memory cap not enforced: {e}")
+
+def getCrashRecord(dirpath: str, outputPath: str) -> dict:
+    # A worker died while processing this study (e.g. killed by the OOM killer), its partial output is removed
+    for temporaryPath in glob.glob(os.path.join(glob.escape(os.path.dirname(outputPath)), f".tmp*_{glob.escape(os.path.basename(outputPath))}")):
+        os.remove(temporaryPath)
+    return {"series": dirpath, "output": outputPath, "status": "failed", "error": "BrokenProcessPool: the worker process died", "timings": {}, "total": 0.0}
+
+"""
+    Description:
+        Run the jobs in a process pool. When a worker dies, every unfinished job of the pool fails with
+        BrokenProcessPool without telling which one killed it: these jobs are run again one by one, each in a
+        new single worker pool, so only the study which kills its worker again is logged as failed and the
+        others are processed normally.
+    Params:
+        jobs: (dirpath, outputPath) of every study
+        workers: number of worker processes
+        memoryCap, coarseToFine: see processSeries
+    Return: iterator of the log records, in completion order
+"""
+def runJobs(jobs: List[Tuple[str, str]], workers: int, memoryCap: int, coarseToFine=False):
+    suspects = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=limitMemory, initargs=(memoryCap,)) as pool:
+        futures = {pool.submit(processSeries, dirpath, outputPath, memoryCap, coarseToFine): (dirpath, outputPath) for dirpath, outputPath in jobs}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                suspects.append(futures[future])
+    for dirpath, outputPath in suspects:
+        try:
+            with ProcessPoolExecutor(max_workers=1, initializer=limitMemory, initargs=(memoryCap,)) as pool:
+                yield pool.submit(processSeries, dirpath, outputPath, memoryCap, coarseToFine).result()
+        except BrokenProcessPool:
+            yield getCrashRecord(dirpath, outputPath)
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Headless bed removal for a DICOM archive")
+    parser.add_argument("series", nargs="+", help="series directories or glob patterns (quote them)")
+    parser.add_argument("-o", "--output-dir", required=True)
+    parser.add_argument("-f", "--format", choices=sorted(FORMATS), default="nrrd")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("-m", "--memory-cap", type=float, default=0, help="GB per worker, bigger studies are processed slab by slab (0 = no cap)")
+    parser.add_argument("--log", default=None, help="JSONL log, default <output-dir>/remove_bed.jsonl")
+    parser.add_argument("--overwrite", action="store_true", help="process studies whose output already exists")
+    parser.add_argument("--coarse-to-fine", action="store_true", help="find the segments on a 4x downsampled grid, refined in the boundary blocks (in-memory path)")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    logPath = args.log or os.path.join(args.output_dir, "remove_bed.jsonl")
+    memoryCap = int(args.memory_cap * 1024 ** 3)
+    extension = FORMATS[args.format]
+    if memoryCap and args.format == "nifti":
+        parser.error("--memory-cap streams the output, use --format nrrd or mha")
+
+    jobs = []
+    for dirpath in expandSeries(args.series):
+        outputPath = getOutputPath(dirpath, args.output_dir, extension)
+        if not args.overwrite and os.path.exists(outputPath):
+            continue
+        jobs.append((dirpath, outputPath))
+    print(f"Studies: {len(jobs)}, workers: {args.workers}")
+
+    failures = 0
+    with open(logPath, "a") as log:
+        for done, record in enumerate(runJobs(jobs, args.workers, memoryCap, args.coarse_to_fine), start=1):
+            log.write(json.dumps(record) + "\n")
+            log.flush()
+            if record["status"] != "ok":
+                failures += 1
+            print(f"[{done}/{len(jobs)}] {record['status']} {record['total']:.1f}s {record['series']}")
+    print(f"Failures: {failures}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
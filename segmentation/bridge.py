@@ -0,0 +1,105 @@
+import vtk
+from typing import Optional
+import numpy as np
+import SimpleITK as sitk
+from vtkmodules.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+
+"""
+    Description:
+        Return the scalars of a vtkImageData as a (z, y, x) numpy view, no copy.
+        Writing into the view writes into the image, call imageData.Modified() afterwards.
+    Params:
+        imageData: vtkImageData object with one component
+    Return: a 3D array
+"""
+def arrayFromVtk(imageData: vtk.vtkImageData) -> np.ndarray:
+    dimensions = imageData.GetDimensions()
+    return vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(dimensions[::-1])
+
+"""
+    Description: copy spacing, origin and direction from a vtkImageData to a SimpleITK image.
+    Params:
+        imageData: the source
+        image: the destination
+    Return: None
+"""
+def copyGeometryToSitk(imageData: vtk.vtkImageData, image: sitk.Image) -> None:
+    image.SetSpacing(imageData.GetSpacing())
+    image.SetOrigin(imageData.GetOrigin())
+    matrix = imageData.GetDirectionMatrix()
+    image.SetDirection([matrix.GetElement(i, j) for i in range(3) for j in range(3)])
+
+"""
+    Description: copy spacing, origin and direction from a SimpleITK image to a vtkImageData.
+    Params:
+        image: the source
+        imageData: the destination
+    Return: None
+"""
+def copyGeometryToVtk(image: sitk.Image, imageData: vtk.vtkImageData) -> None:
+    imageData.SetSpacing(image.GetSpacing())
+    imageData.SetOrigin(image.GetOrigin())
+    imageData.SetDirectionMatrix(image.GetDirection())
+
+"""
+    Description:
+        Build a SimpleITK image from an array with the geometry of a vtkImageData.
+        SimpleITK cannot wrap a foreign buffer, so this is the only copy of the bridge:
+        threshold first and pass a uint8 array to pay 1 byte per voxel instead of the input type.
+    Params:
+        array: a (z, y, x) array, by default the scalars of imageData
+        imageData: gives the geometry
+    Return: SimpleITK image
+"""
+def vtkToSitk(imageData: vtk.vtkImageData, array: Optional[np.ndarray] = None) -> sitk.Image:
+    if array is None:
+        array = arrayFromVtk(imageData)
+    image = sitk.GetImageFromArray(array)
+    copyGeometryToSitk(imageData, image)
+    return image
+
+"""
+    Description:
+        Wrap the buffer of a SimpleITK image as vtkImageData, no copy.
+        The vtk array keeps the SimpleITK image alive, so the buffer cannot be freed under it.
+    Params:
+        image: SimpleITK image (3D, one component)
+    Return: vtkImageData object
+"""
+def sitkToVtk(image: sitk.Image) -> vtk.vtkImageData:
+    array = sitk.GetArrayViewFromImage(image)
+    return wrapArray(array, image, image)
+
+"""
+    Description:
+        Wrap a (z, y, x) array as vtkImageData with the geometry of a SimpleITK image, no copy.
+    Params:
+        array: a C-contiguous 3D array
+        image: gives the geometry
+        owner: extra object kept alive by the vtk array (e.g. the image the array is a view of)
+    Return: vtkImageData object
+"""
+def wrapArray(array: np.ndarray, image: sitk.Image, owner=None) -> vtk.vtkImageData:
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(array.shape[2], array.shape[1], array.shape[0])
+    copyGeometryToVtk(image, imageData)
+    scalars = numpy_to_vtk(array.reshape(-1), deep=False)
+    scalars._owner = owner # lifetime pinning of the buffer
+    imageData.GetPointData().SetScalars(scalars)
+    return imageData
+
+"""
+    Description:
+        Set the voxels of imageData where mask is not 0 to fillValue, in place.
+        BinaryMask.apply is the zero-copy path for the masks of the segmentation pipeline.
+    Params:
+        imageData: vtkImageData object, modified
+        maskArray: a (z, y, x) array with the same shape
+        fillValue: the new value
+    Return: None
+"""
+def fillMaskedVoxels(imageData: vtk.vtkImageData, maskArray: np.ndarray, fillValue) -> None:
+    array = arrayFromVtk(imageData)
+    np.copyto(array, fillValue, where=maskArray != 0)
+    imageData.GetPointData().GetScalars().Modified()
+    imageData.Modified()
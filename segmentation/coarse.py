@@ -0,0 +1,234 @@
+from typing import List, Optional, Tuple
+
+import numpy as np
+import SimpleITK as sitk
+import vtk
+
+from bridge import arrayFromVtk
+from mask import BinaryMask
+from slabs import UnionFind
+
+"""
+    Coarse-to-fine version of computeMask.
+    The volume is cut into 4x4x4 blocks (a 4x downsampled grid) and every block is classified from its
+    foreground count: empty, full (every voxel >= imageThreshold) or mixed (the boundary).
+    - Full blocks are labelled on the coarse grid. Two 26-adjacent full blocks always touch at full
+      resolution, so this labelling is exact and the interior of the body is never labelled voxel by voxel.
+    - Mixed blocks are refined at full resolution: a block is stored as a 64-bit word (bit z * 16 + y * 4 + x),
+      its components are found by bit-parallel flood fill and linked to the components of the mixed and full
+      neighbour blocks (the dilated band around the coarse boundary) with shifts of the words.
+    The components, their sizes and so the mask are the ones of the full-resolution pipeline. Tolerance: the
+    voxel sets are identical, only components of exactly equal size may be ranked in a different order than
+    by RelabelComponentImageFilter (which then only matters when one of them is at the maxNumberOfSegments cut).
+"""
+
+BLOCK_SIZE = 4
+BLOCK_VOXELS = BLOCK_SIZE ** 3
+STRIDES = (16, 4, 1) # bit offset of one step along z, y, x inside a block word
+FIRST_PLANES = (np.uint64(0x000000000000FFFF), np.uint64(0x000F000F000F000F), np.uint64(0x1111111111111111))
+LAST_PLANES = (np.uint64(0xFFFF000000000000), np.uint64(0xF000F000F000F000), np.uint64(0x8888888888888888))
+
+def getBlockCounts(binary: np.ndarray) -> np.ndarray:
+    # Foreground voxels per block, binary dimensions are multiples of BLOCK_SIZE
+    counts = binary[0::BLOCK_SIZE].copy()
+    for i in range(1, BLOCK_SIZE):
+        counts += binary[i::BLOCK_SIZE]
+    rows = counts[:, 0::BLOCK_SIZE].copy()
+    for i in range(1, BLOCK_SIZE):
+        rows += counts[:, i::BLOCK_SIZE]
+    blocks = rows[:, :, 0::BLOCK_SIZE].copy()
+    for i in range(1, BLOCK_SIZE):
+        blocks += rows[:, :, i::BLOCK_SIZE]
+    return blocks
+
+def getNeighbourDirections() -> List[Tuple[int, int, int]]:
+    # The 13 "forward" block offsets of the 26-neighbourhood, every neighbour pair is visited once
+    return [(dz, dy, dx) for dz in (-1, 0, 1) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if (dz, dy, dx) > (0, 0, 0)]
+
+def dilateAxis(words: np.ndarray, axis: int) -> np.ndarray:
+    # One voxel dilation of block words along one axis, without wrapping into the next row/plane
+    shift = np.uint64(STRIDES[axis])
+    return words | ((words << shift) & ~FIRST_PLANES[axis]) | ((words >> shift) & ~LAST_PLANES[axis])
+
+def dilate(words: np.ndarray) -> np.ndarray:
+    # 26-neighbourhood dilation, separable along the three axes
+    for axis in range(3):
+        words = dilateAxis(words, axis)
+    return words
+
+def getFacePlanes(direction: Tuple[int, int, int]) -> np.uint64:
+    # Voxels of a block touching its neighbour at block offset direction (face, edge or corner)
+    face = np.uint64(0xFFFFFFFFFFFFFFFF)
+    for axis, d in enumerate(direction):
+        if d > 0:
+            face &= LAST_PLANES[axis]
+        elif d < 0:
+            face &= FIRST_PLANES[axis]
+    return face
+
+def getTouching(first: np.ndarray, second: np.ndarray, direction: Tuple[int, int, int]) -> np.ndarray:
+    # first[i] and second[i] are voxel sets of two blocks, second at first + direction: True where they touch
+    words = first
+    for axis, d in enumerate(direction):
+        shift = np.uint64((BLOCK_SIZE - 1) * STRIDES[axis])
+        if d > 0:
+            words = (words & LAST_PLANES[axis]) >> shift # last plane of first next to the first plane of second
+        elif d < 0:
+            words = (words & FIRST_PLANES[axis]) << shift
+        else:
+            words = dilateAxis(words, axis)
+    return (words & second) != 0
+
+def expandRanges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    # Concatenation of the ranges [start, start + count) without a Python loop
+    return np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+
+"""
+    Description: connected components (26-neighbourhood) inside every block word, by bit-parallel flood fill.
+    Params:
+        words: the foreground voxels of the blocks
+    Return: (blocks, components): the block index and the voxel set of every component, sorted by block
+"""
+def getWordComponents(words: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    blocks = []
+    components = []
+    remaining = words.copy()
+    active = np.flatnonzero(remaining)
+    while len(active):
+        # Grow the lowest remaining voxel of every block until it stops changing
+        component = remaining[active] & (~remaining[active] + np.uint64(1))
+        allowed = words[active]
+        pending = np.arange(len(active))
+        while len(pending):
+            grown = dilate(component[pending]) & allowed[pending]
+            changed = grown != component[pending]
+            component[pending] = grown
+            pending = pending[changed]
+        blocks.append(active)
+        components.append(component)
+        remaining[active] &= ~component
+        active = active[remaining[active] != 0]
+    if not blocks:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint64)
+    blocks = np.concatenate(blocks)
+    order = np.argsort(blocks, kind="stable")
+    return blocks[order], np.concatenate(components)[order]
+
+"""
+    Description:
+        computeMask working on a 4x downsampled block grid and refining at full resolution only in the
+        boundary blocks, see above. Same parameters and result as computeMask.
+    Params:
+        imageData: the volume
+        imageThreshold, minimumSize, maxNumberOfSegments, packed: see computeMask
+    Return: BinaryMask object or None if there are less than 2 segments
+"""
+def computeMaskCoarseToFine(imageData: vtk.vtkImageData, imageThreshold=-50, minimumSize=1000, maxNumberOfSegments=1, packed=True) -> Optional[BinaryMask]:
+    array = arrayFromVtk(imageData)
+    shape = array.shape
+    # x is padded to whole bytes of the packed mask (two blocks)
+    paddedShape = (-(-shape[0] // BLOCK_SIZE) * BLOCK_SIZE, -(-shape[1] // BLOCK_SIZE) * BLOCK_SIZE, -(-shape[2] // 8) * 8)
+    gridShape = tuple(n // BLOCK_SIZE for n in paddedShape)
+
+    # Threshold into a zero-padded buffer, the padding is background
+    binary = np.zeros(paddedShape, dtype=np.uint8)
+    np.greater_equal(array, imageThreshold, out=binary[:shape[0], :shape[1], :shape[2]].view(np.bool_))
+    counts = getBlockCounts(binary)
+    full = counts == BLOCK_VOXELS
+    mixed = (counts > 0) & ~full
+    del counts
+
+    # Full blocks: labels 1..coreCount on the coarse grid
+    ccfilter = sitk.ConnectedComponentImageFilter()
+    ccfilter.SetFullyConnected(True)
+    coreLabels = sitk.GetArrayFromImage(ccfilter.Execute(sitk.GetImageFromArray(full.view(np.uint8))))
+    coreCount = ccfilter.GetObjectCount()
+
+    # Mixed blocks: one word per block, components labelled coreCount + 1..nodeCount - 1
+    mixedBlocks = np.nonzero(mixed)
+    blockView = binary.reshape(gridShape[0], BLOCK_SIZE, gridShape[1], BLOCK_SIZE, gridShape[2], BLOCK_SIZE).transpose(0, 2, 4, 1, 3, 5)
+    words = np.packbits(blockView[mixedBlocks].reshape(-1, BLOCK_VOXELS), axis=1, bitorder="little").view("<u8").reshape(-1)
+    del binary, blockView
+    componentBlocks, components = getWordComponents(words)
+    componentStarts = np.searchsorted(componentBlocks, np.arange(len(words) + 1))
+
+    nodeCount = coreCount + len(components) + 1
+    sizes = np.zeros(nodeCount, dtype=np.int64)
+    sizes[:coreCount + 1] = np.bincount(coreLabels.reshape(-1), minlength=coreCount + 1) * BLOCK_VOXELS
+    sizes[coreCount + 1:] = np.bitwise_count(components)
+    sizes[0] = 0
+
+    # Links between a mixed block and its mixed or full neighbours, full/full links are in coreLabels.
+    # One id per block: brick index + 1 for mixed blocks, -core label for full blocks, 0 for empty blocks
+    blockIds = np.where(full, -coreLabels.astype(np.int64), 0)
+    blockIds[mixedBlocks] = np.arange(1, len(words) + 1)
+    blockIds = blockIds.reshape(-1)
+    mixedCoordinates = np.stack(mixedBlocks, axis=1)
+    mixedIndices = np.ravel_multi_index(mixedBlocks, gridShape)
+    unionFind = UnionFind(nodeCount)
+    for direction in getNeighbourDirections():
+        links = []
+        for side in (1, -1):
+            # Neighbours of every mixed block at side * direction
+            offset = np.array(direction) * side
+            neighbours = mixedCoordinates + offset
+            bricks = np.flatnonzero(np.all((neighbours >= 0) & (neighbours < gridShape), axis=1))
+            ids = blockIds[mixedIndices[bricks] + int(np.dot(offset, (gridShape[1] * gridShape[2], gridShape[2], 1)))]
+            if side == 1:
+                # mixed/mixed: every component of the block against every component of the neighbour
+                isMixed = ids > 0
+                firstBricks = bricks[isMixed]
+                secondBricks = ids[isMixed] - 1
+                firstCounts = componentStarts[firstBricks + 1] - componentStarts[firstBricks]
+                secondCounts = componentStarts[secondBricks + 1] - componentStarts[secondBricks]
+                combinations = firstCounts * secondCounts
+                pair = np.repeat(np.arange(len(combinations)), combinations)
+                index = expandRanges(np.zeros(len(combinations), dtype=np.int64), combinations)
+                firstComponents = componentStarts[firstBricks][pair] + index // secondCounts[pair]
+                secondComponents = componentStarts[secondBricks][pair] + index % secondCounts[pair]
+                touching = getTouching(components[firstComponents], components[secondComponents], direction)
+                links.append(np.stack([firstComponents[touching], secondComponents[touching]], axis=1) + coreCount + 1)
+            # full/mixed: every voxel of the full block is foreground, so the components of the mixed block with
+            # voxels on the shared face, edge or corner touch it
+            isFull = ids < 0
+            bricks = bricks[isFull]
+            labels = -ids[isFull]
+            counts = componentStarts[bricks + 1] - componentStarts[bricks]
+            mixedComponents = expandRanges(componentStarts[bricks], counts)
+            touching = (components[mixedComponents] & getFacePlanes(tuple(side * d for d in direction))) != 0
+            links.append(np.stack([np.repeat(labels, counts)[touching], mixedComponents[touching] + coreCount + 1], axis=1))
+        unionFind.unionPairs(np.concatenate(links))
+    roots = unionFind.roots()
+    componentSizes = np.bincount(roots, weights=sizes, minlength=nodeCount)
+    componentSizes[0] = 0
+
+    # Same selection as RelabelComponentImageFilter: objects >= minimumSize ordered by decreasing size
+    candidates = np.flatnonzero(componentSizes >= max(minimumSize, 1))
+    candidates = candidates[np.argsort(-componentSizes[candidates], kind="stable")]
+    if len(candidates) < 2:
+        return
+    if maxNumberOfSegments > 0:
+        candidates = candidates[:maxNumberOfSegments]
+    keptRoots = np.zeros(nodeCount, dtype=bool)
+    keptRoots[candidates] = True
+    kept = keptRoots[roots] # label 0 (background) is never kept
+
+    # Mask words of every block: all 0 in kept full blocks, the voxels outside kept components in mixed blocks
+    maskWords = np.where(kept[coreLabels], np.uint64(0), np.uint64(0xFFFFFFFFFFFFFFFF))
+    keptWords = np.zeros(len(words), dtype=np.uint64)
+    keptComponents = kept[coreCount + 1:]
+    np.bitwise_or.at(keptWords, componentBlocks[keptComponents], components[keptComponents])
+    maskWords[mixedBlocks] = ~keptWords
+
+    # Packed mask straight from the words: byte k of a word holds the rows y = 2 * (k % 2) and y + 1 of the
+    # plane z = k // 2 as two nibbles, two blocks side by side make one mask byte
+    wordBytes = maskWords.view(np.uint8).reshape(gridShape + (BLOCK_SIZE, 2))
+    rows = np.stack([wordBytes & 0x0F, wordBytes >> 4], axis=-1).reshape(gridShape + (BLOCK_SIZE, BLOCK_SIZE))
+    data = rows[:, :, 0::2] | (rows[:, :, 1::2] << 4)
+    data = data.transpose(0, 3, 1, 4, 2).reshape(paddedShape[0], paddedShape[1], paddedShape[2] // 8)
+    data = np.ascontiguousarray(data[:shape[0], :shape[1], :-(-shape[2] // 8)])
+    padding = data.shape[2] * 8 - shape[2]
+    if padding:
+        data[..., -1] &= np.uint8(0xFF >> padding) # keep the padding bits at 0
+    mask = BinaryMask(data, shape, True)
+    return mask if packed else mask.toUint8()
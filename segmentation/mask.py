@@ -0,0 +1,154 @@
+import struct
+import zlib
+from typing import Optional, Tuple
+
+import numpy as np
+
+RLE_MAGIC = b"RLEM"
+RLE_VERSION = 1
+
+"""
+    Description:
+        Binary mask of a (z, y, x) volume stored as uint8 (1 byte per voxel) or bit-packed (1 bit per voxel).
+        Packed masks are packed along x, one row at a time: shape (z, y, ceil(x / 8)), little bit order.
+        Rows always start on a byte, so z-slabs and rows can be processed independently; the padding bits
+        at the end of a row are kept at 0.
+        Value 1 marks a voxel of the mask (e.g. a voxel filled by applyMask).
+"""
+class BinaryMask:
+    def __init__(self, data: np.ndarray, shape: Tuple[int, int, int], packed: bool) -> None:
+        self.data = data
+        self.shape = tuple(shape)
+        self.packed = packed
+
+    @classmethod
+    def fromArray(cls, array: np.ndarray, packed=True, slabSize=64) -> "BinaryMask":
+        # array: (z, y, x) bool or 0/1 array
+        if not packed:
+            return cls(np.ascontiguousarray(array, dtype=np.uint8), array.shape, False)
+        data = np.empty(packedShape(array.shape), dtype=np.uint8)
+        for z0 in range(0, array.shape[0], slabSize):
+            data[z0:z0 + slabSize] = np.packbits(array[z0:z0 + slabSize] != 0, axis=-1, bitorder="little")
+        return cls(data, array.shape, True)
+
+    @classmethod
+    def fromLabels(cls, labelArray: np.ndarray, lookupTable: np.ndarray, packed=True, slabSize=64) -> "BinaryMask":
+        # Map a label image through a 0/1 lookup table slab by slab, no full size uint8 temporary when packed
+        if not packed:
+            return cls(lookupTable.astype(np.uint8)[labelArray], labelArray.shape, False)
+        data = np.empty(packedShape(labelArray.shape), dtype=np.uint8)
+        lookupTable = lookupTable.astype(bool)
+        for z0 in range(0, labelArray.shape[0], slabSize):
+            data[z0:z0 + slabSize] = np.packbits(lookupTable[labelArray[z0:z0 + slabSize]], axis=-1, bitorder="little")
+        return cls(data, labelArray.shape, True)
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes
+
+    def toArray(self, z0=0, z1: Optional[int] = None) -> np.ndarray:
+        # uint8 0/1 array of the slices [z0, z1)
+        if not self.packed:
+            return self.data[z0:z1]
+        return np.unpackbits(self.data[z0:z1], axis=-1, count=self.shape[2], bitorder="little")
+
+    def toUint8(self) -> "BinaryMask":
+        if not self.packed:
+            return self
+        return BinaryMask(self.toArray(), self.shape, False)
+
+    def toPacked(self) -> "BinaryMask":
+        if self.packed:
+            return self
+        return BinaryMask.fromArray(self.data, packed=True)
+
+    def count(self) -> int:
+        # Number of voxels in the mask
+        if self.packed:
+            return int(np.bitwise_count(self.data).sum(dtype=np.int64))
+        return int(np.count_nonzero(self.data))
+
+    def invert(self) -> "BinaryMask":
+        if not self.packed:
+            return BinaryMask(self.data ^ 1, self.shape, False)
+        data = np.invert(self.data)
+        padding = self.data.shape[2] * 8 - self.shape[2]
+        if padding:
+            data[..., -1] &= np.uint8(0xFF >> padding) # keep the padding bits at 0
+        return BinaryMask(data, self.shape, True)
+
+    def union(self, other: "BinaryMask") -> "BinaryMask":
+        first, second = self._aligned(other)
+        return BinaryMask(first.data | second.data, self.shape, first.packed)
+
+    def intersection(self, other: "BinaryMask") -> "BinaryMask":
+        first, second = self._aligned(other)
+        return BinaryMask(first.data & second.data, self.shape, first.packed)
+
+    def _aligned(self, other: "BinaryMask") -> Tuple["BinaryMask", "BinaryMask"]:
+        if self.shape != other.shape:
+            raise ValueError(f"Mask shapes differ: {self.shape} and {other.shape}")
+        if self.packed == other.packed:
+            return self, other
+        return self.toPacked(), other.toPacked()
+
+    def apply(self, array: np.ndarray, fillValue=-1000, slabSize=64) -> None:
+        # Set the voxels of array (same shape) in the mask to fillValue, in place
+        if tuple(array.shape) != self.shape:
+            raise ValueError(f"Mask shape {self.shape} does not match array shape {array.shape}")
+        for z0 in range(0, self.shape[0], slabSize):
+            z1 = min(self.shape[0], z0 + slabSize)
+            np.copyto(array[z0:z1], fillValue, where=self.toArray(z0, z1).view(np.bool_))
+
+    def toRLE(self, slabSize=64) -> bytes:
+        # Run-length encoded form (x fastest): header, value of the first voxel, then the run lengths
+        # as uint64, zlib compressed. Masks are a few large regions, the result is usually a few KB.
+        runs = []
+        currentValue = None
+        currentLength = 0
+        firstValue = 0
+        for z0 in range(0, self.shape[0], slabSize):
+            flat = self.toArray(z0, min(self.shape[0], z0 + slabSize)).reshape(-1)
+            if flat.size == 0:
+                continue
+            if currentValue is None:
+                currentValue = firstValue = int(flat[0])
+            changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+            boundaries = np.concatenate(([0], changes, [flat.size]))
+            lengths = np.diff(boundaries)
+            if int(flat[0]) == currentValue:
+                lengths[0] += currentLength
+            else:
+                runs.append(currentLength)
+            runs.extend(lengths[:-1].tolist())
+            currentLength = int(lengths[-1])
+            currentValue = int(flat[-1])
+        if currentValue is not None:
+            runs.append(currentLength)
+
+        header = RLE_MAGIC + struct.pack("<BIIIB", RLE_VERSION, *self.shape, firstValue)
+        return header + zlib.compress(np.asarray(runs, dtype="<u8").tobytes())
+
+    @classmethod
+    def fromRLE(cls, buffer: bytes, packed=True) -> "BinaryMask":
+        if buffer[:4] != RLE_MAGIC:
+            raise ValueError("Not a run-length encoded mask")
+        version, depth, rows, columns, firstValue = struct.unpack_from("<BIIIB", buffer, 4)
+        if version != RLE_VERSION:
+            raise ValueError(f"Unsupported mask version: {version}")
+        runs = np.frombuffer(zlib.decompress(buffer[4 + struct.calcsize("<BIIIB"):]), dtype="<u8")
+        values = (np.arange(len(runs)) + firstValue) % 2
+        flat = np.repeat(values.astype(np.uint8), runs.astype(np.int64))
+        return cls.fromArray(flat.reshape(depth, rows, columns), packed=packed)
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as f:
+            f.write(self.toRLE())
+
+    @classmethod
+    def load(cls, path: str, packed=True) -> "BinaryMask":
+        with open(path, "rb") as f:
+            return cls.fromRLE(f.read(), packed=packed)
+
+def packedShape(shape: Tuple[int, int, int]) -> Tuple[int, int, int]:
+    return (shape[0], shape[1], (shape[2] + 7) // 8)
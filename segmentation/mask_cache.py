@@ -0,0 +1,125 @@
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Optional
+
+import vtk
+
+from cache import getSeriesKey
+from mask import BinaryMask
+from remove_bed import computeMask
+
+MASK_CACHE_DIR = os.environ.get("VTK_TEST_MASK_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "vtk-test", "masks"))
+MASK_ALGORITHM_VERSION = 1 # bump when computeMask changes its output
+NO_MASK = object() # computeMask returned None, cached as well
+
+"""
+    Description:
+        Cache of bed-removal masks keyed by the series content hash and the computeMask parameters.
+        Level 1: in memory, bit-packed masks, LRU evicted above maxMemoryBytes.
+        Level 2: on disk, run-length encoded (<key>.rle, or an empty <key>.none when there is no mask),
+        LRU evicted (by modification time) above maxDiskBytes.
+"""
+class MaskCache:
+    def __init__(self, cacheDir: str = MASK_CACHE_DIR, maxMemoryBytes=512 * 1024 ** 2, maxDiskBytes=1024 ** 3) -> None:
+        self.cacheDir = cacheDir
+        self.maxMemoryBytes = maxMemoryBytes
+        self.maxDiskBytes = maxDiskBytes
+        self.entries: "OrderedDict[str, object]" = OrderedDict()
+        self.memoryBytes = 0
+
+    @staticmethod
+    def getKey(seriesKey: str, imageThreshold, minimumSize, maxNumberOfSegments) -> str:
+        parameters = f"{MASK_ALGORITHM_VERSION}|{seriesKey}|{imageThreshold}|{minimumSize}|{maxNumberOfSegments}"
+        return hashlib.sha1(parameters.encode()).hexdigest()
+
+    def get(self, key: str) -> object:
+        # Returns a BinaryMask, NO_MASK, or None when the key is not cached
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        maskPath = os.path.join(self.cacheDir, f"{key}.rle")
+        nonePath = os.path.join(self.cacheDir, f"{key}.none")
+        if os.path.exists(nonePath):
+            os.utime(nonePath)
+            self._remember(key, NO_MASK)
+            return NO_MASK
+        if os.path.exists(maskPath):
+            try:
+                mask = BinaryMask.load(maskPath)
+            except (OSError, ValueError) as e:
+                print(f"Cached mask is unreadable, recomputing: {e}")
+                return
+            os.utime(maskPath)
+            self._remember(key, mask)
+            return mask
+
+    def put(self, key: str, mask: Optional[BinaryMask]) -> None:
+        value = NO_MASK if mask is None else mask.toPacked()
+        self._remember(key, value)
+        try:
+            os.makedirs(self.cacheDir, exist_ok=True)
+            if value is NO_MASK:
+                open(os.path.join(self.cacheDir, f"{key}.none"), "wb").close()
+            else:
+                path = os.path.join(self.cacheDir, f"{key}.rle")
+                value.save(f"{path}.tmp")
+                os.replace(f"{path}.tmp", path)
+            self._evictDisk()
+        except OSError as e:
+            print(f"Mask cache is not writable: {e}")
+
+    def _remember(self, key: str, value: object) -> None:
+        if key in self.entries:
+            self.memoryBytes -= self._size(self.entries.pop(key))
+        self.entries[key] = value
+        self.memoryBytes += self._size(value)
+        while self.memoryBytes > self.maxMemoryBytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.memoryBytes -= self._size(evicted)
+
+    @staticmethod
+    def _size(value: object) -> int:
+        return value.nbytes if isinstance(value, BinaryMask) else 0
+
+    def _evictDisk(self) -> None:
+        files = []
+        totalBytes = 0
+        for name in os.listdir(self.cacheDir):
+            if not (name.endswith(".rle") or name.endswith(".none")):
+                continue
+            path = os.path.join(self.cacheDir, name)
+            size = os.path.getsize(path)
+            files.append((os.path.getmtime(path), size, path))
+            totalBytes += size
+        files.sort()
+        for _, size, path in files:
+            if totalBytes <= self.maxDiskBytes:
+                break
+            os.remove(path)
+            totalBytes -= size
+
+maskCache = MaskCache()
+
+"""
+    Description:
+        computeMask through the mask cache: reopening a study with the same parameters reuses its mask.
+    Params:
+        dirpath: the series directory of imageData (gives the content hash)
+        imageData: the volume, only read on a cache miss
+        imageThreshold, minimumSize, maxNumberOfSegments: see computeMask
+        cache: default=maskCache (process wide)
+    Return: BinaryMask object or None if there are less than 2 segments
+"""
+def getBedMask(dirpath: str, imageData: vtk.vtkImageData, imageThreshold=-50, minimumSize=1000, maxNumberOfSegments=1, cache: MaskCache = maskCache) -> Optional[BinaryMask]:
+    key = cache.getKey(getSeriesKey(dirpath), imageThreshold, minimumSize, maxNumberOfSegments)
+    cached = cache.get(key)
+    if cached is NO_MASK:
+        return
+    if cached is not None:
+        return cached
+
+    mask = computeMask(imageData, imageThreshold, minimumSize, maxNumberOfSegments)
+    cache.put(key, mask)
+    return mask
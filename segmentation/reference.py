@@ -0,0 +1,107 @@
+import os
+import sys
+from collections import deque
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mask import BinaryMask
+
+"""
+    Straightforward implementations the segmentation fast paths are compared with by the regression tests
+    (test_*.py): random small volumes, breadth-first 26-connected labelling and the mask of computeMask.
+    Run the tests with: python -m pytest segmentation
+"""
+
+SHAPES = [(9, 13, 19), (16, 16, 16), (5, 7, 33), (12, 9, 8)]
+THRESHOLD = -50
+SEEDS = range(12)
+
+"""
+    Description: a random CT-like volume: a few boxes and sparse voxels above THRESHOLD on air.
+    Params:
+        shape: (z, y, x)
+        seed: seed of the generator
+    Return: an int16 array
+"""
+def randomVolume(shape: Tuple[int, int, int], seed: int) -> np.ndarray:
+    generator = np.random.default_rng(seed)
+    array = np.full(shape, -1000, dtype=np.int16)
+    for _ in range(generator.integers(2, 6)):
+        start = [generator.integers(0, n) for n in shape]
+        size = [generator.integers(1, max(2, n // 2)) for n in shape]
+        array[start[0]:start[0] + size[0], start[1]:start[1] + size[1], start[2]:start[2] + size[2]] = generator.integers(0, 500)
+    noise = generator.random(shape) < 0.03
+    array[noise] = generator.integers(-50, 300, size=int(noise.sum()))
+    return array
+
+"""
+    Description: 26-connected components by breadth-first search, one voxel at a time.
+    Params:
+        binary: a (z, y, x) bool array
+    Return: labels (0 = background, 1.. in scan order) and the size of every label
+"""
+def labelComponents(binary: np.ndarray) -> Tuple[np.ndarray, List[int]]:
+    labels = np.zeros(binary.shape, dtype=np.int64)
+    sizes = [0]
+    offsets = [(dz, dy, dx) for dz in (-1, 0, 1) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if (dz, dy, dx) != (0, 0, 0)]
+    for seed in zip(*np.nonzero(binary)):
+        if labels[seed]:
+            continue
+        label = len(sizes)
+        labels[seed] = label
+        queue = deque([seed])
+        size = 0
+        while queue:
+            z, y, x = queue.popleft()
+            size += 1
+            for dz, dy, dx in offsets:
+                neighbour = (z + dz, y + dy, x + dx)
+                if all(0 <= neighbour[axis] < binary.shape[axis] for axis in range(3)) and binary[neighbour] and not labels[neighbour]:
+                    labels[neighbour] = label
+                    queue.append(neighbour)
+        sizes.append(size)
+    return labels, sizes
+
+"""
+    Description: the mask of computeMask written directly (voxels outside the maxNumberOfSegments largest objects).
+    Params:
+        array: the volume
+        minimumSize, maxNumberOfSegments: see computeMask
+    Return: uint8 mask, None if less than 2 objects, "tie" when objects of equal size are at the cut
+"""
+def referenceMask(array: np.ndarray, minimumSize: int, maxNumberOfSegments: int):
+    labels, sizes = labelComponents(array >= THRESHOLD)
+    candidates = sorted((label for label in range(1, len(sizes)) if sizes[label] >= max(minimumSize, 1)), key=lambda label: -sizes[label])
+    if len(candidates) < 2:
+        return
+    if maxNumberOfSegments > 0:
+        if len(candidates) > maxNumberOfSegments and sizes[candidates[maxNumberOfSegments - 1]] == sizes[candidates[maxNumberOfSegments]]:
+            return "tie" # the order of equal objects is not specified
+        candidates = candidates[:maxNumberOfSegments]
+    return (~np.isin(labels, candidates)).astype(np.uint8)
+
+"""
+    Description: (volume, minimumSize, maxNumberOfSegments, expected mask) of every random case without a tie.
+    Return: a list of cases
+"""
+def getCases() -> List[Tuple[np.ndarray, int, int, Optional[np.ndarray]]]:
+    cases = []
+    for shape in SHAPES:
+        for seed in SEEDS:
+            array = randomVolume(shape, seed)
+            for minimumSize, maxNumberOfSegments in ((1, 1), (4, 2), (2, 0)):
+                expected = referenceMask(array, minimumSize, maxNumberOfSegments)
+                if isinstance(expected, str):
+                    continue
+                cases.append((array, minimumSize, maxNumberOfSegments, expected))
+    return cases
+
+def assertMask(mask, expected: Optional[np.ndarray]) -> None:
+    if expected is None:
+        assert mask is None
+        return
+    assert mask is not None
+    array = mask.toArray() if isinstance(mask, BinaryMask) else np.asarray(mask)
+    np.testing.assert_array_equal(array, expected)
@@ -1,21 +1,23 @@
 import vtk
-from vtkmodules.util.numpy_support import vtk_to_numpy, numpy_to_vtk
-import math
-from typing import Optional
+import numpy as np
+from typing import Optional, Union
 import SimpleITK as sitk
-
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "reader"))
+from cache import loadCachedVolume
+from loader import wrapArrayAsImageData
+from bridge import arrayFromVtk, vtkToSitk, fillMaskedVoxels
+from mask import BinaryMask
+from presets import presetRegistry
+from instrumentation import timed, span, instrumentAlgorithm, instrumentRenderWindow
+
+@timed()
 def vtk2sitk(vtkImage: vtk.vtkImageData) -> sitk.Image:
-    # Takes a VTK image, returns a SimpleITK image
-    dimentions = vtkImage.GetDimensions()
-    spacing = vtkImage.GetSpacing()
-
-    shape = dimentions[::-1]
-    nparray = vtk_to_numpy(vtkImage.GetPointData().GetScalars()).reshape(shape)
-
-    image = sitk.GetImageFromArray(nparray)
-    image.SetSpacing(spacing)
-    return image
+    # Takes a VTK image, returns a SimpleITK image with the same spacing, origin and direction
+    return vtkToSitk(vtkImage)
 
+@timed()
 def getLabelmap(binaryImageData: vtk.vtkImageData, minimumSize: int) -> Optional[vtk.vtkImageData]:
     from vtkITK import vtkITKIslandMath
 
@@ -32,24 +34,30 @@ def getLabelmap(binaryImageData: vtk.vtkImageData, minimumSize: int) -> Optional
     # print(islandImage.GetScalarRange())
     return islandImage
 
-def splitSegments(imageData: vtk.vtkImageData, imageThreshold=-50, minimumSize=1000, maxNumberOfSegments=1) -> Optional[vtk.vtkImageData]:
-    # Create a mask using global thresholding
-    scalarRange = imageData.GetScalarRange()
-    thresh = vtk.vtkImageThreshold()
-    thresh.SetInputData(imageData)
-    thresh.ThresholdBetween(imageThreshold, scalarRange[1])
-    thresh.SetInValue(1)
-    thresh.SetOutValue(0)
-    thresh.SetOutputScalarType(vtk.VTK_UNSIGNED_INT)
-    thresh.Update()
-    binaryImageData = thresh.GetOutput()
-    scalarRange = binaryImageData.GetScalarRange()
-
-    sitkImage = vtk2sitk(binaryImageData)
+"""
+    Description:
+        Threshold + connected components + relabel, returns the voxels outside the maxNumberOfSegments largest
+        segments (background, small objects, bed) as a BinaryMask. The mask stays uint8 or bit-packed from the
+        threshold to the application, only the label image of SimpleITK is uint32.
+    Params:
+        imageData: the volume
+        imageThreshold: voxels >= imageThreshold are foreground
+        minimumSize: smaller objects are dropped
+        maxNumberOfSegments: number of kept segments, <= 0 keeps every object >= minimumSize
+        packed: 1 bit per voxel instead of 1 byte, default=True
+    Return: BinaryMask object or None if there are less than 2 segments
+"""
+@timed()
+def computeMask(imageData: vtk.vtkImageData, imageThreshold=-50, minimumSize=1000, maxNumberOfSegments=1, packed=True) -> Optional[BinaryMask]:
+    # Create a mask using global thresholding, done in numpy so only a uint8 copy is handed to SimpleITK
+    binaryArray = (arrayFromVtk(imageData) >= imageThreshold).view(np.uint8)
+    sitkImage = vtkToSitk(imageData, binaryArray)
+    del binaryArray
 
     ccfilter = sitk.ConnectedComponentImageFilter()
     ccfilter.SetFullyConnected(True)
     output = ccfilter.Execute(sitkImage)
+    del sitkImage
 
     relabel = sitk.RelabelComponentImageFilter()
     relabel.SetMinimumObjectSize(minimumSize)
@@ -60,65 +68,39 @@ def splitSegments(imageData: vtk.vtkImageData, imageThreshold=-50, minimumSize=1
     if labelcount < 2:
         return
 
-    array = sitk.GetArrayFromImage(output)
-    binaryImageData.GetPointData().SetScalars(numpy_to_vtk(array.flat))
-    labelmap = binaryImageData
-    
-    dimensions = labelmap.GetDimensions()
+    dimensions = imageData.GetDimensions()
     if dimensions[0] <= 0 or dimensions[1] <= 0 or dimensions[2] <= 0:
-        print("Labelmap is empty, there are no label values. Running vtkImageAccumulate would cause a crash")
+        print("Labelmap is empty, there are no label values")
         return
-    
-    scalarRange = labelmap.GetScalarRange()
-    lowLabel = math.floor(scalarRange[0])
-    highLabel = math.ceil(scalarRange[1])
-
-    # Generalized histograms
-    imageAccumulate = vtk.vtkImageAccumulate()
-    imageAccumulate.SetInputData(labelmap)
-    imageAccumulate.IgnoreZeroOn()
-    imageAccumulate.SetComponentExtent(lowLabel, highLabel, 0, 0, 0, 0)
-    imageAccumulate.SetComponentOrigin(0, 0, 0)
-    imageAccumulate.SetComponentSpacing(1, 1, 1)
-    imageAccumulate.Update()
-
-    labels = vtk.vtkIntArray()
-    for label in range(lowLabel, highLabel + 1):
-        if label == 0:
-            continue
-        frequency = imageAccumulate.GetOutput().GetPointData().GetScalars().GetTuple1(label - lowLabel)
-        if frequency == 0:
-            continue
-        labels.InsertNextValue(label)
-
-    for i in range(labels.GetNumberOfTuples()):
-        if maxNumberOfSegments > 0 and i >= maxNumberOfSegments:
-            break
-
-        label = int(labels.GetTuple1(i))
-        
-        threshold = vtk.vtkImageThreshold()
-        threshold.SetInputData(labelmap)
-        threshold.ThresholdBetween(label, label)
-        threshold.SetInValue(0)
-        threshold.SetOutValue(1)
-        threshold.Update()
-
-        castIn = vtk.vtkImageCast()
-        castIn.SetInputData(threshold.GetOutput())
-        castIn.SetOutputScalarTypeToUnsignedChar()
-        castIn.Update()
-
-        return castIn.GetOutput()
-
-def applyMask(imageData: vtk.vtkImageData, mask: vtk.vtkImageData, fillValue=-1000) -> None:
-    dimensions = imageData.GetDimensions()
-    shape = dimensions[::-1]
-    array = vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(shape)
-    maskArray = vtk_to_numpy(mask.GetPointData().GetScalars()).reshape(shape)
-    
-    array[maskArray > 0] = fillValue
-    imageData.GetPointData().SetScalars(numpy_to_vtk(array.flat))
+
+    # RelabelComponentImageFilter numbers the kept objects 1..labelcount by decreasing size,
+    # so the label sizes are already known and no histogram of the label image is needed
+    labels = np.arange(1, labelcount + 1)
+    if maxNumberOfSegments > 0:
+        labels = labels[:maxNumberOfSegments]
+
+    # Lookup table over label values: 0 for the kept segments, 1 elsewhere (background, small objects, bed)
+    lookupTable = np.ones(labelcount + 1, dtype=np.uint8)
+    lookupTable[labels] = 0
+    return BinaryMask.fromLabels(sitk.GetArrayViewFromImage(output), lookupTable, packed=packed)
+
+@timed()
+def splitSegments(imageData: vtk.vtkImageData, imageThreshold=-50, minimumSize=1000, maxNumberOfSegments=1) -> Optional[vtk.vtkImageData]:
+    # Same mask as computeMask as a uint8 vtkImageData with the geometry of imageData
+    mask = computeMask(imageData, imageThreshold, minimumSize, maxNumberOfSegments, packed=False)
+    if mask is None:
+        return
+    return wrapArrayAsImageData(mask.data, imageData.GetSpacing(), imageData.GetOrigin())
+
+@timed()
+def applyMask(imageData: vtk.vtkImageData, mask: Union[vtk.vtkImageData, BinaryMask], fillValue=-1000) -> None:
+    # In place, the scalars of imageData are not replaced
+    if isinstance(mask, BinaryMask):
+        mask.apply(arrayFromVtk(imageData), fillValue)
+        imageData.GetPointData().GetScalars().Modified()
+        imageData.Modified()
+        return
+    fillMaskedVoxels(imageData, arrayFromVtk(mask), fillValue)
 
 def showVolume(dirpath: str) -> None:
     renderer = vtk.vtkRenderer()
@@ -130,12 +112,12 @@ def showVolume(dirpath: str) -> None:
     renderWindowInteractor.SetInteractorStyle(style)
     renderWindow.SetInteractor(renderWindowInteractor)
 
-    reader = vtk.vtkDICOMImageReader()
-    reader.SetDirectoryName(dirpath)
-    reader.Update()
-    imageData = reader.GetOutput()
+    imageData = loadCachedVolume(dirpath)
 
-    mask = splitSegments(imageData)
+    from mask_cache import getBedMask # mask_cache imports this module
+
+    with span("remove_bed.getBedMask"):
+        mask = getBedMask(dirpath, imageData)
     if mask is not None:
         applyMask(imageData, mask)
 
@@ -153,35 +135,8 @@ def showVolume(dirpath: str) -> None:
     volumeProperty.SetSpecular(0.3)
     volumeProperty.SetSpecularPower(15)
 
-    gradientOpacity = vtk.vtkPiecewiseFunction()
-    gradientOpacity.AddPoint(0, 1)
-    gradientOpacity.AddPoint(255, 1)
-    volumeProperty.SetGradientOpacity(gradientOpacity)
-
-    scalarColorTransferFunction = vtk.vtkColorTransferFunction()
-    # Slicer preset (CT-AAA)
-    scalarColorTransferFunction.AddRGBPoint(-3024, 0, 0, 0)
-    scalarColorTransferFunction.AddRGBPoint(143.556, 0.615686, 0.356863, 0.184314)
-    scalarColorTransferFunction.AddRGBPoint(166.222, 0.882353, 0.603922, 0.290196)
-    scalarColorTransferFunction.AddRGBPoint(214.389, 1, 1, 1)
-    scalarColorTransferFunction.AddRGBPoint(419.736, 1, 0.937033, 0.954531)
-    scalarColorTransferFunction.AddRGBPoint(3071, 0.827451, 0.658824, 1)
-    volumeProperty.SetColor(scalarColorTransferFunction)
-
-    scalarOpacity = vtk.vtkPiecewiseFunction()
     # Slicer preset (CT-AAA)
-    scalarOpacity.AddPoint(-3024, 0)
-    scalarOpacity.AddPoint(143.556, 0)
-    scalarOpacity.AddPoint(166.222, 0.686275)
-    scalarOpacity.AddPoint(214.389, 0.696078)
-    scalarOpacity.AddPoint(419.736, 0.833333)
-    scalarOpacity.AddPoint(3071, 0.803922)
-    volumeProperty.SetScalarOpacity(scalarOpacity)
-
-    gradientOpacity = vtk.vtkPiecewiseFunction()
-    gradientOpacity.AddPoint(0, 1)
-    gradientOpacity.AddPoint(255, 1)
-    volumeProperty.SetGradientOpacity(gradientOpacity)
+    presetRegistry.applyPreset(volumeProperty, "CT-AAA")
 
     volume = vtk.vtkVolume()
     volume.SetMapper(mapper)
@@ -190,6 +145,8 @@ def showVolume(dirpath: str) -> None:
     renderer.AddVolume(volume)
     renderer.ResetCamera()
 
+    instrumentAlgorithm(mapper)
+    instrumentRenderWindow(renderWindow)
     renderWindowInteractor.Start()
 
 if __name__ == "__main__":
@@ -0,0 +1,161 @@
+from typing import List, Optional, Sequence
+
+import numpy as np
+import SimpleITK as sitk
+import vtk
+
+from bridge import arrayFromVtk
+from mask import BinaryMask
+
+"""
+    Description:
+        Interactive bed-removal session: after a one-time build, changing the threshold, the minimum size
+        or the number of kept segments only rewrites the voxels whose mask value changes.
+
+        Build (component tree over quantized thresholds, highest level first):
+            The voxels >= the lowest level are sorted by intensity once. The voxels entering at level k
+            (levels[k] <= v < levels[k - 1]) are a contiguous range of that order, "band k".
+            The superlevel set {v >= levels[k]} is labelled once (fully connected, as computeMask).
+            Its components are the tree nodes of level k. Every node of level k - 1 lies in exactly one node
+            of level k (its parent) because the superlevel sets are nested. Node sizes come from the band
+            sizes and the children sizes, no extra pass over the volume is needed. Inside band k the voxels
+            are reordered by node, so the voxels of a node are one range of the order (CSR layout). No
+            per-voxel label image is kept after the build.
+
+        Query (level K, minimumSize, maxNumberOfSegments):
+            The kept nodes are picked among the nodes of level K like RelabelComponentImageFilter does.
+            A voxel entered at level k <= K is kept when the ancestor of its node at level K is kept.
+            Only the nodes whose value changes since the previous query have their voxels rewritten.
+
+        Thresholds are snapped to the nearest level, results are exact for thresholds in levels.
+    Params:
+        imageData: the volume (read during the build only)
+        levels: thresholds available to the slider (any order)
+        minimumSize, maxNumberOfSegments: initial parameters, see computeMask
+"""
+class SegmentationSession:
+    def __init__(self, imageData: vtk.vtkImageData, levels: Sequence[float] = tuple(range(-300, 201, 25)), minimumSize=1000, maxNumberOfSegments=1) -> None:
+        self.levels = np.array(sorted(set(levels), reverse=True), dtype=np.float64)
+        self.shape = imageData.GetDimensions()[::-1]
+        self.minimumSize = minimumSize
+        self.maxNumberOfSegments = maxNumberOfSegments
+        self.levelIndex: Optional[int] = None
+
+        self.order: np.ndarray = np.empty(0, dtype=np.int64) # flat voxel indices, grouped by band then node
+        self.nodeOffsets: List[int] = [] # first node id of every level
+        self.parents: List[np.ndarray] = [] # parents[k][i]: node of level k + 1 (local index) containing node i of level k
+        self.sizes: List[np.ndarray] = [] # sizes[k][i]: voxel count of node i of level k
+        self.voxelStarts: np.ndarray = np.empty(0, dtype=np.int64) # voxels of node n: order[voxelStarts[n]:voxelStarts[n + 1]]
+        self._build(arrayFromVtk(imageData))
+
+        self.nodeValues = np.ones(self.nodeCount, dtype=np.uint8)
+        self.maskArray = np.ones(self.shape, dtype=np.uint8) # 1 = filled by applyMask, like computeMask
+
+    @property
+    def nodeCount(self) -> int:
+        return len(self.voxelStarts) - 1
+
+    def _build(self, array: np.ndarray) -> None:
+        flat = array.reshape(-1)
+        candidates = np.flatnonzero(flat >= self.levels[-1])
+        # Intensity order, highest first: the bands are consecutive ranges
+        order = candidates[np.argsort(-flat[candidates].astype(np.int32), kind="stable")]
+        bandEnds = np.searchsorted(-flat[order].astype(np.float64), -self.levels, side="right")
+        del candidates
+
+        voxelCounts = []
+        representatives = np.empty(0, dtype=np.int64) # one voxel of every node of the previous level
+        previousSizes = np.empty(0, dtype=np.int64)
+        bandStart = 0
+        nodeOffset = 0
+        for k, level in enumerate(self.levels):
+            bandEnd = bandEnds[k]
+            ccfilter = sitk.ConnectedComponentImageFilter()
+            ccfilter.SetFullyConnected(True)
+            labelImage = ccfilter.Execute(sitk.GetImageFromArray((array >= level).view(np.uint8)))
+            labels = sitk.GetArrayViewFromImage(labelImage).reshape(-1)
+            count = ccfilter.GetObjectCount()
+
+            band = order[bandStart:bandEnd]
+            bandLabels = labels[band].astype(np.int64) - 1
+            parentLabels = labels[representatives].astype(np.int64) - 1
+            del labels, labelImage
+
+            if k > 0:
+                self.parents.append(parentLabels)
+            bandSizes = np.bincount(bandLabels, minlength=count)
+            self.sizes.append(bandSizes + np.bincount(parentLabels, weights=previousSizes, minlength=count).astype(np.int64))
+
+            nodeRepresentatives = np.empty(count, dtype=np.int64)
+            nodeRepresentatives[parentLabels] = representatives
+            nodeRepresentatives[bandLabels] = band
+
+            # CSR: voxels of the band grouped by node
+            order[bandStart:bandEnd] = band[np.argsort(bandLabels, kind="stable")]
+            voxelCounts.append(bandSizes)
+            self.nodeOffsets.append(nodeOffset)
+
+            representatives = nodeRepresentatives
+            previousSizes = self.sizes[-1]
+            nodeOffset += count
+            bandStart = bandEnd
+
+        self.order = order[:bandStart]
+        self.nodeOffsets.append(nodeOffset)
+        self.voxelStarts = np.concatenate(([0], np.cumsum(np.concatenate(voxelCounts)))).astype(np.int64)
+
+    def _computeNodeValues(self, levelIndex: int) -> Optional[np.ndarray]:
+        sizes = self.sizes[levelIndex]
+        candidates = np.flatnonzero(sizes >= max(self.minimumSize, 1))
+        if len(candidates) < 2:
+            return
+        candidates = candidates[np.argsort(-sizes[candidates], kind="stable")]
+        if self.maxNumberOfSegments > 0:
+            candidates = candidates[:self.maxNumberOfSegments]
+
+        kept = np.zeros(len(sizes), dtype=bool)
+        kept[candidates] = True
+        values = np.ones(self.nodeCount, dtype=np.uint8)
+        # Walk down from level K to level 0 composing the parent maps: ancestor[k][i] = node of level K
+        ancestors = np.arange(len(sizes))
+        for k in range(levelIndex, -1, -1):
+            if k < levelIndex:
+                ancestors = ancestors[self.parents[k]]
+            start, end = self.nodeOffsets[k], self.nodeOffsets[k + 1]
+            values[start:end] = np.where(kept[ancestors], 0, 1)
+        return values
+
+    def update(self, imageThreshold: Optional[float] = None, minimumSize: Optional[int] = None, maxNumberOfSegments: Optional[int] = None) -> Optional[BinaryMask]:
+        # Change any parameter, returns the mask (a view of the session buffer) or None if less than 2 segments
+        if imageThreshold is not None:
+            self.levelIndex = int(np.argmin(np.abs(self.levels - imageThreshold)))
+        if minimumSize is not None:
+            self.minimumSize = minimumSize
+        if maxNumberOfSegments is not None:
+            self.maxNumberOfSegments = maxNumberOfSegments
+        if self.levelIndex is None:
+            raise ValueError("No threshold set")
+
+        values = self._computeNodeValues(self.levelIndex)
+        if values is None:
+            return
+        changedNodes = np.flatnonzero(values != self.nodeValues)
+        self._writeNodes(changedNodes, values)
+        self.nodeValues = values
+        return BinaryMask(self.maskArray, self.shape, False)
+
+    def _writeNodes(self, nodes: np.ndarray, values: np.ndarray) -> None:
+        if len(nodes) == 0:
+            return
+        starts = self.voxelStarts[nodes]
+        lengths = self.voxelStarts[nodes + 1] - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return
+        # Indices into self.order of all changed ranges, without a Python loop over the nodes
+        positions = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+        self.maskArray.reshape(-1)[self.order[positions]] = np.repeat(values[nodes], lengths)
+
+    @property
+    def threshold(self) -> Optional[float]:
+        return None if self.levelIndex is None else float(self.levels[self.levelIndex])
@@ -0,0 +1,178 @@
+import os
+import tempfile
+from typing import List, Optional
+
+import numpy as np
+import SimpleITK as sitk
+
+"""
+    Out-of-core version of splitSegments/applyMask.
+    The volume is processed in z-slabs, so only one slab of the input, of the uint8 binary image
+    and of the uint32 label image is in memory at a time. The input can be a np.memmap
+    (e.g. a volume of the cache opened with np.load(path, mmap_mode="r")).
+"""
+
+class UnionFind:
+    def __init__(self, size: int) -> None:
+        self.parent = np.arange(size, dtype=np.int64)
+
+    def find(self, label: int) -> int:
+        root = label
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[label] != root: # path compression
+            self.parent[label], label = root, self.parent[label]
+        return int(root)
+
+    def union(self, first: int, second: int) -> None:
+        firstRoot = self.find(first)
+        secondRoot = self.find(second)
+        if firstRoot != secondRoot:
+            self.parent[max(firstRoot, secondRoot)] = min(firstRoot, secondRoot)
+
+    def unionPairs(self, pairs: np.ndarray) -> None:
+        # union() of every (N, 2) pair at once: hook the larger root under the smaller one, then compress,
+        # until both labels of every pair share their root
+        first = pairs[:, 0].astype(np.int64)
+        second = pairs[:, 1].astype(np.int64)
+        while len(first):
+            self.parent = self.roots()
+            firstRoots = self.parent[first]
+            secondRoots = self.parent[second]
+            different = firstRoots != secondRoots
+            if not different.any():
+                break
+            first, second = first[different], second[different]
+            firstRoots, secondRoots = firstRoots[different], secondRoots[different]
+            np.minimum.at(self.parent, np.maximum(firstRoots, secondRoots), np.minimum(firstRoots, secondRoots))
+
+    def roots(self) -> np.ndarray:
+        # Pointer jumping over all labels at once, union() always links to the smaller root
+        parent = self.parent
+        while True:
+            grandParent = parent[parent]
+            if np.array_equal(grandParent, parent):
+                return parent
+            parent = grandParent
+
+"""
+    Description:
+        Pairs of labels touching across the border between two neighbouring slices,
+        with the 26-neighbourhood of a fully connected ConnectedComponentImageFilter.
+    Params:
+        lower: the last label slice of a slab (global labels)
+        upper: the first label slice of the next slab (global labels)
+    Return: an (N, 2) array of unique label pairs
+"""
+def getBorderPairs(lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+    rows, columns = lower.shape
+    pairs = []
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            a = lower[max(0, -dy):rows - max(0, dy), max(0, -dx):columns - max(0, dx)]
+            b = upper[max(0, dy):rows - max(0, -dy), max(0, dx):columns - max(0, -dx)]
+            touching = (a > 0) & (b > 0)
+            if touching.any():
+                # One uint64 key per pair, a 1D unique is much cheaper than np.unique(axis=0)
+                keys = (a[touching].astype(np.uint64) << np.uint64(32)) | b[touching].astype(np.uint64)
+                pairs.append(np.unique(keys))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.uint32)
+    keys = np.unique(np.concatenate(pairs))
+    return np.stack([keys >> np.uint64(32), keys & np.uint64(0xFFFFFFFF)], axis=1).astype(np.uint32)
+
+"""
+    Description:
+        Threshold + connected components + relabel of splitSegments, slab by slab.
+        Pass 1 labels every slab on its own and spills the labels (made global by an offset) to a temporary
+        memory-mapped file, the components touching across a slab border are merged with a union-find.
+        Pass 2 maps every global label to the mask value and writes the uint8 mask slab by slab.
+    Params:
+        array: a (z, y, x) array or np.memmap
+        maskPath: path of the output mask (.npy, memory-mapped)
+        imageThreshold, minimumSize, maxNumberOfSegments: see splitSegments
+        slabSize: number of slices per slab
+        tempDir: directory of the temporary label file, default=None (system default)
+    Return: the mask as np.memmap (1 = voxels to fill, 0 = kept segments) or None if less than 2 segments
+"""
+def splitSegmentsOutOfCore(array: np.ndarray, maskPath: str, imageThreshold=-50, minimumSize=1000, maxNumberOfSegments=1, slabSize=64, tempDir: Optional[str] = None) -> Optional[np.memmap]:
+    depth = array.shape[0]
+    fd, labelPath = tempfile.mkstemp(suffix=".labels", dir=tempDir)
+    os.close(fd)
+    labels = None
+    try:
+        labels = np.memmap(labelPath, dtype=np.uint32, mode="w+", shape=array.shape)
+        sizes: List[np.ndarray] = [np.zeros(1, dtype=np.int64)] # global label 0 is the background
+        borderPairs = []
+        offset = 0
+        previousLastSlice = None
+
+        for z0 in range(0, depth, slabSize):
+            z1 = min(depth, z0 + slabSize)
+            binary = (np.asarray(array[z0:z1]) >= imageThreshold).view(np.uint8)
+            ccfilter = sitk.ConnectedComponentImageFilter()
+            ccfilter.SetFullyConnected(True)
+            slabLabels = sitk.GetArrayFromImage(ccfilter.Execute(sitk.GetImageFromArray(binary)))
+            count = ccfilter.GetObjectCount()
+            del binary
+
+            slabSizes = np.bincount(slabLabels.ravel(), minlength=count + 1)[1:]
+            slabLabels[slabLabels > 0] += offset
+            labels[z0:z1] = slabLabels
+            sizes.append(slabSizes)
+
+            if previousLastSlice is not None:
+                borderPairs.append(getBorderPairs(previousLastSlice, slabLabels[0]))
+            previousLastSlice = slabLabels[-1].copy()
+            offset += count
+            del slabLabels
+        labels.flush()
+
+        unionFind = UnionFind(offset + 1)
+        if borderPairs:
+            unionFind.unionPairs(np.concatenate(borderPairs))
+        roots = unionFind.roots()
+        componentSizes = np.bincount(roots, weights=np.concatenate(sizes), minlength=offset + 1)
+        componentSizes[0] = 0
+
+        # Same selection as RelabelComponentImageFilter: objects >= minimumSize ordered by decreasing size
+        candidates = np.flatnonzero(componentSizes >= max(minimumSize, 1))
+        candidates = candidates[np.argsort(-componentSizes[candidates], kind="stable")]
+        if len(candidates) < 2:
+            return
+        if maxNumberOfSegments > 0:
+            candidates = candidates[:maxNumberOfSegments]
+
+        keptRoots = np.zeros(offset + 1, dtype=bool)
+        keptRoots[candidates] = True
+        lookupTable = (~keptRoots[roots]).astype(np.uint8)
+
+        mask = np.lib.format.open_memmap(maskPath, mode="w+", dtype=np.uint8, shape=array.shape)
+        for z0 in range(0, depth, slabSize):
+            z1 = min(depth, z0 + slabSize)
+            mask[z0:z1] = lookupTable[labels[z0:z1]]
+        mask.flush()
+        return mask
+    finally:
+        labels = None # close the memory map before removing its file
+        os.remove(labelPath)
+
+"""
+    Description: applyMask slab by slab, the result is written to a new memory-mapped .npy file.
+    Params:
+        array: a (z, y, x) array or np.memmap
+        mask: the mask of splitSegmentsOutOfCore
+        outputPath: path of the output volume (.npy)
+        fillValue: value of the masked voxels
+        slabSize: number of slices per slab
+    Return: the masked volume as np.memmap
+"""
+def applyMaskOutOfCore(array: np.ndarray, mask: np.ndarray, outputPath: str, fillValue=-1000, slabSize=64) -> np.memmap:
+    output = np.lib.format.open_memmap(outputPath, mode="w+", dtype=array.dtype, shape=array.shape)
+    for z0 in range(0, array.shape[0], slabSize):
+        z1 = min(array.shape[0], z0 + slabSize)
+        slab = np.array(array[z0:z1])
+        np.copyto(slab, fillValue, where=mask[z0:z1].view(np.bool_))
+        output[z0:z1] = slab
+    output.flush()
+    return output
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "reader"))
+from loader import wrapArrayAsImageData
+from coarse import computeMaskCoarseToFine
+from reference import THRESHOLD, assertMask, getCases, referenceMask
+
+# Coarse-to-fine labelling (4x4x4 blocks, refined on the mixed boundary blocks) against the whole-volume labelling
+CASES = getCases()
+
+def test_cases_cover_both_outcomes():
+    assert sum(expected is None for *_, expected in CASES) > 0
+    assert sum(expected is not None for *_, expected in CASES) > len(CASES) // 2
+
+@pytest.mark.parametrize("packed", [True, False])
+def test_computeMaskCoarseToFine(packed):
+    for array, minimumSize, maxNumberOfSegments, expected in CASES:
+        imageData = wrapArrayAsImageData(array.copy(), (1.0, 1.0, 1.0))
+        mask = computeMaskCoarseToFine(imageData, THRESHOLD, minimumSize, maxNumberOfSegments, packed=packed)
+        assertMask(mask, expected)
+
+def test_computeMaskCoarseToFine_full_blocks():
+    # Large solid objects: full 4x4x4 blocks labelled on the coarse grid, linked to the mixed boundary blocks
+    array = np.full((20, 24, 28), -1000, dtype=np.int16)
+    array[2:18, 3:15, 2:20] = 100
+    array[2:18, 17:22, 4:26] = 100
+    array[10, 15:17, 10] = 100 # one voxel wide bridge: both boxes are one object
+    array[0, 0, 27] = 100
+    expected = referenceMask(array, 1, 1)
+    imageData = wrapArrayAsImageData(array, (1.0, 1.0, 1.0))
+    assertMask(computeMaskCoarseToFine(imageData, THRESHOLD, 1, 1), expected)
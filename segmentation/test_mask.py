@@ -0,0 +1,61 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "reader"))
+from loader import wrapArrayAsImageData
+from mask import BinaryMask
+from remove_bed import computeMask
+from reference import SHAPES, THRESHOLD, assertMask, getCases
+
+CASES = getCases()
+
+# computeMask returns the same mask packed or as uint8
+@pytest.mark.parametrize("packed", [True, False])
+def test_computeMask(packed):
+    for array, minimumSize, maxNumberOfSegments, expected in CASES:
+        imageData = wrapArrayAsImageData(array.copy(), (1.0, 1.0, 1.0))
+        mask = computeMask(imageData, THRESHOLD, minimumSize, maxNumberOfSegments, packed=packed)
+        assertMask(mask, expected)
+        if mask is not None:
+            assert mask.packed == packed
+
+# Bit-packed BinaryMask against the boolean numpy operations, packed and unpacked storage
+@pytest.mark.parametrize("shape", SHAPES)
+def test_binaryMask(shape):
+    generator = np.random.default_rng(sum(shape))
+    first = generator.random(shape) < 0.5
+    second = generator.random(shape) < 0.2
+    for packed in (True, False):
+        mask = BinaryMask.fromArray(first, packed=packed, slabSize=4)
+        other = BinaryMask.fromArray(second, packed=not packed)
+        np.testing.assert_array_equal(mask.toArray(), first)
+        np.testing.assert_array_equal(mask.toArray(2, 5), first[2:5])
+        assert mask.count() == int(first.sum())
+        np.testing.assert_array_equal(mask.invert().toArray(), ~first)
+        assert mask.invert().count() == int((~first).sum()) # the padding bits stay 0
+        np.testing.assert_array_equal(mask.union(other).toArray(), first | second)
+        np.testing.assert_array_equal(mask.intersection(other).toArray(), first & second)
+        np.testing.assert_array_equal(mask.toPacked().toArray(), first)
+        np.testing.assert_array_equal(mask.toUint8().data, first)
+        np.testing.assert_array_equal(BinaryMask.fromRLE(mask.toRLE(slabSize=3), packed=packed).toArray(), first)
+
+        array = generator.integers(-1000, 1000, size=shape, dtype=np.int16)
+        expected = np.where(first, -1000, array)
+        mask.apply(array, -1000, slabSize=3)
+        np.testing.assert_array_equal(array, expected)
+
+    labels = generator.integers(0, 5, size=shape)
+    lookupTable = np.array([1, 0, 1, 1, 0], dtype=np.uint8)
+    for packed in (True, False):
+        np.testing.assert_array_equal(BinaryMask.fromLabels(labels, lookupTable, packed=packed, slabSize=4).toArray(), lookupTable[labels])
+
+def test_binaryMask_shape_mismatch():
+    mask = BinaryMask.fromArray(np.zeros((2, 3, 4), dtype=bool))
+    with pytest.raises(ValueError):
+        mask.union(BinaryMask.fromArray(np.zeros((2, 3, 5), dtype=bool)))
+    with pytest.raises(ValueError):
+        mask.apply(np.zeros((2, 3, 5), dtype=np.int16))
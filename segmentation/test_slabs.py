@@ -0,0 +1,40 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from reference import THRESHOLD, assertMask, getCases
+from slabs import UnionFind, splitSegmentsOutOfCore
+
+# Out-of-core bed removal: slab labelling + union-find across the slab borders against the whole-volume labelling
+CASES = getCases()
+
+@pytest.mark.parametrize("slabSize", [1, 3, 64])
+def test_splitSegmentsOutOfCore(tmp_path, slabSize):
+    for index, (array, minimumSize, maxNumberOfSegments, expected) in enumerate(CASES):
+        maskPath = str(tmp_path / f"mask{index}.npy")
+        mask = splitSegmentsOutOfCore(array, maskPath, THRESHOLD, minimumSize, maxNumberOfSegments, slabSize, str(tmp_path))
+        assertMask(mask, expected)
+        del mask
+    # The temporary label files are removed
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".labels")]
+
+def test_unionFind():
+    generator = np.random.default_rng(0)
+    for _ in range(20):
+        size = int(generator.integers(2, 200))
+        pairs = generator.integers(0, size, size=(int(generator.integers(0, size)), 2))
+        # Straightforward: relabel every member of the merged set to its smallest label
+        expected = np.arange(size)
+        for first, second in pairs:
+            low, high = sorted((expected[first], expected[second]))
+            expected[expected == high] = low
+        unionFind = UnionFind(size)
+        for first, second in pairs:
+            unionFind.union(int(first), int(second))
+        np.testing.assert_array_equal(unionFind.roots(), expected)
+        unionFind = UnionFind(size)
+        unionFind.unionPairs(pairs)
+        np.testing.assert_array_equal(unionFind.roots(), expected)